@@ -0,0 +1,276 @@
+import argparse
+import asyncio
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, "src")]
+
+from src.config import MOCK_PREFIX_CACHE_MIN_TOKENS, RETRY_BASE_DELAY
+
+STAGES = ["generator", "llm_evaluator", "automated_evaluator", "verifier"]
+BENCHMARK = os.path.join(ROOT, "benchmark/fact_lens_benchmark.csv")
+SYNTHETIC = os.path.join(ROOT, "synthetic/fact_lens_synthetic_sub_claims.csv")
+COVERBENCH = os.path.join(ROOT, "data/coverbench_dataset.csv")
+
+
+class RecordingBackend:
+    '''
+    Wraps a backend and records the latency and the outcome of every call
+    '''
+    def __init__(self, backend):
+        self.backend = backend
+        self.latencies = []
+        self.errors = Counter()
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+    def create(self, model_config, timeout=None):
+        start = time.perf_counter()
+        try:
+            return self.backend.create(model_config, timeout)
+        except Exception as e:
+            self.errors[type(e).__name__] += 1
+            raise
+        finally:
+            self.latencies.append(time.perf_counter() - start)
+
+    async def acreate(self, model_config):
+        start = time.perf_counter()
+        try:
+            return await self.backend.acreate(model_config)
+        except Exception as e:
+            self.errors[type(e).__name__] += 1
+            raise
+        finally:
+            self.latencies.append(time.perf_counter() - start)
+
+
+def replicate(data, rows, exact=False):
+    '''
+    Repeat the rows of a dataset up to the given number of rows. Unless exact, every copy after the first gets its
+    copy number appended to the claim and sub-claims, so that caches and deduplication don't collapse the copies.
+    '''
+    import pandas as pd
+    n = len(data)
+    data = pd.concat([data]*(-(-rows//n)), ignore_index=True).head(rows)
+    if exact:
+        return data
+    copies = data.index//n
+    suffix = [" ({})".format(c) if c else "" for c in copies]
+    data["claim"] = [claim + s for claim, s in zip(data["claim"], suffix)]
+    if "sub_claims" in data:
+        data["sub_claims"] = [[c + s for c in sub_claims] for sub_claims, s in zip(data["sub_claims"], suffix)]
+    return data
+
+
+def load_inputs(stage, rows, exact=False):
+    '''
+    Claims of the benchmark for the generator, automated evaluator and verifier, the synthetic sub-claims
+    for the LLM evaluator. The verifier uses the CoverBench contexts when data/load_dataset.py was run,
+    the claim itself otherwise.
+    '''
+    from src.dataset_io import read_dataset
+    if stage == "llm_evaluator":
+        data = read_dataset(SYNTHETIC, columns=["claim", "sub_claims"])
+    else:
+        data = read_dataset(BENCHMARK, columns=["ind", "claim", "sub_claims"])
+    data = data[data["sub_claims"].notna()].reset_index(drop=True)
+    if stage == "verifier":
+        if os.path.exists(COVERBENCH):
+            contexts = read_dataset(COVERBENCH, columns=["context"])["context"]
+            data["context"] = contexts.iloc[data["ind"]].values
+        else:
+            data["context"] = data["claim"]
+    data = replicate(data, rows, exact)
+    if stage == "generator":
+        data = data[["claim"]].copy()
+    return data
+
+
+def make_stage(stage, args):
+    '''
+    The stage, the function processing a chunk of rows with it, and the function closing it
+    '''
+    if stage == "generator":
+        from sub_claim_generator import SubClaimGenerator
+        s = SubClaimGenerator(stable_prefix=args.stable_prefix, dedup=args.dedup, route_atomic=args.route_atomic)
+        run, close = s.process, lambda: None
+    elif stage == "llm_evaluator":
+        from sub_claim_evaluator import SubClaimEvaluator
+        s = SubClaimEvaluator(single_pass=args.single_pass, dedup=args.dedup)
+        run, close = s.process, lambda: None
+    elif stage == "automated_evaluator":
+        from automated_evaluator import AutomatedEvaluator
+        s = AutomatedEvaluator(
+            batch_entities=args.batch_entities, workers=args.workers, stable_prefix=args.stable_prefix, dedup=args.dedup
+        )
+        run, close = s.process, s.close
+    else:
+        from verifier import Verifier
+        s = Verifier(cache=False, stable_prefix=args.stable_prefix, dedup=args.dedup, retrieval_k=args.retrieval_k)
+
+        def run(chunk):
+            return asyncio.run(s.verify_many(chunk["sub_claims"].tolist(), chunk["context"].tolist(), args.early_exit))
+        close = lambda: None
+    s.async_model.max_in_flight = args.max_in_flight
+    s.async_model.backoff.base_delay = args.retry_base_delay
+    return s, run, close
+
+
+def percentile(values, q):
+    import numpy as np
+    return float(np.percentile(values, q)) if values else 0.0
+
+
+def run_stage(stage, args):
+    '''
+    Run one stage over the replicated inputs in chunks, a chunk which fails is counted as failed rows
+    '''
+    from src import instrumentation
+    from src.backends import MockBackend, set_backend
+    from src.resilience import set_dead_letter
+    backend = RecordingBackend(MockBackend(args.latency, args.jitter, args.failure_rate, args.seed, args.prefix_cache_min_tokens))
+    set_backend(backend)
+    metrics = instrumentation.add_hook(instrumentation.Metrics())
+    dead_letter_path = os.path.join(args.dead_letter_dir, "{}.jsonl".format(stage))
+    if os.path.exists(dead_letter_path):
+        os.remove(dead_letter_path)
+    dead_letter = set_dead_letter(dead_letter_path)
+
+    data = load_inputs(stage, args.rows, args.exact_copies)
+    s, run, close = make_stage(stage, args)
+    rows_failed = 0
+    chunk_errors = Counter()
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start = time.perf_counter()
+    try:
+        for i in range(0, len(data), args.chunksize):
+            chunk = data.iloc[i:i + args.chunksize].copy()
+            try:
+                run(chunk)
+            except Exception as e:
+                rows_failed += len(chunk)
+                chunk_errors[type(e).__name__] += 1
+    finally:
+        close()
+    wall = time.perf_counter() - start
+    cpu = sum(
+        getattr(after, k) - getattr(before, k)
+        for before, after in [(usage, resource.getrusage(resource.RUSAGE_SELF)), (children, resource.getrusage(resource.RUSAGE_CHILDREN))]
+        for k in ["ru_utime", "ru_stime"]
+    )
+
+    rows = len(data)
+    calls = len(backend.latencies)
+    tokens = metrics.summary().get(stage, {})
+    return {
+        "rows": rows,
+        "rows_failed": rows_failed,
+        "wall_seconds": wall,
+        "rows_per_second": (rows - rows_failed)/wall if wall else 0,
+        "calls": calls,
+        "calls_per_row": calls/rows if rows else 0,
+        "prompt_tokens_per_row": tokens.get("prompt_tokens", 0)/rows if rows else 0,
+        "completion_tokens_per_row": tokens.get("completion_tokens", 0)/rows if rows else 0,
+        "cached_token_share": tokens.get("cached_token_share", 0),
+        "cost_per_1k_rows": 1000*tokens.get("cost", 0)/rows if rows else 0,
+        "failed_calls": sum(backend.errors.values()),
+        "retries": tokens.get("retries", 0),
+        "dead_letter_rows": dead_letter.count,
+        "errors": dict(backend.errors),
+        "failed_chunks": dict(chunk_errors),
+        "dedup": s.dedup.report() if s.dedup is not None else None,
+        "routed_claims": s.routed if getattr(s, "router", None) is not None else None,
+        "call_latency_p50": percentile(backend.latencies, 50),
+        "call_latency_p99": percentile(backend.latencies, 99),
+        "cpu_seconds": cpu,
+        "peak_rss_mb": max(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        )/1024,
+    }
+
+
+def compare(results, baseline, tolerance):
+    '''
+    Stages whose throughput dropped by more than tolerance (a fraction) against a baseline run
+    '''
+    regressions = {}
+    for stage, result in results["stages"].items():
+        before = baseline.get("stages", {}).get(stage)
+        if not before or not before.get("rows_per_second") or "rows_per_second" not in result:
+            continue
+        change = result["rows_per_second"]/before["rows_per_second"] - 1
+        if change < -tolerance:
+            regressions[stage] = {"rows_per_second": result["rows_per_second"], "baseline": before["rows_per_second"], "change": change}
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Throughput and latency of the FactLens stages against a mock LLM")
+    parser.add_argument("--stages", nargs="+", default=STAGES, choices=STAGES)
+    parser.add_argument("--rows", type=int, default=10000, help="rows per stage, the bundled datasets are replicated up to this size")
+    parser.add_argument("--chunksize", type=int, default=1000, help="rows processed per call of the stage")
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds per mock request")
+    parser.add_argument("--jitter", type=float, default=0.0, help="seconds of uniform random latency added per request")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="fraction of mock requests failing")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--max-in-flight", type=int, default=64, help="concurrent requests per stage")
+    parser.add_argument("--retry-base-delay", type=float, default=RETRY_BASE_DELAY, help="seconds before the first retry of a failed request")
+    parser.add_argument("--dead-letter-dir", default=tempfile.gettempdir(), help="failed rows are written to <stage>.jsonl here")
+    parser.add_argument("--single-pass", action="store_true", help="LLM evaluator scores all metrics in one request per row")
+    parser.add_argument("--batch-entities", action="store_true", help="automated evaluator extracts the entities of a row in one request")
+    parser.add_argument("--workers", type=int, default=None, help="automated evaluator scoring processes")
+    parser.add_argument("--route-atomic", action="store_true", help="generator passes claims classified atomic through without a model call")
+    parser.add_argument("--early-exit", action="store_true", help="verifier stops at the first false sub-claim")
+    parser.add_argument("--retrieval-k", type=int, default=0, help="verifier checks each sub-claim against the k most relevant chunks of the context")
+    parser.add_argument("--dedup", action="store_true", help="stages run once per unique claim / row and share the results")
+    parser.add_argument("--exact-copies", action="store_true", help="replicate rows without numbering the copies, so that they are duplicates")
+    parser.add_argument("--stable-prefix", action="store_true", help="prefix-stable prompts for the generator, entity extraction and verifier")
+    parser.add_argument("--prefix-cache-min-tokens", type=int, default=MOCK_PREFIX_CACHE_MIN_TOKENS, help="shortest prompt prefix the mock provider caches")
+    parser.add_argument("--output", default=None, help="write the results as JSON")
+    parser.add_argument("--baseline", default=None, help="results of a previous run, stages slower by more than --tolerance fail")
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    parser.add_argument("--run-stage", choices=STAGES, default=None, help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def main():
+    args = parse_args()
+    if args.run_stage:
+        print(json.dumps(run_stage(args.run_stage, args)))
+        return
+
+    # every stage runs in a fresh interpreter, so that peak RSS and CPU time are its own
+    results = {"config": {k: v for k, v in vars(args).items() if k not in ("run_stage", "output", "baseline")}, "stages": {}}
+    for stage in args.stages:
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--run-stage", stage] + sys.argv[1:],
+            cwd=ROOT, capture_output=True, text=True
+        )
+        if output.returncode:
+            results["stages"][stage] = {"error": output.stderr.strip().splitlines()[-1:]}
+            continue
+        results["stages"][stage] = json.loads(output.stdout.strip().splitlines()[-1])
+        print(stage, json.dumps(results["stages"][stage]), file=sys.stderr)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            results["regressions"] = compare(results, json.load(f), args.tolerance)
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if results.get("regressions"):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+# entry point module -> stage constructed on start
+ENTRY_POINTS = {
+    "sub_claim_generator": "SubClaimGenerator",
+    "sub_claim_evaluator": "SubClaimEvaluator",
+    "automated_evaluator": "AutomatedEvaluator",
+    "verifier": "Verifier",
+}
+
+PROBE = '''
+import json, resource, sys, time
+start = time.perf_counter()
+module = __import__(sys.argv[1])
+imported = time.perf_counter()
+getattr(module, sys.argv[2])()
+constructed = time.perf_counter()
+print(json.dumps({{
+    "import_seconds": imported - start,
+    "construct_seconds": constructed - imported,
+    "total_seconds": constructed - start,
+    "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024,
+    "modules": len(sys.modules),
+    "heavy_modules": sorted(m for m in {heavy} if m in sys.modules),
+}}))
+'''
+
+HEAVY_MODULES = ["pandas", "numpy", "torch", "transformers", "bert_score", "openai", "tqdm", "jaro"]
+
+
+def measure(module, stage, repeat):
+    '''
+    Cold start of an entry point: import its module and construct its stage in a fresh interpreter
+    '''
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([root, os.path.join(root, "src")]))
+    probe = PROBE.format(heavy=HEAVY_MODULES)
+    runs = []
+    for _ in range(repeat):
+        output = subprocess.run(
+            [sys.executable, "-c", probe, module, stage], env=env, cwd=root, capture_output=True, text=True, check=True
+        ).stdout
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+    best = min(runs, key=lambda r: r["total_seconds"])
+    best["peak_rss_mb"] = max(r["peak_rss_mb"] for r in runs)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cold-start latency and peak memory of the FactLens entry points")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per entry point, the fastest is reported")
+    parser.add_argument("--output", default=None, help="write the results as JSON")
+    args = parser.parse_args()
+
+    results = {module: measure(module, stage, args.repeat) for module, stage in ENTRY_POINTS.items()}
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    main()
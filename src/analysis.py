@@ -0,0 +1,308 @@
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from src.config import BOOTSTRAP_CONFIDENCE, BOOTSTRAP_RESAMPLES, BOOTSTRAP_SEED
+from src.dataset_io import as_list, parse_literal
+
+METRICS = ["atomicity", "sufficiency", "fabrication", "coverage", "redundancy"]
+SUB_CLAIM_METRICS = ["atomicity", "sufficiency", "fabrication"]
+HUMANS = ["human1", "human2"]
+EVALUATORS = {"llm": "llm_evaluation_scores", "automated": "automated_scores"}
+STATISTICS = ["kappa", "weighted_kappa", "spearman", "kendall"]
+LEVELS = 3 # scores are 1 (low / non-atomic-2), 2 (medium / non-atomic-1) or 3 (high / atomic)
+LABEL_PATTERN = r"(non-atomic-2|non-atomic-1|atomic|low|medium|high)"
+LABEL_VALUES = {"atomic": 3, "non-atomic-1": 2, "non-atomic-2": 1, "low": 1, "medium": 2, "high": 3}
+BOOTSTRAP_CHUNK = 50 # resamples per task, fixed so that the intervals don't depend on the number of workers
+KENDALL_MAX_CELLS = 10**7 # above this many contingency table cells (e.g. continuous scores), Kendall's tau is computed per resample
+
+
+def literal(value, kind):
+    '''
+    List or dict column value, either native (JSONL, Parquet) or stringified (CSV), None for a failed row
+    or a malformed value, parsed like the stages parse them (dataset_io)
+    '''
+    if isinstance(value, str):
+        value = parse_literal(value)
+    elif kind is list and hasattr(value, "tolist"):
+        value = as_list(value)
+    return value if isinstance(value, kind) else None
+
+
+def label_values(values):
+    '''
+    Numeric scores of a column of labels ("high", "non-atomic-1", or a judge answer containing one) or numbers,
+    NaN where there is no score
+    '''
+    import pandas as pd
+    values = pd.Series(values, dtype=object).reset_index(drop=True)
+    numbers = pd.to_numeric(values, errors="coerce")
+    labels = values.where(values.map(lambda v: isinstance(v, str)))
+    found = labels.astype(str).str.lower().str.extract(LABEL_PATTERN, expand=False).map(LABEL_VALUES)
+    return numbers.fillna(found.where(labels.notna())).astype(float).to_numpy()
+
+
+def long_table(lists, column):
+    '''
+    One row per element of a column of lists: the row, the position in the list and its numeric score
+    '''
+    import pandas as pd
+    lengths = np.array([len(v) if isinstance(v, list) else 0 for v in lists])
+    return pd.DataFrame({
+        "row": np.repeat(np.arange(len(lists)), lengths),
+        "sub_claim": np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths),
+        column: label_values([x for v in lists if isinstance(v, list) for x in v]),
+    })
+
+
+def flatten(data):
+    '''
+    Numeric scores of the human annotators (<metric>_human1, <metric>_human2) and of the evaluators
+    (llm_evaluation_scores, automated_scores) of a dataframe, as two tables with a <metric>_<rater> column per
+    metric and rater: one row per claim, and one row per sub-claim for the sub-claim level metrics.
+    The claim-level score of a sub-claim level metric is the mean over the sub-claims, as the evaluators compute it.
+    '''
+    import pandas as pd
+    claims = pd.DataFrame(index=range(len(data)))
+    parts = []
+    for column in data.columns:
+        metric, _, rater = column.rpartition("_")
+        if metric not in METRICS or rater not in HUMANS:
+            continue
+        values = data[column].tolist()
+        if metric in SUB_CLAIM_METRICS:
+            lists = [literal(v, list) for v in values]
+            parts.append(long_table(lists, column).set_index(["row", "sub_claim"]))
+        else:
+            claims[column] = label_values(values)
+
+    for rater, column in EVALUATORS.items():
+        if column not in data:
+            continue
+        scores = pd.DataFrame.from_records([literal(s, dict) or {} for s in data[column]], index=claims.index)
+        for metric in METRICS:
+            if metric in SUB_CLAIM_METRICS and "{}_fine_grained".format(metric) in scores:
+                lists = [v if isinstance(v, list) else None for v in scores["{}_fine_grained".format(metric)]]
+                parts.append(long_table(lists, "{}_{}".format(metric, rater)).set_index(["row", "sub_claim"]))
+            elif metric in scores:
+                claims["{}_{}".format(metric, rater)] = label_values(scores[metric])
+
+    sub_claims = pd.concat(parts, axis=1).sort_index() if parts else pd.DataFrame(index=pd.MultiIndex.from_arrays([[], []], names=["row", "sub_claim"]))
+    if parts:
+        claims = claims.join(sub_claims.groupby(level="row").mean())
+    claims.index.name = "row"
+    return claims, sub_claims
+
+
+def confusion(a, b):
+    '''
+    Confusion matrices (rows: levels of a, columns: levels of b) of the scores in the last axis of a and b,
+    scores are rounded to the nearest level
+    '''
+    a = np.clip(np.rint(a), 1, LEVELS).astype(int) - 1
+    b = np.clip(np.rint(b), 1, LEVELS).astype(int) - 1
+    batch = a.shape[:-1]
+    offsets = LEVELS*LEVELS*np.arange(int(np.prod(batch))).reshape(batch + (1,))
+    counts = np.bincount((offsets + a*LEVELS + b).ravel(), minlength=LEVELS*LEVELS*int(np.prod(batch)))
+    return counts.reshape(batch + (LEVELS, LEVELS))
+
+
+def cohen_kappa(a, b, weights=None):
+    '''
+    Cohen's kappa along the last axis, unweighted or with "linear" or "quadratic" disagreement weights
+    '''
+    observed = confusion(a, b).astype(float)
+    observed /= observed.sum(axis=(-2, -1), keepdims=True)
+    expected = observed.sum(axis=-1)[..., :, None]*observed.sum(axis=-2)[..., None, :]
+    distance = np.abs(np.subtract.outer(np.arange(LEVELS), np.arange(LEVELS)))
+    weight = {None: distance > 0, "linear": distance, "quadratic": distance**2}[weights].astype(float)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        # NaN when both raters always give the same single score
+        return 1 - (weight*observed).sum(axis=(-2, -1))/(weight*expected).sum(axis=(-2, -1))
+
+
+def pearson(x, y):
+    x = x - x.mean(axis=-1, keepdims=True)
+    y = y - y.mean(axis=-1, keepdims=True)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return (x*y).sum(axis=-1)/np.sqrt((x*x).sum(axis=-1)*(y*y).sum(axis=-1))
+
+
+def spearman(a, b):
+    '''
+    Spearman's rank correlation along the last axis, tied scores get their average rank
+    '''
+    from scipy.stats import rankdata
+    return pearson(rankdata(a, axis=-1), rankdata(b, axis=-1))
+
+
+def kendall(a, b):
+    '''
+    Kendall's tau-b along the last axis, from the contingency table of the distinct scores of a and b:
+    the pairs of cells below and to the right are concordant, below and to the left discordant
+    '''
+    n = a.shape[-1]
+    batch = a.shape[:-1]
+    a_values, a_codes = np.unique(a, return_inverse=True)
+    b_values, b_codes = np.unique(b, return_inverse=True)
+    cells = len(a_values)*len(b_values)
+    if cells*int(np.prod(batch)) > KENDALL_MAX_CELLS:
+        from scipy.stats import kendalltau
+        tau = [kendalltau(x, y).statistic for x, y in zip(a.reshape(-1, n), b.reshape(-1, n))]
+        return np.array(tau).reshape(batch)
+    offsets = cells*np.arange(int(np.prod(batch))).reshape(batch + (1,))
+    codes = offsets + a_codes.reshape(a.shape)*len(b_values) + b_codes.reshape(b.shape)
+    table = np.bincount(codes.ravel(), minlength=cells*int(np.prod(batch))).reshape(batch + (len(a_values), len(b_values)))
+    below = np.flip(np.cumsum(np.flip(table, -2), -2), -2) - table
+    right = np.flip(np.cumsum(np.flip(below, -1), -1), -1) - below
+    left = np.cumsum(below, -1) - below
+    difference = (table*(right - left)).sum(axis=(-2, -1))
+    pairs = n*(n - 1)/2
+    a_ties = (table.sum(axis=-1)*(table.sum(axis=-1) - 1)/2).sum(axis=-1)
+    b_ties = (table.sum(axis=-2)*(table.sum(axis=-2) - 1)/2).sum(axis=-1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return difference/np.sqrt((pairs - a_ties)*(pairs - b_ties))
+
+
+def statistics(a, b):
+    '''
+    All agreement statistics of a and b along the last axis
+    '''
+    return {
+        "kappa": cohen_kappa(a, b),
+        "weighted_kappa": cohen_kappa(a, b, "quadratic"),
+        "spearman": spearman(a, b),
+        "kendall": kendall(a, b),
+    }
+
+
+def _bootstrap_chunk(task):
+    '''
+    Statistics of size resamples (with replacement) of the pairs of every comparison
+    '''
+    comparisons, seed, size = task
+    rng = np.random.default_rng(seed)
+    results = []
+    for a, b in comparisons:
+        index = rng.integers(0, len(a), (size, len(a)))
+        results.append(statistics(a[index], b[index]))
+    return results
+
+
+def bootstrap(comparisons, resamples=BOOTSTRAP_RESAMPLES, seed=BOOTSTRAP_SEED, workers=None):
+    '''
+    Bootstrap distributions of the statistics of every (a, b) comparison: one array of resamples per statistic.
+    Resamples are drawn in chunks of BOOTSTRAP_CHUNK, each from its own seed, and the chunks run in parallel
+    in worker processes (all cores by default, 0 to run in this process).
+    '''
+    sizes = [min(BOOTSTRAP_CHUNK, resamples - start) for start in range(0, resamples, BOOTSTRAP_CHUNK)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    tasks = [(comparisons, s, size) for s, size in zip(seeds, sizes)]
+    workers = os.cpu_count() if workers is None else workers
+    if workers and len(tasks) > 1:
+        with ProcessPoolExecutor(min(workers, len(tasks))) as pool:
+            chunks = list(pool.map(_bootstrap_chunk, tasks))
+    else:
+        chunks = list(map(_bootstrap_chunk, tasks))
+    return [
+        {k: np.concatenate([chunk[i][k] for chunk in chunks]) for k in STATISTICS}
+        for i in range(len(comparisons))
+    ]
+
+
+def rater_pairs(columns, metric):
+    '''
+    (rater a, rater b) pairs to compare on a metric: the two annotators, and every evaluator against each annotator
+    '''
+    raters = [r for r in HUMANS + list(EVALUATORS) if "{}_{}".format(metric, r) in columns]
+    humans = [r for r in raters if r in HUMANS]
+    pairs = [(humans[0], humans[1])] if len(humans) == 2 else []
+    return pairs + [(r, h) for r in raters if r not in HUMANS for h in humans]
+
+
+def agreement(data, resamples=BOOTSTRAP_RESAMPLES, confidence=BOOTSTRAP_CONFIDENCE, seed=BOOTSTRAP_SEED, workers=None):
+    '''
+    Agreement of the evaluators with the human annotators, and of the annotators with each other, per metric
+    at the claim and at the sub-claim level: Cohen's kappa (unweighted and quadratic-weighted, on scores rounded
+    to the nearest level), Spearman's rho and Kendall's tau-b, with bootstrap confidence intervals, and the
+    confusion matrices. Rows missing a score of either rater are left out of that comparison.
+    '''
+    import pandas as pd
+    claims, sub_claims = flatten(data)
+    keys = []
+    comparisons = []
+    for level, table in [("claim", claims), ("sub_claim", sub_claims)]:
+        for metric in METRICS if level == "claim" else SUB_CLAIM_METRICS:
+            for a, b in rater_pairs(table.columns, metric):
+                x = table["{}_{}".format(metric, a)].to_numpy(dtype=float)
+                y = table["{}_{}".format(metric, b)].to_numpy(dtype=float)
+                valid = ~(np.isnan(x) | np.isnan(y))
+                if valid.sum() < 2:
+                    continue
+                keys.append((level, metric, a, b))
+                comparisons.append((x[valid], y[valid]))
+
+    samples = bootstrap(comparisons, resamples, seed, workers) if resamples else [{} for _ in comparisons]
+    alpha = 100*(1 - confidence)/2
+    records = []
+    confusions = {}
+    for (level, metric, a, b), (x, y), sample in zip(keys, comparisons, samples):
+        record = {"level": level, "metric": metric, "rater_a": a, "rater_b": b, "n": len(x)}
+        for k, value in statistics(x, y).items():
+            record[k] = float(value)
+            if k in sample:
+                # a statistic undefined in every resample (a rater giving a single score) has no interval
+                finite = sample[k][np.isfinite(sample[k])]
+                low, high = np.percentile(finite, [alpha, 100 - alpha]) if len(finite) else (np.nan, np.nan)
+                record["{}_low".format(k)], record["{}_high".format(k)] = low, high
+        records.append(record)
+        confusions[(level, metric, a, b)] = pd.DataFrame(
+            confusion(x, y), index=pd.Index(range(1, LEVELS + 1), name=a), columns=pd.Index(range(1, LEVELS + 1), name=b)
+        )
+    return pd.DataFrame.from_records(records), confusions
+
+
+def read_scores(paths):
+    '''
+    Columns of datasets holding the same rows (e.g. the LLM and the automated evaluation of the synthetic set)
+    side by side, each column taken from the first dataset which has it
+    '''
+    import pandas as pd
+    from src.dataset_io import read_dataset
+    data = None
+    for path in paths:
+        d = read_dataset(path)
+        if data is None:
+            data = d
+            continue
+        if len(d) != len(data) or ("claim" in d and "claim" in data and (d["claim"].values != data["claim"].values).any()):
+            raise ValueError("{} doesn't hold the same rows as {}".format(path, paths[0]))
+        data = pd.concat([data, d[[c for c in d.columns if c not in data.columns]].set_index(data.index)], axis=1)
+    return data
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Agreement of the evaluators with the human annotations of the synthetic set")
+    parser.add_argument("inputs", nargs="+", help="datasets of the same rows with <metric>_human1/2, llm_evaluation_scores and/or automated_scores columns")
+    parser.add_argument("--output", default=None, help="write the statistics as CSV")
+    parser.add_argument("--resamples", type=int, default=BOOTSTRAP_RESAMPLES, help="bootstrap resamples, 0 for no confidence intervals")
+    parser.add_argument("--confidence", type=float, default=BOOTSTRAP_CONFIDENCE)
+    parser.add_argument("--seed", type=int, default=BOOTSTRAP_SEED)
+    parser.add_argument("--workers", type=int, default=None, help="bootstrap processes, all cores by default, 0 to run in this process")
+    parser.add_argument("--confusion", action="store_true", help="print the confusion matrices")
+    args = parser.parse_args()
+
+    import pandas as pd
+    report, confusions = agreement(read_scores(args.inputs), args.resamples, args.confidence, args.seed, args.workers)
+    with pd.option_context("display.max_rows", None, "display.width", 200, "display.float_format", "{:.3f}".format):
+        print(report.to_string(index=False))
+        if args.confusion:
+            for (level, metric, a, b), matrix in confusions.items():
+                print("\n{} {}: {} vs {}\n{}".format(level, metric, a, b, matrix.to_string()))
+    if args.output:
+        report.to_csv(args.output, index=False)
+
+if __name__ == '__main__':
+    main()
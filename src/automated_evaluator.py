@@ -1,92 +1,419 @@
+import argparse
 import os
-import pandas as pd
-import ast
+import asyncio
 import json
-from src.prompts import ENTITY_EXTRACTOR_PROMPT
-from src.open_ai import OpenAI
-import jaro
-import itertools
-from bert_score import BERTScorer
+from concurrent.futures import ProcessPoolExecutor
+from src.prompts import (BATCH_ENTITY_EXTRACTOR_PROMPT, ENTITY_EXTRACTOR_PROMPT,
+                         PREFIX_STABLE_BATCH_ENTITY_EXTRACTOR_PROMPT,
+                         PREFIX_STABLE_ENTITY_EXTRACTOR_PROMPT)
+from src.dataset_io import (as_list, read_dataset, require_list, run_streaming,
+                            streaming_output, write_dataset)
+from src.dedup import DedupStats, UniqueTable
+from src.incremental import fingerprint, get_cell_store, source
+from src.instrumentation import labels
+from src.open_ai import AsyncOpenAI
+from src.registry import get_bert_scorer
+from src.resilience import ParseError, gather_rows, parse_json
 import warnings
-from tqdm import tqdm
 warnings.filterwarnings("ignore")
 
+_worker = None
+
+# settings of the evaluator which the pool processes score with
+WORKER_SETTINGS = ["redundancy_chunk_size", "bert_model", "fabrication_threshold", "coverage_threshold", "redundancy_threshold"]
+
+def _init_worker(settings):
+    '''
+    Load the evaluator (and its BERT model) once per pool process, with the settings of the parent evaluator
+    '''
+    import torch
+    global _worker
+    torch.set_num_threads(1) # one core per process
+    _worker = AutomatedEvaluator()
+    for name, value in settings.items():
+        setattr(_worker, name, value)
+
+def _score_rows(rows):
+    return _worker.score_rows(rows)
+
+def check_entities(content):
+    '''
+    Entities answer with lists of subjects and objects, ValueError otherwise
+    '''
+    if not isinstance(content, dict) or not isinstance(content.get("subjects"), list) or not isinstance(content.get("objects"), list):
+        raise ValueError("expected a dictionary with lists of subjects and objects")
+    return content
+
 class AutomatedEvaluator():
-    def __init__(self):
-        self.model = OpenAI(os.environ['OPENAI_API_KEY'], os.environ['OPENAI_ORGANIZATION'])
-        self.scorer = BERTScorer(model_type="bert-base-uncased") 
+    def __init__(self, batch_entities=False, redundancy_chunk_size=256, workers=None, incremental=False, stable_prefix=False,
+                 dedup=False):
+        self.batch_entities = batch_entities # extract entities of a claim and its sub-claims in one request
+        self.redundancy_chunk_size = redundancy_chunk_size # rows whose sub-claims are encoded together, None to encode row by row
+        self.workers = workers # processes scoring fabrication, coverage and redundancy, None to score in this process
+        self.store = get_cell_store() if incremental else None # only score the row x metric cells which changed
+        self.dedup = DedupStats() if dedup else None # score every unique (claim, sub-claims) row once
+        self.entity_model = "gpt-4o-mini"
+        # with stable_prefix the instructions come before the claim, so that requests share a cached prompt prefix
+        self.entity_prompt = PREFIX_STABLE_ENTITY_EXTRACTOR_PROMPT if stable_prefix else ENTITY_EXTRACTOR_PROMPT
+        self.batch_entity_prompt = PREFIX_STABLE_BATCH_ENTITY_EXTRACTOR_PROMPT if stable_prefix else BATCH_ENTITY_EXTRACTOR_PROMPT
+        self.bert_model = "bert-base-uncased"
+        self.fabrication_threshold = 0.75 # Jaro-Winkler score of a sub-claim entity matching a claim entity
+        self.coverage_threshold = 0.6 # Jaro-Winkler score of a claim entity matching a sub-claim entity
+        self.redundancy_threshold = 0.85 # BERTScore F1 of a redundant pair of sub-claims
+        self.metrics = ["atomicity", "fabrication", "coverage", "redundancy"]
+        self._pool = None
+        self._pool_settings = None # settings the pool processes score with
+        self.entity_cache = {} # claim/sub-claim -> entities, shared across rows
+        self.max_cached_entities = 1000000 # texts in the entity cache, it is cleared when full
+        self._pending = {}
+        self._pair_scores = None
+        self._entity_indexes = {}
+        self._redundancy = None
+        self.async_model = AsyncOpenAI(os.environ.get('OPENAI_API_KEY', ''), os.environ.get('OPENAI_ORGANIZATION', ''), stage="automated_evaluator")
+
+    @property
+    def scorer(self):
+        '''
+        BERTScorer, loaded on first use and shared by the whole process
+        '''
+        return get_bert_scorer(self.bert_model)
+
+    @property
+    def redundancy(self):
+        if self._redundancy is None:
+            from src.redundancy import BERTScoreRedundancy
+            self._redundancy = BERTScoreRedundancy(self.scorer)
+        return self._redundancy
+
+    @property
+    def pair_scores(self):
+        '''
+        Entity pair -> Jaro-Winkler score, shared across rows
+        '''
+        if self._pair_scores is None:
+            from src.entity_index import PairScores
+            self._pair_scores = PairScores()
+        return self._pair_scores
 
     def set_data(self, path):
-        self.data = pd.read_csv(path)
+        self.data = read_dataset(path)
 
     def set_output_file(self, path):
         self.output_file = path
 
 
-    def get_entities(self, claim, sub_claims):
-        '''
-        Get entities (subjects, objects) for a claim/sub-claim
-        '''
-        def get_entities_helper(c):
-            '''
-            Extract list of subjects and objects from a claim using LLM
-            '''
-            user_prompt = ENTITY_EXTRACTOR_PROMPT.format(claim=c)
-            model_config = {
-                "model": "gpt-4o-mini",
-                "messages": [
-                    {
-                        "role": "system",
-                        "content": "Your answer should be strictly be in form of a dictionary with keys: subjects and objects"
-                    },
-                    {
-                        "role": "user",
-                        "content": user_prompt
-                    }
-                ],
-                "temperature": 0,
-                "response_format": {"type": "json_object"}
-            }
-            response = self.model.call(model_config)
-            content = response.choices[0]["message"]["content"]
-            content = json.loads(content)
-            return content
+    async def extract_entities(self, c):
+        '''
+        Extract list of subjects and objects from a claim using LLM
+        '''
+        user_prompt = self.entity_prompt.format(claim=c)
+        model_config = {
+            "model": self.entity_model,
+            "messages": [
+                {
+                    "role": "system",
+                    "content": "Your answer should be strictly be in form of a dictionary with keys: subjects and objects"
+                },
+                {
+                    "role": "user",
+                    "content": user_prompt
+                }
+            ],
+            "temperature": 0,
+            "response_format": {"type": "json_object"}
+        }
+        with labels(metric="entities"):
+            return await self.async_model.call_json(model_config, validate=check_entities)
+
+    async def extract_entities_batch(self, texts):
+        '''
+        Extract subjects and objects of several claims in one request. 
+        Claims missing from the answer (or with a malformed answer) are extracted individually.
+        '''
+        claims = {str(i + 1): c for i, c in enumerate(texts)}
+        user_prompt = self.batch_entity_prompt.format(claims=json.dumps(claims, indent=2, ensure_ascii=False))
+        model_config = {
+            "model": self.entity_model,
+            "messages": [
+                {
+                    "role": "system",
+                    "content": "Your answer should be strictly be in form of a dictionary keyed by claim id, each value a dictionary with keys: subjects and objects"
+                },
+                {
+                    "role": "user",
+                    "content": user_prompt
+                }
+            ],
+            "temperature": 0,
+            "response_format": {"type": "json_object"}
+        }
+        with labels(metric="entities_batch"):
+            response = await self.async_model.call(model_config)
+        content = response.choices[0]["message"]["content"]
+        try:
+            content = parse_json(content)
+        except ParseError:
+            content = {}
+
         entities = {}
-        entities[claim] = get_entities_helper(claim)
-        for sub_claim in sub_claims:
-            entities[sub_claim] = get_entities_helper(sub_claim)
+        for i, c in claims.items():
+            e = content.get(i) if isinstance(content, dict) else None
+            if isinstance(e, dict) and isinstance(e.get("subjects"), list) and isinstance(e.get("objects"), list):
+                entities[c] = {"subjects": e["subjects"], "objects": e["objects"]}
+        missing = [c for c in texts if c not in entities]
+        results = await asyncio.gather(*[self.extract_entities(c) for c in missing])
+        entities.update(zip(missing, results))
         return entities
-        
-    def evaluate_sub_claims(self):
+
+    async def get_entities(self, claim, sub_claims):
+        '''
+        Get entities (subjects, objects) for a claim/sub-claim. 
+        Every distinct text is extracted only once across rows, in batch mode the remaining texts of a row share one request.
+        '''
+        texts = list(dict.fromkeys([claim] + list(require_list(sub_claims, "sub_claims"))))
+        # read now, the cache may be cleared while the row waits
+        entities = {c: self.entity_cache[c] for c in texts if c in self.entity_cache}
+        waiting = {c: self._pending[c] for c in texts if c not in entities and c in self._pending}
+        todo = [c for c in texts if c not in entities and c not in waiting]
+        if todo:
+            loop = asyncio.get_running_loop()
+            futures = {c: loop.create_future() for c in todo}
+            self._pending.update(futures)
+            try:
+                if self.batch_entities:
+                    results = await self.extract_entities_batch(todo)
+                else:
+                    results = dict(zip(todo, await asyncio.gather(*[self.extract_entities(c) for c in todo])))
+                for c in todo:
+                    self.cache_entities(c, results[c])
+                    entities[c] = results[c]
+                    futures[c].set_result(results[c])
+            except Exception as e:
+                for f in futures.values():
+                    if not f.done():
+                        f.set_exception(e)
+                raise
+            finally:
+                for c in todo:
+                    self._pending.pop(c, None)
+
+        for c, future in waiting.items():
+            entities[c] = await future
+        return {c: entities[c] for c in texts}
+
+    def cache_entities(self, text, entities):
+        if len(self.entity_cache) >= self.max_cached_entities:
+            self.entity_cache.clear()
+        self.entity_cache[text] = entities
+
+    async def get_all_entities(self, claims, sub_claims, rows=None):
+        '''
+        Extract entities of all rows concurrently, results are returned in row order (None for a failed row)
+        '''
+        rows = range(len(claims)) if rows is None else rows
+        inputs = [{"claim": c, "sub_claims": s} for c, s in zip(claims, sub_claims)]
+        return await gather_rows("automated_evaluator", rows, inputs, [self.get_entities(c, s) for c, s in zip(claims, sub_claims)])
+
+    def entity_key(self, text):
+        '''
+        Fingerprint of the entities of a text: the text, the extraction prompts and the model
+        '''
+        prompts = [self.entity_prompt] + ([self.batch_entity_prompt] if self.batch_entities else [])
+        return fingerprint("entities", text, prompts, self.entity_model)
+
+    def pair_key(self, sub_claims):
+        '''
+        Fingerprint of the BERTScore F1 of the pairs of sub-claims of a row
+        '''
+        from src.redundancy import BERTScoreRedundancy
+        return fingerprint("bertscore_pairs", sub_claims, self.bert_model, source(BERTScoreRedundancy))
+
+    def cell_key(self, m, claim, sub_claims, entities):
+        '''
+        Fingerprint of everything the score of metric m for a row depends on: the texts, their entities (BERTScore
+        pairs for redundancy), the thresholds and the scoring code
+        '''
+        from src.entity_index import EntityIndex
+        if m == "redundancy":
+            return fingerprint(
+                "automated_evaluator", m, self.pair_key(sub_claims), self.redundancy_threshold,
+                source(self.calculate_redundancy), source(self.score_metric)
+            )
+        code = {
+            "atomicity": [self.calculate_atomicity, self.compound_atomicity],
+            "fabrication": [self.calculate_fabrication, self.compound_metric, EntityIndex],
+            "coverage": [self.calculate_coverage, EntityIndex],
+        }[m]
+        threshold = {"fabrication": self.fabrication_threshold, "coverage": self.coverage_threshold}.get(m)
+        row_entities = [entities[c] for c in [claim] + list(sub_claims)]
+        return fingerprint(
+            "automated_evaluator", m, claim, sub_claims, row_entities, threshold,
+            [source(f) for f in code + [self.score_metric]]
+        )
+
+    def load_entities(self, texts):
+        '''
+        Fill the entity cache from the cell store, returns the keys of the texts whose entities are not stored
+        '''
+        keys = {c: self.entity_key(c) for c in dict.fromkeys(texts) if c not in self.entity_cache}
+        stored = self.store.get_many(keys.values())
+        for c, k in keys.items():
+            if k in stored:
+                self.cache_entities(c, stored[k])
+        self.store.count("automated_evaluator/entities", len(stored), len(keys) - len(stored))
+        return {c: k for c, k in keys.items() if k not in stored}
+
+    def score_incremental(self, claims, sub_claims, entities):
+        '''
+        Score all rows, only the row x metric cells which are not in the cell store are computed, from the stored
+        entities and BERTScore pairs. No model calls.
+        '''
+        rows = [i for i, e in enumerate(entities) if e is not None]
+        keys = {i: {m: self.cell_key(m, claims[i], sub_claims[i], entities[i]) for m in self.metrics} for i in rows}
+        stored = self.store.get_many(k for row_keys in keys.values() for k in row_keys.values())
+        stale = {i: [m for m in self.metrics if keys[i][m] not in stored] for i in rows}
+        for m in self.metrics:
+            recomputed = sum(m in stale[i] for i in rows)
+            self.store.count("automated_evaluator/" + m, len(rows) - recomputed, recomputed)
+
+        # BERTScore F1 of the pairs of the rows whose redundancy is stale, encoded in chunks of rows
+        pair_keys = {i: self.pair_key(sub_claims[i]) for i in rows if "redundancy" in stale[i]}
+        pairs = self.store.get_many(pair_keys.values())
+        missing = [i for i, k in pair_keys.items() if k not in pairs]
+        self.store.count("automated_evaluator/bertscore_pairs", len(pair_keys) - len(missing), len(missing))
+        chunk_size = self.redundancy_chunk_size or 1
+        for start in range(0, len(missing), chunk_size):
+            chunk = missing[start:start + chunk_size]
+            self.redundancy.encode([c for i in chunk for c in sub_claims[i]])
+            new_pairs = [(pair_keys[i], self.redundancy.pair_scores(sub_claims[i])) for i in chunk]
+            self.redundancy.clear()
+            pairs.update(new_pairs)
+            self.store.put_many(new_pairs)
+
+        new_cells = []
+        for i in rows:
+            for m in stale[i]:
+                cell = self.score_metric(m, claims[i], sub_claims[i], entities[i], pairs.get(pair_keys.get(i)))
+                stored[keys[i][m]] = cell
+                new_cells.append((keys[i][m], cell))
+        self.store.put_many(new_cells)
+
+        results = []
+        for i, e in enumerate(entities):
+            if e is None: # failed row
+                results.append((None, None, None))
+                continue
+            scores = {k: v for m in self.metrics for k, v in stored[keys[i][m]].items()}
+            results.append((scores,) + self.row_entities(claims[i], sub_claims[i], e))
+        return results
+
+    def process(self, data):
+        '''
+        Add the automated scores and the entities of every row to a dataframe
+        '''
+        from tqdm import tqdm
         claim_entities = []
         sub_claim_entities = []
         automated_scores = []
-        data = self.data
 
-        for _, row in tqdm(data.iterrows(), total=len(data)):
-            claim = row['claim']
-            sub_claims = ast.literal_eval(row['sub_claims'])
+        claims = data['claim'].tolist()
+        sub_claims = [as_list(s) for s in data['sub_claims']]
+        index = data.index.tolist()
+        if self.dedup is not None:
+            table = UniqueTable(list(zip(claims, sub_claims)))
+            self.dedup.add("rows", len(claims), len(table))
+            claims, sub_claims, index = [c for c, _ in table.items], [s for _, s in table.items], table.column(index)
+        if self.store is not None:
+            unstored = self.load_entities(claims + [c for s in sub_claims for c in s or []])
+        entities = asyncio.run(self.get_all_entities(claims, sub_claims, index))
 
-            automated_score, claim_entity, sub_claim_entity = self.evaluate(
-                claim=claim, sub_claims=sub_claims
-            )
-            automated_scores.append(automated_score)
-            claim_entities.append(claim_entity)
-            sub_claim_entities.append(sub_claim_entity)
-        
+        rows = list(zip(claims, sub_claims, entities))
+        chunk_size = self.redundancy_chunk_size or 256
+        if self.workers:
+            # enough chunks to keep every process busy
+            chunk_size = max(1, min(chunk_size, -(-len(rows)//(4*self.workers))))
+        chunks = [rows[i:i + chunk_size] for i in range(0, len(rows), chunk_size)]
+        if self.store is not None:
+            extracted = {c: e for row in entities if row is not None for c, e in row.items()}
+            self.store.put_many((k, extracted[c]) for c, k in unstored.items() if c in extracted)
+            # incremental scoring runs in this process, it is mostly lookups
+            chunks = [rows]
+            scored = [self.score_incremental(claims, sub_claims, entities)]
+        elif self.workers:
+            settings = {name: getattr(self, name) for name in WORKER_SETTINGS}
+            if self._pool is not None and settings != self._pool_settings:
+                self.close() # e.g. a threshold changed since the processes started
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(self.workers, initializer=_init_worker, initargs=(settings,))
+                self._pool_settings = settings
+            # map returns the chunks in submission order
+            scored = self._pool.map(_score_rows, chunks)
+        else:
+            scored = map(self.score_rows, chunks)
+
+        for results in tqdm(scored, total=len(chunks)):
+            for automated_score, claim_entity, sub_claim_entity in results:
+                automated_scores.append(automated_score)
+                claim_entities.append(claim_entity)
+                sub_claim_entities.append(sub_claim_entity)
+
+        if self.dedup is not None:
+            automated_scores = table.broadcast(automated_scores)
+            claim_entities = table.broadcast(claim_entities)
+            sub_claim_entities = table.broadcast(sub_claim_entities)
         data['automated_scores'] = automated_scores
         data['claim_entities'] = claim_entities
         data['sub_claim_entities'] = sub_claim_entities
-        data.to_csv(self.output_file, index=False)
+        return data
+        
+    def score_rows(self, rows):
+        '''
+        Score (claim, sub_claims, entities) rows, no model calls
+        '''
+        if self.redundancy_chunk_size:
+            # encode the sub-claims of all the rows in large batches
+            self.redundancy.encode([c for _, sub_claims, entities in rows if entities is not None for c in sub_claims])
+        results = [
+            self.score(claim, sub_claims, entities) if entities is not None else (None, None, None) # failed row
+            for claim, sub_claims, entities in rows
+        ]
+        self.redundancy.clear()
+        return results
+
+    def close(self):
+        '''
+        Shut down the scoring processes
+        '''
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+        
+    def evaluate_sub_claims(self):
+        data = self.process(self.data)
+        write_dataset(data, self.output_file)
+        self.close()
 
     def entity_match(self, x, y):
         '''
         Perform fuzzy matching to check if two entities are similar
         '''
+        import jaro
         a = x.lower().strip()
         b = y.lower().strip()
         return jaro.jaro_winkler_metric(a, b)
     
+    def entity_index(self, entities):
+        '''
+        Index of normalized entities, the index of the last claim is reused by all its sub-claims
+        '''
+        from src.entity_index import EntityIndex
+        key = tuple(entities)
+        if key not in self._entity_indexes:
+            if len(self._entity_indexes) >= 2:
+                self._entity_indexes.clear()
+            self._entity_indexes[key] = EntityIndex(entities, self.pair_scores)
+        return self._entity_indexes[key]
+    
     def calculate_atomicity(self, s_i, o_i):
         '''
         Calculate atomicity based on number of subjects and objects in the claim. 
@@ -104,23 +431,13 @@ class AutomatedEvaluator():
         i.e. s_i and o_i but not in the list of subjects & objects in the original claim S and O
         '''
         num_fabrications = 0
-        E = S+O
+        index = self.entity_index(S+O)
         for s in s_i:
-            s_exists = False
-            for e in E:
-                if self.entity_match(s, e) > 0.75: #threshold
-                    s_exists = True
-                    break
-            if s_exists == False:
+            if not index.contains(s, self.fabrication_threshold):
                 num_fabrications += 1
         
         for o in o_i:
-            o_exists = False
-            for e in E:
-                if self.entity_match(o, e) > 0.75: #threshold
-                    o_exists = True
-                    break
-            if o_exists == False:
+            if not index.contains(o, self.fabrication_threshold):
                 num_fabrications += 1
         
         if num_fabrications <= 0.25*(len(S) + len(O)):
@@ -142,16 +459,10 @@ class AutomatedEvaluator():
             o_i = entities[sub_claim]["objects"]
             e.extend(o_i)
 
-        e = list(set(e))
-        E = S+O
+        index = self.entity_index(e)
         non_coverage = 0
-        for e_i in E:
-            is_covered = False
-            for e_j in e:
-                if self.entity_match(e_i, e_j) > 0.6: # threshold
-                    is_covered = True
-                    break
-            if is_covered == False:
+        for e_i in S+O:
+            if not index.contains(e_i, self.coverage_threshold):
                 non_coverage += 1
         
         if non_coverage <= 0.25*(len(S) + len(O)):
@@ -161,17 +472,17 @@ class AutomatedEvaluator():
         else:
             return "low"
         
-    def calculate_redundancy(self, S, O, sub_claims, entities):
+    def calculate_redundancy(self, S, O, sub_claims, entities, F1_scores=None):
         '''
         Check if there exists a pairing of sub-claims s_i, s_j which have a high BERT Score. 
-        If so, it is likely the sub-claims are redundant.
+        If so, it is likely the sub-claims are redundant. F1_scores are the stored pair scores, if any.
         '''
-        pairings = list(itertools.combinations(sub_claims, 2))
-        F1_scores = [self.scorer.score([a], [b])[2].item() for a, b in pairings]
+        if F1_scores is None:
+            F1_scores = self.redundancy.pair_scores(sub_claims)
 
         num_redundant = 0
         for f1 in F1_scores:
-            if f1 > 0.85:
+            if f1 > self.redundancy_threshold:
                 num_redundant += 1
         
         if num_redundant <= 0.25*len(sub_claims):
@@ -204,44 +515,63 @@ class AutomatedEvaluator():
         return score/len(metric)
 
     def evaluate(self, claim, sub_claims):
-        entities = self.get_entities(claim, sub_claims)
-        claim_entity = {}
-        sub_claim_entity = []
+        entities = asyncio.run(self.get_entities(claim, sub_claims))
+        return self.score(claim, sub_claims, entities)
 
+    def score_metric(self, m, claim, sub_claims, entities, F1_scores=None):
+        '''
+        Score of one metric for the sub-claims of a claim (and the fine-grained labels of the sub-claim level metrics)
+        '''
         S = entities[claim]["subjects"]
         O = entities[claim]["objects"]
-        claim_entity["subjects"] = S
-        claim_entity["objects"] = O
+        if m == "atomicity":
+            atomicity_fine_grained = [
+                self.calculate_atomicity(entities[c]["subjects"], entities[c]["objects"]) for c in sub_claims
+            ]
+            return {"atomicity": self.compound_atomicity(atomicity_fine_grained), "atomicity_fine_grained": atomicity_fine_grained}
+        if m == "fabrication":
+            inflation_fine_grained = [
+                self.calculate_fabrication(S, O, entities[c]["subjects"], entities[c]["objects"]) for c in sub_claims
+            ]
+            return {"fabrication": self.compound_metric(inflation_fine_grained), "fabrication_fine_grained": inflation_fine_grained}
+        if m == "coverage":
+            return {"coverage": self.calculate_coverage(S, O, sub_claims, entities)}
+        return {"redundancy": self.calculate_redundancy(S, O, sub_claims, entities, F1_scores)}
 
-        atomicity_fine_grained = []
-        inflation_fine_grained = []
+    def row_entities(self, claim, sub_claims, entities):
+        '''
+        Entities of the claim and of each sub-claim
+        '''
+        claim_entity = {"subjects": entities[claim]["subjects"], "objects": entities[claim]["objects"]}
+        sub_claim_entity = [{"subjects": entities[c]["subjects"], "objects": entities[c]["objects"]} for c in sub_claims]
+        return claim_entity, sub_claim_entity
 
-        for sub_claim in sub_claims:
-            s_i = entities[sub_claim]["subjects"]
-            o_i = entities[sub_claim]["objects"]
-            sub_claim_entity.append({
-                "subjects": s_i,
-                "objects": o_i 
-            })
-            atomicity_fine_grained.append(self.calculate_atomicity(s_i, o_i))
-            inflation_fine_grained.append(self.calculate_fabrication(S, O, s_i, o_i))
-            
-        coverage = self.calculate_coverage(S, O, sub_claims, entities)
-        redundancy = self.calculate_redundancy(S, O, sub_claims, entities)
-
-        return {
-            "atomicity": self.compound_atomicity(atomicity_fine_grained),
-            "atomicity_fine_grained": atomicity_fine_grained,
-            "fabrication": self.compound_metric(inflation_fine_grained),
-            "fabrication_fine_grained": inflation_fine_grained,
-            "coverage": coverage,
-            "redundancy": redundancy
-        }, claim_entity, sub_claim_entity
+    def score(self, claim, sub_claims, entities):
+        '''
+        Score the sub-claims of a claim from the extracted entities, no model calls
+        '''
+        scores = {}
+        for m in self.metrics:
+            scores.update(self.score_metric(m, claim, sub_claims, entities))
+        return (scores,) + self.row_entities(claim, sub_claims, entities)
 
 def main():
+    parser = argparse.ArgumentParser(description="Score sub-claims with the automated metrics")
+    parser.add_argument("--input", default='data/sub_claims.csv')
+    parser.add_argument("--output", default='data/automated_evaluation.csv')
+    parser.add_argument("--streaming", action="store_true",
+                        help="process the input in chunks, checkpoint the finished rows to the output as JSONL and resume an interrupted run")
+    parser.add_argument("--chunksize", type=int, default=100, help="rows per chunk with --streaming")
+    args = parser.parse_args()
     sub_claim_evaluator = AutomatedEvaluator()
-    sub_claim_evaluator.set_data('data/sub_claims.csv') # set data
-    sub_claim_evaluator.set_output_file('data/automated_evaluation.csv') # set output file
+    if args.streaming:
+        try:
+            run_streaming(sub_claim_evaluator.process, args.input, streaming_output(args.output), args.chunksize, "automated_scores")
+        finally:
+            sub_claim_evaluator.close()
+        return
+    sub_claim_evaluator.set_data(args.input) # set data
+    sub_claim_evaluator.set_output_file(args.output) # set output file
     sub_claim_evaluator.evaluate_sub_claims()
 
 if __name__ == '__main__':
@@ -0,0 +1,299 @@
+import asyncio
+import hashlib
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from src.config import (BACKEND, LOCAL_BATCH_SIZE, LOCAL_MAX_NEW_TOKENS,
+                        LOCAL_MODEL_NAME, MOCK_FAILURE_RATE, MOCK_JITTER,
+                        MOCK_LATENCY, MOCK_PREFIX_CACHE_MIN_TOKENS)
+from src.fake_server import fake_completion
+from src.registry import get_shared
+
+
+class TransientError(Exception):
+    '''
+    A failed request which may succeed if it is sent again
+    '''
+
+
+class Response(dict):
+    '''
+    Chat-completions response with attribute access, like the objects returned by the openai SDK
+    '''
+    def __getattr__(self, key):
+        try:
+            return self[key]
+        except KeyError:
+            raise AttributeError(key)
+
+
+def to_response(value):
+    if isinstance(value, dict):
+        return Response({k: to_response(v) for k, v in value.items()})
+    if isinstance(value, list):
+        return [to_response(v) for v in value]
+    return value
+
+
+class Backend:
+    '''
+    Model behind OpenAI/AsyncOpenAI. create() and acreate() take an OpenAI chat-completions model config
+    and return a response shaped like the OpenAI one (choices[0]["message"]["content"], usage).
+    create() raises a timeout error if the response takes longer than timeout seconds (None to wait forever),
+    AsyncOpenAI bounds acreate() itself.
+    '''
+    name = "backend"
+    cacheable = True # responses are worth caching
+    rate_limited = False # subject to the requests/tokens per minute limits
+
+    def create(self, model_config, timeout=None):
+        raise NotImplementedError
+
+    async def acreate(self, model_config):
+        return await asyncio.get_running_loop().run_in_executor(None, self.create, model_config)
+
+    def cache_config(self, model_config):
+        '''
+        What identifies a response in the cache
+        '''
+        return dict(model_config, backend=self.name)
+
+
+class OpenAIBackend(Backend):
+    name = "openai"
+    rate_limited = True
+
+    def __init__(self, openai_api_key, openai_organization=""):
+        import openai
+        self.openai = openai
+        openai.api_key = openai_api_key
+        if openai_organization:
+            openai.organization = openai_organization
+
+    def create(self, model_config, timeout=None):
+        return self.openai.ChatCompletion.create(request_timeout=timeout, **model_config)
+
+    async def acreate(self, model_config):
+        return await self.openai.ChatCompletion.acreate(**model_config)
+
+    def cache_config(self, model_config):
+        return model_config
+
+
+class StubBackend(Backend):
+    '''
+    Deterministic answers in the format each FactLens stage expects, for offline runs and CI
+    '''
+    name = "stub"
+    cacheable = False
+
+    def create(self, model_config, timeout=None):
+        return to_response(fake_completion(model_config))
+
+    async def acreate(self, model_config):
+        return self.create(model_config)
+
+
+class PrefixCache:
+    '''
+    Simulated provider prompt cache: once a prompt was sent, its prefixes of at least min_tokens, in steps of
+    block_tokens, are cached for later prompts of the same model (like OpenAI's automatic prompt caching).
+    Tokens are estimated as 4 characters.
+    '''
+    def __init__(self, min_tokens=MOCK_PREFIX_CACHE_MIN_TOKENS, block_tokens=128, max_prefixes=1000000):
+        self.min_chars = 4*min_tokens
+        self.block_chars = 4*block_tokens
+        self.max_prefixes = max_prefixes
+        self.prefixes = set()
+
+    def cached_tokens(self, model_config):
+        '''
+        Tokens of the longest cached prefix of a prompt, the prefixes of the prompt are cached afterwards
+        '''
+        text = "".join("{}: {}\n".format(m["role"], m["content"]) for m in model_config["messages"])
+        digest = hashlib.sha1(str(model_config.get("model")).encode("utf-8"))
+        if len(self.prefixes) >= self.max_prefixes:
+            self.prefixes.clear()
+        cached = 0
+        start = 0
+        for end in range(self.min_chars, len(text) + 1, self.block_chars):
+            digest.update(text[start:end].encode("utf-8"))
+            start = end
+            key = digest.digest()
+            if key in self.prefixes:
+                cached = end
+            else:
+                self.prefixes.add(key)
+        return cached//4
+
+
+class MockBackend(StubBackend):
+    '''
+    Stub answers after a latency of latency + uniform(0, jitter) seconds, a request fails with TransientError
+    with probability failure_rate. Prompt prefixes of at least prefix_cache_min_tokens which were sent before
+    are reported as cached tokens (None to disable). For load tests of the stages without a model.
+    '''
+    name = "mock"
+
+    def __init__(self, latency=MOCK_LATENCY, jitter=MOCK_JITTER, failure_rate=MOCK_FAILURE_RATE, seed=0,
+                 prefix_cache_min_tokens=MOCK_PREFIX_CACHE_MIN_TOKENS):
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.prefix_cache = PrefixCache(prefix_cache_min_tokens) if prefix_cache_min_tokens is not None else None
+
+    def delay(self):
+        return self.latency + self.random.uniform(0, self.jitter)
+
+    def respond(self, model_config):
+        if self.random.random() < self.failure_rate:
+            raise TransientError("mock failure")
+        response = StubBackend.create(self, model_config)
+        if self.prefix_cache is not None:
+            usage = response["usage"]
+            usage["prompt_tokens_details"] = {
+                "cached_tokens": min(usage["prompt_tokens"], self.prefix_cache.cached_tokens(model_config))
+            }
+        return response
+
+    def create(self, model_config, timeout=None):
+        delay = self.delay()
+        if timeout is not None and delay > timeout:
+            time.sleep(timeout)
+            raise TimeoutError("mock response took longer than {} seconds".format(timeout))
+        time.sleep(delay)
+        return self.respond(model_config)
+
+    async def acreate(self, model_config):
+        await asyncio.sleep(self.delay())
+        return self.respond(model_config)
+
+
+class LocalBackend(Backend):
+    '''
+    Local CPU chat model (transformers), greedy decoding. Concurrent acreate() calls are grouped into batches
+    of up to batch_size prompts which are generated together.
+    '''
+    name = "local"
+
+    def __init__(self, model_name=LOCAL_MODEL_NAME, batch_size=LOCAL_BATCH_SIZE, max_new_tokens=LOCAL_MAX_NEW_TOKENS, batch_wait=0.01):
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.max_new_tokens = max_new_tokens
+        self.batch_wait = batch_wait # seconds to wait for a batch to fill up
+        self.tokenizer = None
+        self.model = None
+        self._executor = ThreadPoolExecutor(1) # one generation at a time
+        self._queue = []
+        self._flush = None
+
+    def load(self):
+        if self.model is None:
+            self.tokenizer, self.model = get_shared(("causal_lm", self.model_name), self._load)
+
+    def _load(self):
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+        tokenizer = AutoTokenizer.from_pretrained(self.model_name, padding_side="left")
+        if tokenizer.pad_token is None:
+            tokenizer.pad_token = tokenizer.eos_token
+        return tokenizer, AutoModelForCausalLM.from_pretrained(self.model_name).eval()
+
+    def generate(self, model_configs):
+        '''
+        Generate the answers of a batch of requests
+        '''
+        import torch
+        self.load()
+        prompts = [
+            self.tokenizer.apply_chat_template(c["messages"], tokenize=False, add_generation_prompt=True)
+            for c in model_configs
+        ]
+        inputs = self.tokenizer(prompts, return_tensors="pt", padding=True, add_special_tokens=False)
+        max_new_tokens = max(c.get("max_tokens", self.max_new_tokens) for c in model_configs)
+        with torch.no_grad():
+            outputs = self.model.generate(
+                **inputs, max_new_tokens=max_new_tokens, do_sample=False, pad_token_id=self.tokenizer.pad_token_id
+            )
+
+        responses = []
+        prompt_length = inputs["input_ids"].shape[1]
+        for i, c in enumerate(model_configs):
+            generated = outputs[i, prompt_length:]
+            generated = generated[generated != self.tokenizer.pad_token_id]
+            content = self.tokenizer.decode(generated, skip_special_tokens=True).strip()
+            prompt_tokens = int(inputs["attention_mask"][i].sum())
+            responses.append(to_response({
+                "model": self.model_name,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                "usage": {
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": len(generated),
+                    "total_tokens": prompt_tokens + len(generated),
+                },
+            }))
+        return responses
+
+    def create(self, model_config, timeout=None):
+        return self._executor.submit(self.generate, [model_config]).result(timeout)[0]
+
+    async def acreate(self, model_config):
+        future = asyncio.get_running_loop().create_future()
+        self._queue.append((model_config, future))
+        if len(self._queue) >= self.batch_size:
+            self._run_batch()
+        elif self._flush is None:
+            self._flush = asyncio.get_running_loop().call_later(self.batch_wait, self._run_batch)
+        return await future
+
+    def _run_batch(self):
+        if self._flush is not None:
+            self._flush.cancel()
+            self._flush = None
+        batch, self._queue = self._queue, []
+        if not batch:
+            return
+
+        def done(task):
+            try:
+                results = task.result()
+            except BaseException as e:
+                results = [e]*len(batch)
+            for (_, future), result in zip(batch, results):
+                if future.done():
+                    continue
+                if isinstance(result, BaseException):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+        loop = asyncio.get_running_loop()
+        task = asyncio.ensure_future(loop.run_in_executor(self._executor, self.generate, [c for c, _ in batch]))
+        task.add_done_callback(done)
+
+    def cache_config(self, model_config):
+        return dict(model_config, backend=self.name, local_model=self.model_name)
+
+
+_backends = {}
+_override = None
+
+def get_backend(openai_api_key="", openai_organization=""):
+    '''
+    Backend configured in config.py (or set with set_backend), local models are loaded once per process
+    '''
+    if _override is not None:
+        return _override
+    if BACKEND == "openai":
+        return OpenAIBackend(openai_api_key, openai_organization)
+    if BACKEND not in _backends:
+        _backends[BACKEND] = {"local": LocalBackend, "stub": StubBackend, "mock": MockBackend}[BACKEND]()
+    return _backends[BACKEND]
+
+
+def set_backend(backend):
+    '''
+    Use this backend instance for every client created afterwards in this process, None restores config.py
+    '''
+    global _override
+    _override = backend
@@ -0,0 +1,122 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from src.config import CACHE_MAX_BYTES, CACHE_PATH, CACHE_READONLY
+
+
+class CacheMiss(KeyError):
+    '''
+    Raised by a read-only cache for a request that was never recorded
+    '''
+
+
+def cache_key(model_config):
+    '''
+    Content hash of a normalized model config
+    '''
+    normalized = json.dumps(model_config, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    '''
+    Disk-backed (SQLite) cache of model responses keyed by the hash of the model config,
+    evicting least recently used entries once the stored responses exceed max_bytes.
+    A read-only cache replays recorded responses and never writes, a miss raises CacheMiss.
+    '''
+    def __init__(self, path, max_bytes=CACHE_MAX_BYTES, readonly=False):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.readonly = readonly
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        if readonly:
+            self.db = sqlite3.connect("file:{}?mode=ro".format(path), uri=True, check_same_thread=False)
+        else:
+            if os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value TEXT, size INTEGER, accessed REAL)"
+            )
+            self.db.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+            self.db.commit()
+        self.size = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    @staticmethod
+    def cacheable(model_config):
+        # only deterministic requests are fully determined by their config
+        return model_config.get("temperature", 1) == 0
+
+    def get(self, model_config):
+        '''
+        Recorded response (as a dict) for the model config, or None
+        '''
+        key = cache_key(model_config)
+        with self._lock:
+            row = self.db.execute("SELECT value FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                if self.readonly:
+                    raise CacheMiss(key)
+                return None
+            self.hits += 1
+            if not self.readonly:
+                self.db.execute("UPDATE responses SET accessed = ? WHERE key = ?", (time.time(), key))
+                self.db.commit()
+        return json.loads(row[0])
+
+    def put(self, model_config, response):
+        if self.readonly:
+            return
+        key = cache_key(model_config)
+        value = json.dumps(response)
+        with self._lock:
+            old = self.db.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self.db.execute(
+                "INSERT OR REPLACE INTO responses (key, value, size, accessed) VALUES (?, ?, ?, ?)",
+                (key, value, len(value), time.time())
+            )
+            self.size += len(value) - (old[0] if old else 0)
+            self._evict()
+            self.db.commit()
+
+    def _evict(self):
+        while self.max_bytes and self.size > self.max_bytes:
+            rows = self.db.execute("SELECT key, size FROM responses ORDER BY accessed LIMIT 100").fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                if self.size <= self.max_bytes:
+                    break
+                self.db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.size -= size
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits/total if total else 0,
+            "entries": self.db.execute("SELECT COUNT(*) FROM responses").fetchone()[0],
+            "bytes": self.size,
+        }
+
+
+_cache = None
+
+def get_cache():
+    '''
+    Process-wide cache configured in config.py, None if caching is disabled
+    '''
+    global _cache
+    if _cache is None and CACHE_PATH:
+        _cache = ResponseCache(CACHE_PATH, CACHE_MAX_BYTES, CACHE_READONLY)
+    return _cache
@@ -0,0 +1,145 @@
+import argparse
+import json
+import re
+
+import numpy as np
+
+from src.config import ATOMIC_ROUTING_THRESHOLD, ATOMIC_ROUTING_TRAINING_DATA
+
+CONNECTIVES = r"\b(and|but|while|whereas|although|though|because|which|who|whom|whose|where|when|also|both|either|neither|nor|or|after|before|since|with|as well as|respectively|than)\b"
+RELATIVE_PRONOUNS = r"\b(which|who|whose|where|that)\b"
+
+
+def features(claims):
+    '''
+    Counts hinting at several facts in a claim: words, commas, semicolons, connectives, "and", relative pronouns,
+    capitalized words after the first (entities), numbers and parentheses
+    '''
+    rows = []
+    for claim in claims:
+        words = claim.split()
+        rows.append([
+            len(words),
+            claim.count(","),
+            claim.count(";"),
+            len(re.findall(CONNECTIVES, claim, re.IGNORECASE)),
+            len(re.findall(r"\band\b", claim, re.IGNORECASE)),
+            len(re.findall(RELATIVE_PRONOUNS, claim, re.IGNORECASE)),
+            sum(w[:1].isupper() for w in words[1:]),
+            len(re.findall(r"\d+(?:\.\d+)?", claim)),
+            claim.count("("),
+        ])
+    return np.array(rows, dtype=float).reshape(len(rows), 9)
+
+
+def is_atomic_decomposition(sub_claims):
+    '''
+    Whether a decomposition left the claim whole (a single sub-claim)
+    '''
+    return isinstance(sub_claims, list) and len(sub_claims) == 1
+
+
+def build_model():
+    '''
+    Logistic regression on the feature counts and on word uni- and bigrams
+    '''
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    from sklearn.linear_model import LogisticRegression
+    from sklearn.pipeline import make_pipeline, make_union
+    from sklearn.preprocessing import FunctionTransformer, StandardScaler
+    return make_pipeline(
+        make_union(
+            make_pipeline(FunctionTransformer(features), StandardScaler()),
+            TfidfVectorizer(ngram_range=(1, 2), min_df=2),
+        ),
+        LogisticRegression(max_iter=1000),
+    )
+
+
+class AtomicClaimRouter:
+    '''
+    Local classifier of claims which are already atomic, so that the sub-claim generator passes them through as
+    their own single sub-claim instead of decomposing them with the model. Trained on the decompositions of the
+    FactLens benchmark (a claim is atomic if it was left whole), a claim is routed through when its probability of
+    being atomic is at least threshold: the higher the threshold, the fewer claims skip the model, and the fewer
+    of them would have been decomposed.
+    '''
+    def __init__(self, threshold=ATOMIC_ROUTING_THRESHOLD, training_data=ATOMIC_ROUTING_TRAINING_DATA):
+        self.threshold = threshold
+        self.training_data = training_data
+        self.model = None
+
+    def fit(self, claims, sub_claims):
+        '''
+        Train on claims and their reference decompositions, rows without a decomposition are left out
+        '''
+        rows = [(c, s) for c, s in zip(claims, sub_claims) if isinstance(s, list)]
+        self.model = build_model().fit([c for c, _ in rows], [is_atomic_decomposition(s) for _, s in rows])
+        return self
+
+    def load(self):
+        if self.model is None:
+            from src.dataset_io import read_dataset
+            data = read_dataset(self.training_data, columns=["claim", "sub_claims"])
+            self.fit(data["claim"].tolist(), data["sub_claims"].tolist())
+        return self
+
+    def probabilities(self, claims):
+        '''
+        Probability of every claim being atomic
+        '''
+        if not claims:
+            return np.zeros(0)
+        return self.load().model.predict_proba(list(claims))[:, 1]
+
+    def is_atomic(self, claims):
+        return [bool(p >= self.threshold) for p in self.probabilities(claims)]
+
+    def evaluate(self, claims, sub_claims, folds=5, thresholds=None):
+        '''
+        Cross-validated routing against reference decompositions, per threshold: the fraction of claims skipping
+        the model, the agreement (fraction of the skipped claims the reference left whole too) and the recall
+        (fraction of the atomic claims which are skipped)
+        '''
+        from sklearn.model_selection import StratifiedKFold, cross_val_predict
+        rows = [(c, s) for c, s in zip(claims, sub_claims) if isinstance(s, list)]
+        atomic = np.array([is_atomic_decomposition(s) for _, s in rows])
+        probabilities = cross_val_predict(
+            build_model(), [c for c, _ in rows], atomic, cv=StratifiedKFold(folds, shuffle=True, random_state=0),
+            method="predict_proba",
+        )[:, 1]
+        report = {}
+        for threshold in thresholds or [self.threshold]:
+            skipped = probabilities >= threshold
+            report[threshold] = {
+                "claims": len(rows),
+                "skipped_fraction": float(skipped.mean()),
+                "agreement": float(atomic[skipped].mean()) if skipped.any() else 1.0,
+                "recall": float(skipped[atomic].mean()) if atomic.any() else 0.0,
+            }
+        return report
+
+
+_router = None
+
+def get_atomic_router():
+    '''
+    Process-wide router configured in config.py, trained on first use
+    '''
+    global _router
+    if _router is None:
+        _router = AtomicClaimRouter()
+    return _router
+
+
+def main():
+    from src.dataset_io import read_dataset
+    parser = argparse.ArgumentParser(description="Cross-validated routing of atomic claims against reference decompositions")
+    parser.add_argument("--data", default=ATOMIC_ROUTING_TRAINING_DATA, help="claims with their reference sub_claims")
+    parser.add_argument("--thresholds", type=float, nargs="+", default=[0.5, 0.7, ATOMIC_ROUTING_THRESHOLD, 0.9])
+    args = parser.parse_args()
+    data = read_dataset(args.data, columns=["claim", "sub_claims"])
+    print(json.dumps(AtomicClaimRouter().evaluate(data["claim"].tolist(), data["sub_claims"].tolist(), thresholds=args.thresholds), indent=2))
+
+if __name__ == '__main__':
+    main()
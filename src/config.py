@@ -1,2 +1,73 @@
 # Enter model name
 MODEL_NAME = '' # eg. gpt-4o-mini, gpt-4o
+
+# Model backend: 'openai', 'local' (transformers model on CPU), 'stub' (deterministic answers, no model)
+# or 'mock' (stub answers with an artificial latency and failure rate)
+BACKEND = 'openai'
+LOCAL_MODEL_NAME = 'Qwen/Qwen2.5-0.5B-Instruct' # any chat model from the Hugging Face hub
+LOCAL_BATCH_SIZE = 8 # concurrent requests generated together
+LOCAL_MAX_NEW_TOKENS = 256
+MOCK_LATENCY = 0.5 # seconds
+MOCK_JITTER = 0.0 # seconds of uniform random latency added to MOCK_LATENCY
+MOCK_FAILURE_RATE = 0.0 # fraction of requests failing with TransientError
+MOCK_PREFIX_CACHE_MIN_TOKENS = 1024 # the mock backend reports prompt prefixes of at least this many tokens as cached, like OpenAI
+
+# Concurrency and rate limits for the async client
+MAX_IN_FLIGHT = 8 # maximum number of concurrent requests
+REQUESTS_PER_MINUTE = 500 # None to disable
+TOKENS_PER_MINUTE = 200000 # None to disable
+
+# Retries of failed requests (rate limits, timeouts, server errors) with jittered exponential backoff
+MAX_RETRIES = 6
+RETRY_BASE_DELAY = 0.5 # seconds, doubled at every retry
+RETRY_MAX_DELAY = 60.0 # seconds
+REQUEST_TIMEOUT = 120 # seconds per request, None to wait forever
+MAX_REASKS = 2 # times an answer which can't be parsed is asked again
+CIRCUIT_FAILURE_THRESHOLD = 20 # consecutive failures pausing all requests, 0 to disable
+CIRCUIT_RESET_SECONDS = 30 # pause before requests are tried again
+DEAD_LETTER_PATH = 'data/dead_letter.jsonl' # rows which failed, '' to stop the run at the first failed row instead
+
+# Prefix-stable prompts (stable_prefix=True): the generator draws the demonstrations of every row from this many
+# seeded orders, so that rows share prompt prefixes
+DEMONSTRATION_PERMUTATIONS = 4
+DEMONSTRATION_SEED = 0
+
+# Sharded runs (src/sharding.py): queue of the shards, 'sqlite:PATH', 'file:DIRECTORY', 'redis://HOST:PORT/DB'
+# (needs the redis package) or 'local-redis' (in-process stand-in for Redis, workers run in the coordinator)
+SHARD_QUEUE = 'sqlite:data/shards/queue.sqlite'
+SHARD_SIZE = 1000 # rows per shard
+SHARD_MAX_ATTEMPTS = 3 # a shard failing this many times fails the run
+SHARD_LEASE_SECONDS = 3600 # a shard whose worker didn't renew its lease in time (it renews every third) is handed to another worker
+
+# Routing of atomic claims (route_atomic=True): claims a local classifier, trained on the benchmark decompositions,
+# finds atomic with at least this probability are passed through as their own sub-claim without a model call
+ATOMIC_ROUTING_THRESHOLD = 0.8
+ATOMIC_ROUTING_TRAINING_DATA = 'benchmark/fact_lens_benchmark.csv'
+
+# Evidence retrieval for the verifier (retrieval_k > 0): contexts are chunked and BM25-indexed once, on disk
+RETRIEVAL_INDEX_PATH = 'data/retrieval'
+RETRIEVAL_TOP_K = 4 # chunks passed to the verifier per sub-claim
+RETRIEVAL_CHUNK_WORDS = 100 # longest chunk, chunks follow the lines (table rows, paragraphs) of a context
+RETRIEVAL_CHUNK_OVERLAP = 20 # words shared by consecutive windows of a line longer than a chunk
+RETRIEVAL_MAX_SEGMENTS = 16 # segments of the index, the smallest are merged when an add goes past it
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# Agreement analysis against the human annotations (src/analysis.py)
+BOOTSTRAP_RESAMPLES = 1000 # resamples of the confidence intervals
+BOOTSTRAP_CONFIDENCE = 0.95
+BOOTSTRAP_SEED = 0
+
+# Results of the incremental evaluators, one cell per row x metric keyed by everything the result depends on
+CELL_STORE_PATH = 'data/cells.sqlite'
+
+# USD per million (prompt, completion, cached prompt) tokens, used for cost accounting of the model calls
+MODEL_PRICES = {
+    'gpt-4o-mini': (0.15, 0.60, 0.075),
+    'gpt-4o': (2.50, 10.00, 1.25),
+}
+
+# Persistent response cache, set CACHE_PATH = '' to disable
+CACHE_PATH = 'data/llm_cache.sqlite'
+CACHE_MAX_BYTES = 1024**3 # least recently used responses are evicted above this size
+CACHE_READONLY = False # replay recorded responses only, a request that was never recorded fails
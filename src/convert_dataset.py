@@ -0,0 +1,47 @@
+import argparse
+import os
+import time
+
+from src.dataset_io import parse_literals, read_dataset, write_dataset
+
+DATASETS = ["benchmark/fact_lens_benchmark.csv", "synthetic/fact_lens_synthetic_sub_claims.csv"]
+
+
+def convert(path, output_path=None):
+    '''
+    Convert a CSV dataset with stringified lists and dicts to Parquet with native list and struct columns
+    '''
+    import pandas as pd
+    output_path = output_path or os.path.splitext(path)[0] + ".parquet"
+    errors = []
+    data = parse_literals(pd.read_csv(path), errors)
+    write_dataset(data, output_path)
+
+    read_dataset(output_path) # warm up the imports
+    start = time.perf_counter()
+    read_dataset(path)
+    csv_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    read_dataset(output_path)
+    parquet_seconds = time.perf_counter() - start
+    return {
+        "input": path,
+        "output": output_path,
+        "rows": len(data),
+        "malformed_cells": ["{}[{}]".format(column, row) for column, row in errors],
+        "csv_bytes": os.path.getsize(path),
+        "parquet_bytes": os.path.getsize(output_path),
+        "csv_read_seconds": csv_seconds,
+        "parquet_read_seconds": parquet_seconds,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert FactLens CSV datasets to Parquet")
+    parser.add_argument("paths", nargs="*", default=DATASETS, help="CSV datasets, written next to the input as .parquet")
+    args = parser.parse_args()
+    for path in args.paths:
+        print(convert(path))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,234 @@
+import ast
+import json
+import os
+import re
+
+# list and dict columns of the datasets and of the stage outputs, stringified in a CSV
+LITERAL_COLUMNS = ["sub_claims", "labels", "predicted_labels", "llm_evaluation_scores", "automated_scores",
+                   "claim_entities", "sub_claim_entities"]
+
+
+def parse_literal(value):
+    '''
+    Python value of a stringified list or dict, None if the string is malformed
+    '''
+    try:
+        return ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        return None
+
+
+def as_list(value):
+    '''
+    List column value, either native (JSONL, Parquet) or stringified (CSV), None if the value is missing
+    (None or NaN, e.g. a row which failed in an earlier stage) or malformed, like parse_literals does
+    '''
+    if value is None or (isinstance(value, float) and value != value):
+        return None
+    if isinstance(value, str):
+        return parse_literal(value)
+    if hasattr(value, "tolist"):
+        return value.tolist()
+    return list(value)
+
+
+def require_list(value, name):
+    '''
+    The list value of a row, ValueError if it is missing, so that the row fails on its own (and is written to the
+    dead-letter file) instead of the whole stage
+    '''
+    if value is None:
+        raise ValueError("{} is missing: the row failed in an earlier stage or its value is malformed".format(name))
+    return value
+
+
+def is_literal_column(name):
+    '''
+    Whether a CSV column holds stringified Python lists or dicts: the known list and dict columns and the
+    human annotations (<metric>_human1, ...). Other text columns are left as they are, whatever they look like.
+    '''
+    return name in LITERAL_COLUMNS or re.fullmatch(r"[a-z]+_human\d+", str(name)) is not None
+
+
+def parse_literals(data, errors=None):
+    '''
+    Replace the stringified lists and dicts of a CSV dataframe by native values.
+    A malformed cell becomes None, which the stages write to the dead-letter file as a failed row (see
+    require_list), and its (column, row) is appended to errors if given.
+    '''
+    import pandas as pd
+    for column in data.columns:
+        if data[column].dtype.kind in "biufcmM" or not is_literal_column(column):
+            continue
+        parsed = []
+        for index, value in data[column].items():
+            parsed.append(parse_literal(value) if isinstance(value, str) else None) # NaN: a missing value
+            if parsed[-1] is None and isinstance(value, str) and errors is not None:
+                errors.append((column, index))
+        data[column] = pd.Series(parsed, index=data.index, dtype=object)
+    return data
+
+
+JSON_COLUMN = {b"factlens.json": b"1"} # Arrow field metadata of a column stored as JSON strings
+
+
+def from_arrow(table):
+    '''
+    Dataframe of an Arrow table, list and struct columns become Python lists and dicts like in the other formats
+    '''
+    import pandas as pd
+    import pyarrow as pa
+    nested = [field.name for field in table.schema if pa.types.is_nested(field.type) or field.metadata == JSON_COLUMN]
+    data = table.drop_columns(nested).to_pandas() if nested else table.to_pandas()
+    for name in nested:
+        values = table.column(name).to_pylist()
+        if table.schema.field(name).metadata == JSON_COLUMN:
+            values = [v if v is None else json.loads(v) for v in values]
+        data[name] = pd.Series(values, index=data.index, dtype=object)
+    return data[table.column_names]
+
+
+def to_arrow(data):
+    '''
+    Arrow table of a dataframe with native list and struct columns.
+    A column whose values have no common Arrow type (e.g. the benchmark labels, booleans in some rows and
+    strings in others) is stored as JSON strings, which from_arrow decodes.
+    '''
+    import pyarrow as pa
+    fields, columns = [], []
+    for name in data.columns:
+        try:
+            column = pa.Array.from_pandas(data[name])
+            fields.append(pa.field(name, column.type))
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            column = pa.array([v if v is None or v != v else json.dumps(v) for v in data[name]], pa.string())
+            fields.append(pa.field(name, pa.string(), metadata=JSON_COLUMN))
+        columns.append(column)
+    return pa.Table.from_arrays(columns, schema=pa.schema(fields))
+
+
+def read_dataset(path, columns=None):
+    '''
+    Read a CSV, JSONL or Parquet dataset, optionally only some of its columns.
+    List and dict columns are returned as native values whatever the format: Parquet files are memory-mapped
+    and only the requested columns are read, stringified lists of a CSV are parsed once here.
+    '''
+    import pandas as pd
+    if path.endswith(".parquet"):
+        import pyarrow.parquet as pq
+        return from_arrow(pq.read_table(path, columns=columns, memory_map=True))
+    if path.endswith(".jsonl"):
+        data = pd.read_json(path, lines=True)
+        return data[columns] if columns else data
+    return parse_literals(pd.read_csv(path, usecols=columns))
+
+
+def write_dataset(data, path):
+    '''
+    Write a dataframe as CSV, JSONL or Parquet depending on the extension of the path
+    '''
+    if path.endswith(".parquet"):
+        import pyarrow.parquet as pq
+        pq.write_table(to_arrow(data), path, compression="zstd")
+    elif path.endswith(".jsonl"):
+        data.to_json(path, orient="records", lines=True, force_ascii=False)
+    else:
+        data.to_csv(path, index=False)
+
+
+def read_parquet_chunks(path, chunksize=100, columns=None):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    start = 0
+    for batch in pq.ParquetFile(path, memory_map=True).iter_batches(batch_size=chunksize, columns=columns):
+        chunk = from_arrow(pa.Table.from_batches([batch]))
+        chunk.index = range(start, start + len(chunk))
+        start += len(chunk)
+        yield chunk
+
+
+def read_chunks(path, chunksize=100):
+    '''
+    Read a CSV, JSONL or Parquet dataset in chunks of rows, the index of each chunk continues from the previous one
+    '''
+    import pandas as pd
+    if path.endswith(".parquet"):
+        return read_parquet_chunks(path, chunksize)
+    if path.endswith(".jsonl"):
+        return pd.read_json(path, lines=True, chunksize=chunksize)
+    return pd.read_csv(path, chunksize=chunksize)
+
+
+class JSONLCheckpoint:
+    '''
+    Append-only JSONL sink of finished rows. Every record carries the index of its input row in "_row",
+    so that an interrupted run can skip the rows which are already done.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.done = set()
+        if os.path.exists(path):
+            self._recover()
+        self.file = open(path, "a", encoding="utf-8")
+
+    def _recover(self):
+        # drop a record which was only partially written when the previous run stopped
+        valid = 0
+        with open(self.path, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    self.done.add(json.loads(line)["_row"])
+                except (ValueError, KeyError):
+                    break
+                valid += len(line)
+        with open(self.path, "rb+") as f:
+            f.truncate(valid)
+
+    def write(self, data):
+        '''
+        Append the rows of a processed chunk and flush them to disk
+        '''
+        for index, record in zip(data.index, json.loads(data.to_json(orient="records"))):
+            record["_row"] = int(index)
+            self.file.write(json.dumps(record, ensure_ascii=False) + "\n")
+            self.done.add(int(index))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+
+def streaming_output(path):
+    '''
+    JSONL checkpoint path of a stage output path
+    '''
+    return os.path.splitext(path)[0] + ".jsonl"
+
+
+def run_streaming(process, input_path, output_path, chunksize=100, result_column=None):
+    '''
+    Stream the input through process (a DataFrame -> DataFrame stage function) chunk by chunk,
+    checkpointing every finished chunk. Rows already in the output are skipped, so a run can be resumed.
+    Rows whose result_column is None (failed rows, in the dead-letter file) are not written, so that resuming
+    the run retries them. Returns the number of such rows.
+    '''
+    sink = JSONLCheckpoint(output_path)
+    failed = 0
+    try:
+        for chunk in read_chunks(input_path, chunksize):
+            chunk = chunk[~chunk.index.isin(sink.done)]
+            if "_row" in chunk:
+                chunk = chunk.drop(columns="_row")
+            if len(chunk):
+                data = process(chunk)
+                if result_column is not None:
+                    done = data[result_column].notna()
+                    failed += int((~done).sum())
+                    data = data[done]
+                sink.write(data)
+    finally:
+        sink.close()
+    return failed
@@ -0,0 +1,115 @@
+import asyncio
+import re
+import unicodedata
+
+
+def normalize(text):
+    '''
+    Text in the form used to recognize duplicates: Unicode NFKC, whitespace runs collapsed to one space, stripped
+    '''
+    if not isinstance(text, str):
+        return text
+    return re.sub(r"\s+", " ", unicodedata.normalize("NFKC", text)).strip()
+
+
+def key(value):
+    '''
+    Hashable key of a text, or of a (nested) list or tuple of texts, after normalization
+    '''
+    if isinstance(value, (list, tuple)):
+        return tuple(key(v) for v in value)
+    return normalize(value)
+
+
+class UniqueTable:
+    '''
+    Unique items of a column of rows (duplicates after normalization are collapsed to their first occurrence)
+    and the position of every row's item among them, to run a stage once per unique item and broadcast its results
+    back to the rows
+    '''
+    def __init__(self, items):
+        index = {}
+        self.items = [] # first occurrence of every unique item, as it appears in the data
+        self.rows = [] # row of the first occurrence
+        self.inverse = [] # row -> position of its item in items
+        for row, item in enumerate(items):
+            k = key(item)
+            if k not in index:
+                index[k] = len(self.items)
+                self.items.append(item)
+                self.rows.append(row)
+            self.inverse.append(index[k])
+
+    def __len__(self):
+        return len(self.items)
+
+    def column(self, values):
+        '''
+        Values of another column at the first occurrence of every unique item
+        '''
+        return [values[row] for row in self.rows]
+
+    def broadcast(self, results):
+        '''
+        Results of the unique items, one per row
+        '''
+        return [results[i] for i in self.inverse]
+
+
+class SharedResults:
+    '''
+    Coroutine results keyed by their normalized input within one event loop: the first request for a key starts
+    the coroutine, later requests for the same key await the same result. The coroutine is cancelled when every
+    caller waiting for it was cancelled, and started again if the key is requested after that.
+    '''
+    def __init__(self):
+        self.tasks = {}
+        self.waiters = {}
+        self.abandoned = set() # keys whose coroutine was cancelled
+        self.requests = 0
+
+    def get(self, k, coroutine_function, *args):
+        self.requests += 1
+        if k not in self.tasks or k in self.abandoned:
+            self.abandoned.discard(k)
+            self.tasks[k] = asyncio.ensure_future(coroutine_function(*args))
+        self.waiters[k] = self.waiters.get(k, 0) + 1
+        return self._wait(k, self.tasks[k])
+
+    async def _wait(self, k, task):
+        try:
+            # a cancelled caller must not cancel the result other callers wait for
+            return await asyncio.shield(task)
+        finally:
+            self.waiters[k] -= 1
+            if not self.waiters[k] and not task.done():
+                task.cancel()
+                self.abandoned.add(k)
+
+    async def settle(self):
+        '''
+        Wait until every coroutine has finished or was cancelled
+        '''
+        await asyncio.gather(*self.tasks.values(), return_exceptions=True)
+
+
+class DedupStats:
+    '''
+    Rows and unique items seen by a stage, per level (e.g. claims, rows, sub-claim cells)
+    '''
+    def __init__(self):
+        self.counts = {}
+
+    def add(self, level, rows, unique):
+        counts = self.counts.setdefault(level, [0, 0])
+        counts[0] += rows
+        counts[1] += unique
+
+    def report(self):
+        '''
+        Rows, unique items and dedup ratio (rows per unique item) per level
+        '''
+        return {
+            level: {"rows": rows, "unique": unique, "ratio": rows/unique if unique else 1.0}
+            for level, (rows, unique) in self.counts.items()
+        }
@@ -0,0 +1,87 @@
+from collections import Counter
+
+import jaro
+import numpy as np
+
+
+def normalize(entity):
+    return entity.lower().strip()
+
+
+class PairScores:
+    '''
+    Memoized Jaro-Winkler scores of normalized entity pairs, shared across rows
+    '''
+    def __init__(self, max_pairs=1000000):
+        self.max_pairs = max_pairs
+        self.scores = {}
+        self.hits = 0
+        self.misses = 0
+
+    def score(self, a, b):
+        # jaro compares the shorter string against the longer one, equal lengths keep the argument order
+        key = (a, b)
+        score = self.scores.get(key)
+        if score is None:
+            self.misses += 1
+            if len(self.scores) >= self.max_pairs:
+                self.scores.clear()
+            score = self.scores[key] = jaro.jaro_winkler_metric(a, b)
+        else:
+            self.hits += 1
+        return score
+
+
+class EntityIndex:
+    '''
+    Normalized entities of a claim (or of a set of sub-claims), to check whether an entity fuzzy matches any of them.
+    A lookup exits early on an exact match or on a prefix match that is guaranteed to pass the threshold.
+    Otherwise an upper bound of the Jaro-Winkler score of every indexed entity, from shared character counts,
+    is computed in bulk and only the entities which can pass the threshold are scored.
+    '''
+    def __init__(self, entities, pair_scores):
+        self.entities = list(dict.fromkeys(normalize(e) for e in entities))
+        self.exact = set(self.entities)
+        self.pair_scores = pair_scores
+
+        self.alphabet = {c: i for i, c in enumerate(sorted(set("".join(self.entities))))}
+        self.counts = np.zeros((len(self.entities), len(self.alphabet)), dtype=np.int32)
+        for i, e in enumerate(self.entities):
+            for c, n in Counter(e).items():
+                self.counts[i, self.alphabet[c]] = n
+        self.lengths = np.array([len(e) for e in self.entities], dtype=np.float64)
+
+    def upper_bounds(self, x):
+        '''
+        Upper bound of the Jaro-Winkler score between x and every indexed entity
+        '''
+        q = np.zeros(len(self.alphabet), dtype=np.int32)
+        for c, n in Counter(x).items():
+            if c in self.alphabet:
+                q[self.alphabet[c]] = n
+        # matched characters can't exceed the shared characters, and at most 4 prefix characters boost the score
+        shared = np.minimum(self.counts, q).sum(axis=1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            bound = (shared/max(len(x), 1) + shared/np.maximum(self.lengths, 1) + 1)/3
+        bound[shared == 0] = 0
+        return np.where(bound > 0.7, bound + 0.4*(1 - bound), bound)
+
+    def contains(self, entity, threshold):
+        '''
+        Whether the Jaro-Winkler score between the entity and any indexed entity is above the threshold
+        '''
+        x = normalize(entity)
+        if x in self.exact:
+            return True
+        if not self.entities:
+            return False
+
+        for i in np.flatnonzero(self.upper_bounds(x) > threshold):
+            e = self.entities[i]
+            short, long = (x, e) if len(x) <= len(e) else (e, x)
+            # every character of a prefix matches in place: jaro >= (2 + |short|/|long|)/3
+            if short and long.startswith(short) and (2 + len(short)/len(long))/3 > threshold:
+                return True
+            if self.pair_scores.score(x, e) > threshold:
+                return True
+        return False
@@ -0,0 +1,125 @@
+import argparse
+import json
+import random
+import re
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def extract_claim(prompt):
+    '''
+    Find the (last) claim in a prompt, every FactLens template has a "Claim: ..." line
+    '''
+    claims = re.findall(r"^claim: (.*)$", prompt, flags=re.IGNORECASE | re.MULTILINE)
+    return claims[-1].strip() if claims else prompt.strip()
+
+
+def fake_entities(claim):
+    words = re.findall(r"\w+", claim)
+    return {"subjects": words[:1], "objects": words[-1:]}
+
+
+def fake_content(messages):
+    '''
+    Deterministic answer to a FactLens prompt, in the format the calling stage expects
+    '''
+    system = messages[0]["content"] if messages[0]["role"] == "system" else ""
+    # the FactLens prompt is the first user turn, later turns only re-ask
+    prompt = next(m["content"] for m in messages if m["role"] == "user")
+    claim = extract_claim(prompt)
+    if "sub_claims" in system:
+        sub_claims = [s.strip() for s in re.split(r",? and |; ", claim) if s.strip()]
+        return json.dumps({"sub_claims": sub_claims})
+    if "keyed by claim id" in system:
+        claims = json.loads(prompt[prompt.index("{"):prompt.rindex("}") + 1])
+        return json.dumps({i: fake_entities(c) for i, c in claims.items()})
+    if "keyed by sub-claim id" in system:
+        sub_claims = json.loads(prompt[prompt.index("{"):prompt.rindex("}") + 1])
+        metrics = re.findall(r"^- (\w+):", prompt, flags=re.MULTILINE)
+        return json.dumps({i: {m: "atomic" if m == "atomicity" else "high" for m in metrics} for i in sub_claims})
+    if "subjects and objects" in system:
+        return json.dumps(fake_entities(claim))
+    if "label" in system:
+        # about one claim in four is false
+        return "false" if zlib.crc32(claim.encode()) % 4 == 0 else "true"
+    if "non-atomic-1" in prompt:
+        return "atomic"
+    return "high"
+
+
+def fake_completion(model_config):
+    '''
+    Chat-completions response body for a request
+    '''
+    content = fake_content(model_config["messages"])
+    prompt_tokens = sum(len(m["content"]) for m in model_config["messages"]) // 4
+    completion_tokens = len(content) // 4 + 1
+    return {
+        "id": "chatcmpl-fake",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model_config.get("model", ""),
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": content},
+            "finish_reason": "stop"
+        }],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens
+        }
+    }
+
+
+class FakeChatCompletionsHandler(BaseHTTPRequestHandler):
+    '''
+    Serve /v1/chat/completions after an artificial latency
+    '''
+    latency = 0.5
+    jitter = 0.1
+
+    def do_POST(self):
+        if not self.path.endswith("/chat/completions"):
+            self.send_error(404)
+            return
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        model_config = json.loads(body)
+        time.sleep(max(0, random.gauss(self.latency, self.jitter)))
+
+        payload = json.dumps(fake_completion(model_config)).encode()
+        try:
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+        except (BrokenPipeError, ConnectionResetError):
+            pass # the client cancelled the request
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(host="127.0.0.1", port=8000, latency=0.5, jitter=0.1):
+    handler = type("Handler", (FakeChatCompletionsHandler,), {"latency": latency, "jitter": jitter})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local fake chat-completions server with artificial latency")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0.5, help="mean latency per request in seconds")
+    parser.add_argument("--jitter", type=float, default=0.1, help="standard deviation of the latency")
+    args = parser.parse_args()
+
+    server = serve(args.host, args.port, args.latency, args.jitter)
+    print("Serving fake chat completions on http://{}:{}/v1".format(args.host, args.port))
+    server.serve_forever()
+
+if __name__ == '__main__':
+    main()
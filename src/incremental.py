@@ -0,0 +1,97 @@
+import hashlib
+import inspect
+import json
+import os
+import sqlite3
+import threading
+from collections import Counter
+from functools import lru_cache
+
+from src.config import CELL_STORE_PATH
+
+
+def fingerprint(*parts):
+    '''
+    Content hash of everything a result depends on (texts, prompts, model, thresholds, code)
+    '''
+    normalized = json.dumps(parts, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str)
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+
+def source(function):
+    '''
+    Source code of a function (or class), so that editing it changes the fingerprints of the results it computed
+    '''
+    return _source(getattr(function, "__func__", function))
+
+
+@lru_cache(maxsize=None)
+def _source(function):
+    try:
+        return inspect.getsource(function)
+    except (OSError, TypeError):
+        return getattr(function, "__qualname__", repr(function))
+
+
+class CellStore:
+    '''
+    Disk-backed (SQLite) store of evaluation results keyed by their fingerprint: one cell per row x metric,
+    plus the intermediate results (entities, BERTScore pairs) the local metrics are derived from.
+    Tracks how many cells were reused and recomputed per metric.
+    '''
+    def __init__(self, path):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS cells (key TEXT PRIMARY KEY, value TEXT)")
+        self.db.commit()
+        self.reused = Counter()
+        self.recomputed = Counter()
+        self._lock = threading.Lock()
+
+    def get_many(self, keys):
+        '''
+        Stored values of the keys which are in the store
+        '''
+        keys = list(set(keys))
+        values = {}
+        with self._lock:
+            for start in range(0, len(keys), 500):
+                batch = keys[start:start + 500]
+                rows = self.db.execute(
+                    "SELECT key, value FROM cells WHERE key IN ({})".format(",".join("?"*len(batch))), batch
+                ).fetchall()
+                values.update((k, json.loads(v)) for k, v in rows)
+        return values
+
+    def put_many(self, items):
+        with self._lock:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO cells (key, value) VALUES (?, ?)",
+                [(k, json.dumps(v, ensure_ascii=False)) for k, v in items]
+            )
+            self.db.commit()
+
+    def count(self, metric, reused, recomputed):
+        self.reused[metric] += reused
+        self.recomputed[metric] += recomputed
+
+    def stats(self):
+        return {
+            m: {"reused": self.reused[m], "recomputed": self.recomputed[m]}
+            for m in sorted(set(self.reused) | set(self.recomputed))
+        }
+
+
+_store = None
+
+def get_cell_store():
+    '''
+    Process-wide cell store configured in config.py
+    '''
+    global _store
+    if _store is None:
+        _store = CellStore(CELL_STORE_PATH)
+    return _store
@@ -0,0 +1,187 @@
+import contextlib
+import contextvars
+import json
+import threading
+import time
+from collections import defaultdict
+
+from src.config import MODEL_PRICES
+
+hooks = [] # callables receiving the record of every model call, nothing is recorded while this is empty
+_labels = contextvars.ContextVar("factlens_call_labels", default={})
+
+
+@contextlib.contextmanager
+def labels(**kwargs):
+    '''
+    Labels (e.g. stage, metric) attached to the model calls made in this block, including those of the asyncio
+    tasks it starts
+    '''
+    token = _labels.set(dict(_labels.get(), **kwargs))
+    try:
+        yield
+    finally:
+        _labels.reset(token)
+
+
+def add_hook(hook):
+    hooks.append(hook)
+    return hook
+
+
+def remove_hook(hook):
+    if hook in hooks:
+        hooks.remove(hook)
+
+
+def cost(model, prompt_tokens, completion_tokens, cached_tokens=0):
+    '''
+    Price of a request in USD, 0 for a model without a price in config.py.
+    cached_tokens of the prompt tokens were served from the provider's prompt cache at the cached price.
+    '''
+    prompt_price, completion_price, cached_price = MODEL_PRICES.get(model, (0, 0, 0))
+    return ((prompt_tokens - cached_tokens)*prompt_price + cached_tokens*cached_price + completion_tokens*completion_price)/1e6
+
+
+def cached_tokens(usage):
+    '''
+    Prompt tokens the provider served from its prompt cache (usage.prompt_tokens_details.cached_tokens)
+    '''
+    details = usage.get("prompt_tokens_details") or {}
+    return details.get("cached_tokens") or 0
+
+
+def emit(stage, model_config, response, latency, cache_hit=False, retries=0, error=None):
+    '''
+    Build the record of a model call and pass it to every hook
+    '''
+    call_labels = _labels.get()
+    usage = (response.get("usage") if response is not None else None) or {}
+    model = model_config.get("model")
+    prompt_tokens = usage.get("prompt_tokens", 0)
+    completion_tokens = usage.get("completion_tokens", 0)
+    prompt_cached_tokens = cached_tokens(usage)
+    record = {
+        "time": time.time(),
+        "stage": call_labels.get("stage", stage),
+        "metric": call_labels.get("metric"),
+        "model": model,
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "cached_tokens": prompt_cached_tokens,
+        "latency": latency,
+        "cache_hit": cache_hit,
+        "retries": retries,
+        "error": type(error).__name__ if error is not None else None,
+        "cost": 0 if cache_hit else cost(model, prompt_tokens, completion_tokens, prompt_cached_tokens), # a cached response is free
+    }
+    for hook in list(hooks):
+        hook(record)
+
+
+class JSONLRecorder:
+    '''
+    Hook appending every call record to a JSONL file
+    '''
+    def __init__(self, path):
+        self.file = open(path, "a", encoding="utf-8")
+        self._lock = threading.Lock()
+
+    def __call__(self, record):
+        line = json.dumps(record) + "\n"
+        with self._lock:
+            self.file.write(line)
+
+    def close(self):
+        self.file.close()
+
+
+class Metrics:
+    '''
+    Hook aggregating the call records per (stage, metric): calls, errors, cache hits, retries, tokens (and prompt
+    tokens served from the provider's prompt cache) and cost of the requests which reached the model, and a latency histogram
+    '''
+    BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float("inf"))
+    COUNTERS = ("calls", "errors", "cache_hits", "retries", "prompt_tokens", "completion_tokens", "cached_tokens", "cost", "latency_sum")
+
+    def __init__(self):
+        self.series = defaultdict(lambda: dict({k: 0 for k in self.COUNTERS}, latency_buckets=[0]*len(self.BUCKETS)))
+        self._lock = threading.Lock()
+
+    def __call__(self, record):
+        with self._lock:
+            s = self.series[(record["stage"], record["metric"])]
+            s["calls"] += 1
+            s["errors"] += record["error"] is not None
+            s["retries"] += record["retries"]
+            s["latency_sum"] += record["latency"]
+            for i, bound in enumerate(self.BUCKETS):
+                if record["latency"] <= bound:
+                    s["latency_buckets"][i] += 1
+                    break
+            if record["cache_hit"]:
+                s["cache_hits"] += 1
+            else:
+                s["prompt_tokens"] += record["prompt_tokens"]
+                s["completion_tokens"] += record["completion_tokens"]
+                s["cached_tokens"] += record.get("cached_tokens", 0)
+                s["cost"] += record["cost"]
+
+    def summary(self, by_metric=False):
+        '''
+        Aggregates per stage (or per stage and metric), with the mean latency, the cache hit rate and the share
+        of prompt tokens served from the provider's prompt cache
+        '''
+        totals = {}
+        with self._lock:
+            for (stage, metric), s in self.series.items():
+                key = "{}/{}".format(stage, metric) if by_metric else str(stage)
+                total = totals.setdefault(key, {k: 0 for k in self.COUNTERS})
+                for k in self.COUNTERS:
+                    total[k] += s[k]
+        for total in totals.values():
+            total["latency_mean"] = total.pop("latency_sum")/total["calls"] if total["calls"] else 0
+            total["cache_hit_rate"] = total["cache_hits"]/total["calls"] if total["calls"] else 0
+            total["cached_token_share"] = total["cached_tokens"]/total["prompt_tokens"] if total["prompt_tokens"] else 0
+        return totals
+
+    def to_prometheus(self, prefix="factlens_llm"):
+        '''
+        Aggregates in the Prometheus text exposition format
+        '''
+        lines = []
+        counters = [
+            ("calls", "calls_total", "Model calls"),
+            ("errors", "errors_total", "Model calls which failed"),
+            ("cache_hits", "cache_hits_total", "Model calls answered from the response cache"),
+            ("retries", "retries_total", "Retried requests"),
+            ("prompt_tokens", "prompt_tokens_total", "Prompt tokens sent to the model"),
+            ("completion_tokens", "completion_tokens_total", "Completion tokens received from the model"),
+            ("cached_tokens", "cached_prompt_tokens_total", "Prompt tokens served from the provider's prompt cache"),
+            ("cost", "cost_usd_total", "Cost of the model calls in USD"),
+        ]
+        with self._lock:
+            series = sorted(self.series.items(), key=lambda item: (str(item[0][0]), str(item[0][1])))
+            for key, name, description in counters:
+                lines.append("# HELP {}_{} {}".format(prefix, name, description))
+                lines.append("# TYPE {}_{} counter".format(prefix, name))
+                for (stage, metric), s in series:
+                    lines.append('{}_{}{{stage="{}",metric="{}"}} {}'.format(prefix, name, stage or "", metric or "", s[key]))
+
+            name = "{}_latency_seconds".format(prefix)
+            lines.append("# HELP {} Model call latency".format(name))
+            lines.append("# TYPE {} histogram".format(name))
+            for (stage, metric), s in series:
+                call_labels = 'stage="{}",metric="{}"'.format(stage or "", metric or "")
+                cumulative = 0
+                for bound, count in zip(self.BUCKETS, s["latency_buckets"]):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append('{}_bucket{{{},le="{}"}} {}'.format(name, call_labels, le, cumulative))
+                lines.append("{}_sum{{{}}} {}".format(name, call_labels, s["latency_sum"]))
+                lines.append("{}_count{{{}}} {}".format(name, call_labels, s["calls"]))
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path):
+        with open(path, "w") as f:
+            f.write(self.to_prometheus())
@@ -1,16 +1,210 @@
-import os
+import asyncio
+import time
 
-import openai
+from src import instrumentation
+from src.backends import get_backend, to_response
+from src.cache import get_cache
+from src.config import (MAX_IN_FLIGHT, MAX_REASKS, REQUEST_TIMEOUT,
+                        REQUESTS_PER_MINUTE, TOKENS_PER_MINUTE)
+from src.resilience import (Backoff, CircuitBreaker, ParseError, is_retryable,
+                            parse_json, reask_config)
 
 
 class OpenAI:
-    def __init__(self, openai_api_key, openai_organization=""):
-        openai.api_key = openai_api_key
-        if openai_organization:
-            openai.organization = openai_organization
+    def __init__(self, openai_api_key="", openai_organization="", cache=None, backend=None, stage=None,
+                 timeout=REQUEST_TIMEOUT):
+        self.backend = backend or get_backend(openai_api_key, openai_organization)
+        self.cache = None # the response cache is only opened for a backend whose responses are cached
+        if self.backend.cacheable:
+            self.cache = get_cache() if cache is None else cache or None # cache=False disables caching
+        self.stage = stage # label of the calls in the instrumentation records
+        self.timeout = timeout
+        self.backoff = Backoff()
+        self.breaker = CircuitBreaker()
 
     def call(self, model_config):
-        response = openai.ChatCompletion.create(
-            **model_config
-        )  
+        if not instrumentation.hooks:
+            return self._call(model_config)[0]
+        start = time.perf_counter()
+        try:
+            response, cache_hit, retries = self._call(model_config)
+        except Exception as e:
+            instrumentation.emit(self.stage, model_config, None, time.perf_counter() - start, error=e)
+            raise
+        instrumentation.emit(self.stage, model_config, response, time.perf_counter() - start, cache_hit, retries)
         return response
+
+    def _call(self, model_config):
+        '''
+        Response, whether it came from the cache, and the number of retries
+        '''
+        cacheable = self.cache is not None and self.cache.cacheable(model_config)
+        if cacheable:
+            cached = self.cache.get(self.backend.cache_config(model_config))
+            if cached is not None:
+                return to_response(cached), True, 0
+        retries = 0
+        while True:
+            time.sleep(self.breaker.wait)
+            try:
+                response = self.backend.create(model_config, self.timeout)
+                break
+            except Exception as e:
+                if not is_retryable(e) or retries >= self.backoff.max_retries:
+                    raise
+                self.breaker.record_failure()
+                time.sleep(self.backoff.delay(retries, e))
+                retries += 1
+        self.breaker.record_success()
+        if cacheable:
+            self.cache.put(self.backend.cache_config(model_config), response)
+        return response, False, retries
+
+
+def estimate_tokens(model_config):
+    '''
+    Rough token estimate of a request (~4 characters per token) used for rate limiting
+    '''
+    characters = sum(len(m["content"]) for m in model_config["messages"])
+    return characters // 4 + model_config.get("max_tokens", 0)
+
+
+class RateLimiter:
+    '''
+    Token buckets limiting requests and tokens per minute. A limit of None disables the bucket.
+    '''
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None):
+        self.limits = {"requests": requests_per_minute, "tokens": tokens_per_minute}
+        self.levels = {k: v for k, v in self.limits.items() if v}
+        self.updated = time.monotonic()
+        self._lock = None
+        self._loop = None
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self.updated
+        self.updated = now
+        for k in self.levels:
+            self.levels[k] = min(self.limits[k], self.levels[k] + elapsed*self.limits[k]/60)
+
+    def consume(self, tokens):
+        '''
+        Correct the token bucket once the real usage of a request is known
+        '''
+        if "tokens" in self.levels:
+            self.levels["tokens"] -= tokens
+
+    async def acquire(self, tokens):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop, self._lock = loop, asyncio.Lock()
+
+        needed = {"requests": 1, "tokens": tokens}
+        async with self._lock:
+            while True:
+                self._refill()
+                # a single request larger than the whole bucket only waits for a full bucket
+                wants = {k: min(needed[k], self.limits[k]) for k in self.levels}
+                waits = [(wants[k] - self.levels[k])*60/self.limits[k] for k in self.levels if self.levels[k] < wants[k]]
+                if not waits:
+                    for k in self.levels:
+                        self.levels[k] -= wants[k]
+                    return
+                await asyncio.sleep(max(waits))
+
+
+class AsyncOpenAI:
+    '''
+    asyncio client with a bound on the number of requests in flight and requests/tokens per minute rate limiting.
+    Failed requests are retried with jittered exponential backoff, and paused by a circuit breaker when every
+    request fails.
+    '''
+    def __init__(self, openai_api_key="", openai_organization="", max_in_flight=MAX_IN_FLIGHT,
+                 requests_per_minute=REQUESTS_PER_MINUTE, tokens_per_minute=TOKENS_PER_MINUTE, cache=None, backend=None,
+                 stage=None, timeout=REQUEST_TIMEOUT):
+        self.backend = backend or get_backend(openai_api_key, openai_organization)
+        self.cache = None # the response cache is only opened for a backend whose responses are cached
+        if self.backend.cacheable:
+            self.cache = get_cache() if cache is None else cache or None # cache=False disables caching
+        if not self.backend.rate_limited:
+            requests_per_minute = tokens_per_minute = None
+        self.stage = stage # label of the calls in the instrumentation records
+        self.timeout = timeout
+        self.backoff = Backoff()
+        self.breaker = CircuitBreaker()
+        self.max_in_flight = max_in_flight
+        self.limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+        self._semaphore = None
+        self._loop = None
+
+    @property
+    def semaphore(self):
+        # asyncio primitives are bound to a loop, and every asyncio.run() starts a new one
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop, self._semaphore = loop, asyncio.Semaphore(self.max_in_flight)
+        return self._semaphore
+
+    async def call(self, model_config):
+        if not instrumentation.hooks:
+            return (await self._call(model_config))[0]
+        start = time.perf_counter()
+        try:
+            response, cache_hit, retries = await self._call(model_config)
+        except Exception as e:
+            instrumentation.emit(self.stage, model_config, None, time.perf_counter() - start, error=e)
+            raise
+        instrumentation.emit(self.stage, model_config, response, time.perf_counter() - start, cache_hit, retries)
+        return response
+
+    async def _call(self, model_config):
+        cacheable = self.cache is not None and self.cache.cacheable(model_config)
+        if cacheable:
+            cached = self.cache.get(self.backend.cache_config(model_config))
+            if cached is not None:
+                return to_response(cached), True, 0
+        retries = 0
+        while True:
+            while self.breaker.wait:
+                await asyncio.sleep(self.breaker.wait)
+            error = None
+            async with self.semaphore:
+                estimate = estimate_tokens(model_config)
+                await self.limiter.acquire(estimate)
+                try:
+                    response = await asyncio.wait_for(self.backend.acreate(model_config), self.timeout)
+                except Exception as e:
+                    error = e
+            if error is None:
+                break
+            if not is_retryable(error) or retries >= self.backoff.max_retries:
+                raise error
+            # wait without holding a slot, so that the other requests go on
+            self.breaker.record_failure()
+            await asyncio.sleep(self.backoff.delay(retries, error))
+            retries += 1
+        self.breaker.record_success()
+        usage = response.get("usage")
+        if usage:
+            self.limiter.consume(usage["total_tokens"] - estimate)
+        if cacheable:
+            self.cache.put(self.backend.cache_config(model_config), response)
+        return response, False, retries
+
+    async def call_json(self, model_config, validate=None, reasks=MAX_REASKS):
+        '''
+        Parsed JSON answer (repaired if needed), passed through validate, which returns the value to use and raises
+        ValueError/KeyError/TypeError for an unusable answer. An unusable answer is asked again up to reasks times,
+        then ParseError is raised.
+        '''
+        config = model_config
+        for _ in range(reasks + 1):
+            response = await self.call(config)
+            content = response.choices[0]["message"]["content"]
+            try:
+                value = parse_json(content)
+                return validate(value) if validate else value
+            except (ValueError, KeyError, TypeError) as e:
+                error = e
+            config = reask_config(model_config, content, error)
+        raise ParseError("no usable answer after {} re-asks: {}".format(reasks, error))
@@ -60,6 +60,18 @@ Claim: {claim}
 Sub-Claim: {sub_claims}
 '''
 
+MULTI_METRIC_SUB_CLAIM_EVALUATION = '''
+A factual claim can be broken down into atomic, yet contextualized sub-claims which makes it easier to fact check.
+You will be provided a claim, and all the sub-claims which have been extracted from it, keyed by sub-claim id. Your job is to evaluate each sub-claim on each of the following metrics:
+
+{metrics}
+
+Your answer should be a dictionary/JSON with one entry per sub-claim id, each a dictionary mapping every metric name to one of its labels. Please be objective and fair in your evaluation.
+
+Claim: {claim}
+Sub-Claims: {sub_claims}
+'''
+
 ENTITY_EXTRACTOR_PROMPT = '''
 Given a fact-checking claim, return all the subjects and the objects present in it. 
 In order to do this, find all relations present in the claim as (subject, relation, object) tuples. Then list all the subjects and objects.
@@ -68,8 +80,43 @@ Claim: {claim}
 Your answer should be in form of a dictionary/JSON with keys \"subjects\" and \"objects\"
 '''
 
+BATCH_ENTITY_EXTRACTOR_PROMPT = '''
+Given a set of fact-checking claims, return all the subjects and the objects present in each of them. 
+In order to do this, for each claim find all relations present in the claim as (subject, relation, object) tuples. Then list all the subjects and objects of that claim.
+Claims (keyed by claim id): 
+{claims}
+
+Your answer should be in form of a dictionary/JSON with one entry per claim id, each a dictionary with keys \"subjects\" and \"objects\"
+'''
+
 VERIFIER_PROMPT = '''
 Verify if the following claim is true or false based on the context provided.
 Claim: {claim}
 Context: {context}
+'''
+
+# Prefix-stable layouts: everything shared across requests first and the claim last, so that providers
+# which cache prompt prefixes reuse the instructions (and the context shared by the sub-claims of a row)
+
+PREFIX_STABLE_ENTITY_EXTRACTOR_PROMPT = '''
+Given a fact-checking claim, return all the subjects and the objects present in it. 
+In order to do this, find all relations present in the claim as (subject, relation, object) tuples. Then list all the subjects and objects.
+Your answer should be in form of a dictionary/JSON with keys \"subjects\" and \"objects\"
+
+Claim: {claim}
+'''
+
+PREFIX_STABLE_BATCH_ENTITY_EXTRACTOR_PROMPT = '''
+Given a set of fact-checking claims, return all the subjects and the objects present in each of them. 
+In order to do this, for each claim find all relations present in the claim as (subject, relation, object) tuples. Then list all the subjects and objects of that claim.
+Your answer should be in form of a dictionary/JSON with one entry per claim id, each a dictionary with keys \"subjects\" and \"objects\"
+
+Claims (keyed by claim id): 
+{claims}
+'''
+
+PREFIX_STABLE_VERIFIER_PROMPT = '''
+Verify if the following claim is true or false based on the context provided.
+Context: {context}
+Claim: {claim}
 '''
\ No newline at end of file
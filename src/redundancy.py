@@ -0,0 +1,76 @@
+from collections import defaultdict
+
+import torch
+from bert_score.utils import get_bert_embedding
+from torch.nn.utils.rnn import pad_sequence
+
+
+class BERTScoreRedundancy:
+    '''
+    Pairwise BERTScore F1 between sub-claims from cached contextual embeddings.
+    Every sentence is encoded once, in batches, and all pairs of a row are scored with one batched matrix operation.
+    Scores are those of BERTScorer.score([a], [b]) for each pair.
+    '''
+    def __init__(self, scorer, batch_size=64):
+        self.scorer = scorer
+        self.batch_size = batch_size
+        self.embeddings = {} # sentence -> (normalized token embeddings, normalized idf weights)
+
+        if scorer.idf:
+            self.idf_dict = scorer._idf_dict
+        else:
+            self.idf_dict = defaultdict(lambda: 1.0)
+            self.idf_dict[scorer._tokenizer.sep_token_id] = 0
+            self.idf_dict[scorer._tokenizer.cls_token_id] = 0
+
+    def encode(self, sentences):
+        '''
+        Encode the sentences which are not cached yet.
+        Sentences are sorted by length so that each batch needs little padding.
+        '''
+        todo = sorted(set(sentences) - self.embeddings.keys(), key=lambda x: len(x.split(" ")), reverse=True)
+        for start in range(0, len(todo), self.batch_size):
+            batch = todo[start:start + self.batch_size]
+            embs, masks, padded_idf = get_bert_embedding(
+                batch, self.scorer._model, self.scorer._tokenizer, self.idf_dict, device=self.scorer.device
+            )
+            embs, masks, padded_idf = embs.cpu(), masks.cpu(), padded_idf.cpu()
+            for i, sentence in enumerate(batch):
+                length = masks[i].sum().item()
+                emb = embs[i, :length]
+                idf = padded_idf[i, :length]
+                self.embeddings[sentence] = (emb/torch.norm(emb, dim=-1).unsqueeze(-1), idf/idf.sum())
+
+    def clear(self):
+        self.embeddings = {}
+
+    def pairwise_f1(self, sentences):
+        '''
+        n x n matrix of BERTScore F1 between the sentences
+        '''
+        self.encode(sentences)
+        embs, idfs = zip(*[self.embeddings[s] for s in sentences])
+        lengths = torch.tensor([e.size(0) for e in embs])
+        mask = torch.arange(lengths.max()).unsqueeze(0) < lengths.unsqueeze(1) # n x L
+        emb = pad_sequence(embs, batch_first=True) # n x L x d
+        idf = pad_sequence(idfs, batch_first=True) # n x L
+
+        # sim[a, b, i, j]: cosine similarity of token i of sentence a and token j of sentence b
+        sim = torch.einsum("ald,bmd->ablm", emb, emb)
+        sim = sim.masked_fill(~mask[None, :, None, :], float("-inf"))
+        # greedy matching of every token of a to the tokens of b
+        word_precision = sim.max(dim=3)[0].masked_fill(~mask[:, None, :], 0)
+        P = (word_precision*idf[:, None, :]).sum(dim=2) # P[a, b] with a as candidate and b as reference
+        R = P.T
+        F = 2*P*R/(P + R)
+        return F.masked_fill(torch.isnan(F), 0.0)
+
+    def pair_scores(self, sentences):
+        '''
+        F1 of every pair of sentences, in the order of itertools.combinations(sentences, 2)
+        '''
+        if len(sentences) < 2:
+            return []
+        F = self.pairwise_f1(sentences)
+        i, j = torch.triu_indices(len(sentences), len(sentences), offset=1)
+        return F[i, j].tolist()
@@ -0,0 +1,21 @@
+import threading
+
+_models = {}
+_lock = threading.Lock()
+
+
+def get_shared(key, load):
+    '''
+    Process-wide model registry: load() runs once per key, on first use, and every caller shares the result
+    '''
+    with _lock:
+        if key not in _models:
+            _models[key] = load()
+        return _models[key]
+
+
+def get_bert_scorer(model_type="bert-base-uncased"):
+    def load():
+        from bert_score import BERTScorer
+        return BERTScorer(model_type=model_type)
+    return get_shared(("bert_score", model_type), load)
@@ -0,0 +1,212 @@
+import ast
+import asyncio
+import json
+import os
+import random
+import re
+import threading
+import time
+import traceback
+
+from src.backends import TransientError
+from src.config import (CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_SECONDS,
+                        DEAD_LETTER_PATH, MAX_RETRIES, RETRY_BASE_DELAY,
+                        RETRY_MAX_DELAY)
+
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504}
+
+
+class ParseError(ValueError):
+    '''
+    A model answer which could not be parsed, even after re-asking
+    '''
+
+
+def is_retryable(error):
+    '''
+    Whether a failed request may succeed if it is sent again: rate limits, timeouts, connection and server errors
+    '''
+    if isinstance(error, (TransientError, asyncio.TimeoutError, ConnectionError)):
+        return True
+    try:
+        import openai.error
+    except ImportError:
+        return False
+    if isinstance(error, (openai.error.RateLimitError, openai.error.Timeout, openai.error.APIConnectionError,
+                          openai.error.ServiceUnavailableError, openai.error.TryAgain)):
+        return True
+    return isinstance(error, openai.error.OpenAIError) and getattr(error, "http_status", None) in RETRYABLE_STATUS
+
+
+def retry_after(error):
+    '''
+    Seconds the server asked to wait before the next request (Retry-After header), None if it didn't say
+    '''
+    delay = getattr(error, "retry_after", None)
+    headers = getattr(error, "headers", None) or {}
+    if delay is None:
+        delay = headers.get("retry-after") or headers.get("Retry-After")
+    try:
+        return float(delay) if delay is not None else None
+    except ValueError:
+        return None
+
+
+class Backoff:
+    '''
+    Exponential backoff with full jitter: the n-th retry waits uniform(0, min(max_delay, base_delay*2**n)) seconds,
+    or at least the Retry-After of the error
+    '''
+    def __init__(self, max_retries=MAX_RETRIES, base_delay=RETRY_BASE_DELAY, max_delay=RETRY_MAX_DELAY):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, retry, error=None):
+        delay = random.uniform(0, min(self.max_delay, self.base_delay*2**retry))
+        server_delay = retry_after(error)
+        return max(delay, min(server_delay, self.max_delay)) if server_delay is not None else delay
+
+
+class CircuitBreaker:
+    '''
+    Stops sending requests after failure_threshold consecutive failures: requests wait until reset_seconds
+    have passed, then go through again (half-open). The next failure opens the circuit again, a success closes it.
+    '''
+    def __init__(self, failure_threshold=CIRCUIT_FAILURE_THRESHOLD, reset_seconds=CIRCUIT_RESET_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at = None
+        self.trips = 0
+
+    @property
+    def wait(self):
+        '''
+        Seconds until requests may be sent again, 0 if the circuit is closed or half-open
+        '''
+        if self.opened_at is None:
+            return 0
+        return max(0, self.opened_at + self.reset_seconds - time.monotonic())
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.failure_threshold and self.failures >= self.failure_threshold and self.wait == 0:
+            self.opened_at = time.monotonic()
+            self.trips += 1
+
+
+def strip_fences(content):
+    content = content.strip()
+    match = re.match(r"^```[a-zA-Z]*\s*(.*?)\s*```$", content, re.S)
+    return match.group(1) if match else content
+
+
+def parse_json(content):
+    '''
+    Parse a JSON answer, repairing common defects: markdown code fences, text around the JSON object
+    and Python literals (single quotes, True/None). Raises ParseError.
+    '''
+    if not isinstance(content, str):
+        raise ParseError("empty answer")
+    content = strip_fences(content)
+    candidates = [content]
+    start, end = content.find("{"), content.rfind("}")
+    if 0 <= start < end and (start, end) != (0, len(content) - 1):
+        candidates.append(content[start:end + 1])
+    for candidate in candidates:
+        try:
+            return json.loads(candidate)
+        except ValueError:
+            pass
+        try:
+            value = ast.literal_eval(candidate)
+            if isinstance(value, (dict, list)):
+                return value
+        except (ValueError, SyntaxError):
+            pass
+    raise ParseError("answer is not valid JSON: {!r}".format(content[:200]))
+
+
+def reask_config(model_config, content, error):
+    '''
+    Model config asking again after an answer which could not be used, with the answer and the problem in the conversation
+    '''
+    messages = list(model_config["messages"]) + [
+        {"role": "assistant", "content": content if isinstance(content, str) else ""},
+        {"role": "user", "content": "Your answer could not be used ({}). Answer again with only the JSON object in the requested format.".format(error)},
+    ]
+    return dict(model_config, messages=messages)
+
+
+class DeadLetter:
+    '''
+    JSONL file of the rows which failed, with the stage, the row index, the input and the error
+    '''
+    def __init__(self, path):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def write(self, stage, row, data, error):
+        record = {
+            "time": time.time(),
+            "stage": stage,
+            "row": row,
+            "input": data,
+            "error": type(error).__name__,
+            "message": str(error),
+            "traceback": "".join(traceback.format_exception(type(error), error, error.__traceback__))[-2000:],
+        }
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+            self.count += 1
+
+
+_dead_letter = None
+
+def get_dead_letter():
+    '''
+    Process-wide dead-letter file configured in config.py, None if failed rows should raise
+    '''
+    global _dead_letter
+    if _dead_letter is None and DEAD_LETTER_PATH:
+        _dead_letter = DeadLetter(DEAD_LETTER_PATH)
+    return _dead_letter
+
+
+def set_dead_letter(path):
+    '''
+    Write the failed rows of this process to another file
+    '''
+    global _dead_letter
+    _dead_letter = DeadLetter(path)
+    return _dead_letter
+
+
+async def gather_rows(stage, rows, inputs, coroutines, progress=True):
+    '''
+    Await one coroutine per row concurrently, results in row order. A row which fails is written to the dead-letter
+    file with its index and input and its result is None, so that one bad row doesn't stop the others.
+    Without a dead-letter file the first failure is raised.
+    '''
+    from tqdm.asyncio import tqdm_asyncio
+    gather = tqdm_asyncio.gather if progress else asyncio.gather
+    dead_letter = get_dead_letter()
+    if dead_letter is None:
+        return await gather(*coroutines)
+
+    async def guarded(row, data, coroutine):
+        try:
+            return await coroutine
+        except Exception as e:
+            dead_letter.write(stage, row, data, e)
+            return None
+    return await gather(*[guarded(r, d, c) for r, d, c in zip(rows, inputs, coroutines)])
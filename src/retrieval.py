@@ -0,0 +1,299 @@
+import fcntl
+import json
+import math
+import os
+import re
+import shutil
+import threading
+import uuid
+from collections import Counter
+
+import numpy as np
+
+from src.config import (BM25_B, BM25_K1, RETRIEVAL_CHUNK_OVERLAP,
+                        RETRIEVAL_CHUNK_WORDS, RETRIEVAL_INDEX_PATH,
+                        RETRIEVAL_MAX_SEGMENTS)
+from src.incremental import fingerprint
+
+ARRAYS = ["doc_chunks", "doc_postings", "chunk_text", "chunk_lengths", "posting_terms", "posting_chunks", "posting_tf"]
+
+
+def tokenize(text):
+    return re.findall(r"\w+", text.lower())
+
+
+def chunk(text, words=RETRIEVAL_CHUNK_WORDS, overlap=RETRIEVAL_CHUNK_OVERLAP):
+    '''
+    Split a context into chunks of at most words words along its lines (table rows, paragraphs),
+    a line longer than that is split into windows overlapping by overlap words
+    '''
+    pieces = []
+    step = max(1, words - overlap)
+    for line in text.splitlines():
+        tokens = line.split()
+        if len(tokens) <= words:
+            pieces.extend([" ".join(tokens)] if tokens else [])
+            continue
+        pieces.extend(" ".join(tokens[start:start + words]) for start in range(0, max(1, len(tokens) - overlap), step))
+
+    chunks, current, length = [], [], 0
+    for piece in pieces:
+        n = len(piece.split())
+        if current and length + n > words:
+            chunks.append("\n".join(current))
+            current, length = [], 0
+        current.append(piece)
+        length += n
+    if current:
+        chunks.append("\n".join(current))
+    return chunks
+
+
+def write_segment(path, contexts, words, overlap):
+    '''
+    Chunk the contexts ({key: text}) and write their BM25 postings as a segment (see save_segment)
+    '''
+    terms = {}
+    doc_chunks, doc_postings, chunk_text, chunk_lengths = [0], [0], [0], []
+    posting_terms, posting_chunks, posting_tf = [], [], []
+    text = bytearray()
+    for context in contexts.values():
+        postings = []
+        for c in chunk(context, words, overlap):
+            tokens = tokenize(c)
+            for term, tf in Counter(tokens).items():
+                postings.append((terms.setdefault(term, len(terms)), len(chunk_lengths), tf))
+            chunk_lengths.append(len(tokens))
+            text += c.encode("utf-8")
+            chunk_text.append(len(text))
+        # postings of a context sorted by term, so that a query finds the chunks of a term by binary search
+        postings.sort()
+        posting_terms.extend(p[0] for p in postings)
+        posting_chunks.extend(p[1] for p in postings)
+        posting_tf.extend(p[2] for p in postings)
+        doc_chunks.append(len(chunk_lengths))
+        doc_postings.append(len(posting_terms))
+    save_segment(path, [doc_chunks, doc_postings, chunk_text, chunk_lengths, posting_terms, posting_chunks, posting_tf],
+                 text, list(contexts), terms)
+
+
+def save_segment(path, arrays, text, contexts, terms):
+    '''
+    Write a segment directory: the arrays (in the order of ARRAYS) as .npy files, the chunk texts as one UTF-8 file
+    and the context keys and vocabulary as JSON. The segment is written to a temporary directory and renamed,
+    so that readers never see a partial segment.
+    '''
+    dtypes = [np.int64, np.int64, np.int64, np.int32, np.int32, np.int32, np.float32]
+    tmp = "{}.{}.tmp".format(path, os.getpid())
+    os.makedirs(tmp)
+    for name, array, dtype in zip(ARRAYS, arrays, dtypes):
+        np.save(os.path.join(tmp, name + ".npy"), np.asarray(array, dtype=dtype))
+    with open(os.path.join(tmp, "text.bin"), "wb") as f:
+        f.write(text)
+    with open(os.path.join(tmp, "meta.json"), "w") as f:
+        json.dump({"contexts": contexts, "terms": terms}, f, ensure_ascii=False)
+    os.replace(tmp, path)
+
+
+def merge_segments(path, segments):
+    '''
+    Write the contexts of several segments as one segment, a context indexed in several of them is kept once
+    '''
+    terms, contexts, seen = {}, [], set()
+    doc_chunks, doc_postings, chunk_text = [[0]], [[0]], [[0]]
+    chunk_lengths, posting_terms, posting_chunks, posting_tf = [], [], [], []
+    text = bytearray()
+    chunks = postings = 0
+    for segment in segments:
+        # term ids of the segment in the merged vocabulary
+        ids = np.zeros(len(segment.terms), dtype=np.int32)
+        for term, i in segment.terms.items():
+            ids[i] = terms.setdefault(term, len(terms))
+        for doc, k in enumerate(segment.contexts):
+            if k in seen:
+                continue
+            seen.add(k)
+            contexts.append(k)
+            first, last = segment.doc_chunks[doc], segment.doc_chunks[doc + 1]
+            start, end = segment.doc_postings[doc], segment.doc_postings[doc + 1]
+            # postings of a context sorted by term again, the merged term ids are in another order
+            doc_terms = ids[segment.posting_terms[start:end]]
+            doc_chunk_ids = np.asarray(segment.posting_chunks[start:end]) - first + chunks
+            order = np.lexsort((doc_chunk_ids, doc_terms))
+            posting_terms.append(doc_terms[order])
+            posting_chunks.append(doc_chunk_ids[order])
+            posting_tf.append(np.asarray(segment.posting_tf[start:end])[order])
+            chunk_lengths.append(segment.chunk_lengths[first:last])
+            offsets = np.asarray(segment.chunk_text[first:last + 1])
+            chunk_text.append(offsets[1:] - offsets[0] + len(text))
+            text += segment.text[offsets[0]:offsets[-1]].tobytes()
+            chunks += last - first
+            postings += end - start
+            doc_chunks.append([chunks])
+            doc_postings.append([postings])
+    arrays = [doc_chunks, doc_postings, chunk_text, chunk_lengths, posting_terms, posting_chunks, posting_tf]
+    save_segment(path, [np.concatenate(a) if a else [] for a in arrays], text, contexts, terms)
+
+
+class Segment:
+    '''
+    Memory-mapped segment of a retrieval index
+    '''
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        self.contexts = meta["contexts"]
+        self.terms = meta["terms"]
+        for name in ARRAYS:
+            setattr(self, name, np.load(os.path.join(path, name + ".npy"), mmap_mode="r"))
+        size = os.path.getsize(os.path.join(path, "text.bin"))
+        self.text = np.memmap(os.path.join(path, "text.bin"), dtype=np.uint8, mode="r") if size else np.zeros(0, np.uint8)
+
+    def chunk(self, i):
+        return self.text[self.chunk_text[i]:self.chunk_text[i + 1]].tobytes().decode("utf-8")
+
+
+class RetrievalIndex:
+    '''
+    BM25 index of the chunks of every context, on disk under path, to pass the verifier only the chunks of a
+    context relevant to a sub-claim. A context is chunked and indexed once: contexts are keyed by a hash of their
+    text (and the chunking), and every add() writes the new contexts as a new segment, so that several processes
+    (e.g. shard workers) can share an index. Segments are memory-mapped, a search only reads the postings of the
+    context it searches. Term statistics (document frequencies, average length) are those of the chunks of the
+    searched context. Once there are more than max_segments segments, the smallest are merged into one.
+    '''
+    def __init__(self, path=RETRIEVAL_INDEX_PATH, chunk_words=RETRIEVAL_CHUNK_WORDS, chunk_overlap=RETRIEVAL_CHUNK_OVERLAP,
+                 k1=BM25_K1, b=BM25_B, max_segments=RETRIEVAL_MAX_SEGMENTS):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.chunk_words = chunk_words
+        self.chunk_overlap = chunk_overlap
+        self.max_segments = max_segments
+        self.k1 = k1
+        self.b = b
+        self.segments = {}
+        self.docs = {} # context key -> (segment, position of the context in the segment)
+        self._lock = threading.Lock()
+        self.refresh()
+
+    def key(self, context):
+        return fingerprint(self.chunk_words, self.chunk_overlap, context)
+
+    def refresh(self):
+        '''
+        Open the segments written since the last refresh, by this or another process, and drop those merged since.
+        The contexts of a dropped segment stay searchable through its memory maps until a merged segment is opened.
+        '''
+        vanished = True
+        while vanished:
+            vanished = False
+            names = {name for name in os.listdir(self.path) if not name.endswith(".tmp") and not name.startswith(".")}
+            for name in set(self.segments) - names:
+                del self.segments[name]
+            for name in sorted(names - set(self.segments)):
+                try:
+                    segment = Segment(os.path.join(self.path, name))
+                except FileNotFoundError:
+                    # merged and removed by another process meanwhile, into a segment which may not be listed yet
+                    vanished = True
+                    continue
+                self.segments[name] = segment
+                for i, k in enumerate(segment.contexts):
+                    if k not in self.docs or os.path.basename(self.docs[k][0].path) not in self.segments:
+                        self.docs[k] = (segment, i)
+
+    def add(self, contexts):
+        '''
+        Index the contexts which are not indexed yet, returns how many were added
+        '''
+        with self._lock:
+            keys = {self.key(context): context for context in contexts}
+            if all(k in self.docs for k in keys):
+                return 0
+            self.refresh()
+            missing = {k: context for k, context in keys.items() if k not in self.docs}
+            if missing:
+                write_segment(os.path.join(self.path, uuid.uuid4().hex), missing, self.chunk_words, self.chunk_overlap)
+                self.refresh()
+                if len(self.segments) > self.max_segments:
+                    self.compact()
+            return len(missing)
+
+    def compact(self):
+        '''
+        Merge the smallest segments into one, so that half of max_segments are left. Skipped while another
+        process compacts the index.
+        '''
+        with open(os.path.join(self.path, ".lock"), "w") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return
+            self.refresh()
+            if len(self.segments) <= self.max_segments:
+                return
+            segments = sorted(self.segments.values(), key=lambda s: len(s.chunk_lengths))
+            segments = segments[:len(segments) - self.max_segments//2 + 1]
+            merge_segments(os.path.join(self.path, uuid.uuid4().hex), segments)
+            for segment in segments:
+                # renamed first, so that other processes stop listing the segment before its files go
+                removed = "{}.{}.tmp".format(segment.path, os.getpid())
+                os.replace(segment.path, removed)
+                shutil.rmtree(removed)
+            self.refresh()
+
+    def search(self, query, context, k):
+        '''
+        Positions and BM25 scores of the k chunks of a context which match the query best, best first
+        (ties in context order). The context must have been added.
+        '''
+        segment, doc = self.docs[self.key(context)]
+        first, last = segment.doc_chunks[doc], segment.doc_chunks[doc + 1]
+        lengths = np.asarray(segment.chunk_lengths[first:last], dtype=np.float64)
+        scores = np.zeros(last - first)
+        if len(lengths) and lengths.sum():
+            start, end = segment.doc_postings[doc], segment.doc_postings[doc + 1]
+            terms = segment.posting_terms[start:end]
+            # scores summed in term order, so that they don't depend on the segment the context was indexed in
+            ids = [segment.terms[t] for t in sorted(set(tokenize(query))) if t in segment.terms]
+            lo = np.searchsorted(terms, ids, "left")
+            hi = np.searchsorted(terms, ids, "right")
+            norm = self.k1*(1 - self.b + self.b*lengths/lengths.mean())
+            for l, h in zip(lo, hi):
+                if h == l:
+                    continue
+                idf = math.log(1 + (len(lengths) - (h - l) + 0.5)/(h - l + 0.5))
+                chunks = np.asarray(segment.posting_chunks[start + l:start + h]) - first
+                tf = np.asarray(segment.posting_tf[start + l:start + h], dtype=np.float64)
+                scores[chunks] += idf*tf*(self.k1 + 1)/(tf + norm[chunks])
+        best = np.argsort(-scores, kind="stable")[:k]
+        return [(int(i), float(scores[i])) for i in best]
+
+    def chunks(self, context):
+        segment, doc = self.docs[self.key(context)]
+        return [segment.chunk(i) for i in range(segment.doc_chunks[doc], segment.doc_chunks[doc + 1])]
+
+    def evidence(self, query, context, k):
+        '''
+        The k chunks of a context most relevant to the query, in context order, or the whole context
+        if it has no more than k chunks
+        '''
+        segment, doc = self.docs[self.key(context)]
+        first = segment.doc_chunks[doc]
+        if segment.doc_chunks[doc + 1] - first <= k:
+            return context
+        positions = sorted(i for i, _ in self.search(query, context, k))
+        return "\n...\n".join(segment.chunk(first + i) for i in positions)
+
+
+_index = None
+
+def get_retrieval_index():
+    '''
+    Process-wide retrieval index configured in config.py
+    '''
+    global _index
+    if _index is None:
+        _index = RetrievalIndex()
+    return _index
@@ -0,0 +1,598 @@
+import argparse
+import contextlib
+import glob
+import importlib
+import json
+import os
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+
+from src.config import (SHARD_LEASE_SECONDS, SHARD_MAX_ATTEMPTS, SHARD_QUEUE,
+                        SHARD_SIZE)
+from src.dataset_io import read_chunks, read_dataset, write_dataset
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# stage name -> (module, class), every stage has a process(data) method
+STAGES = {
+    "generator": ("sub_claim_generator", "SubClaimGenerator"),
+    "llm_evaluator": ("sub_claim_evaluator", "SubClaimEvaluator"),
+    "automated_evaluator": ("automated_evaluator", "AutomatedEvaluator"),
+    "verifier": ("verifier", "Verifier"),
+}
+
+
+class ShardsFailed(Exception):
+    '''
+    Shards which still failed after SHARD_MAX_ATTEMPTS attempts, with their last error
+    '''
+    def __init__(self, errors):
+        self.errors = errors
+        super().__init__("{} shard(s) failed: {}".format(len(errors), errors))
+
+
+def default_worker_id():
+    return "{}-{}".format(socket.gethostname(), os.getpid())
+
+
+def lease(task, worker, lease_seconds):
+    '''
+    Task claimed by a worker: one more attempt, leased until the deadline
+    '''
+    return dict(task, state="running", attempts=task.get("attempts", 0) + 1, worker=worker,
+                leased_until=time.time() + lease_seconds)
+
+
+def renewed(task, lease_seconds):
+    '''
+    Running task whose lease was extended by its worker
+    '''
+    return dict(task, leased_until=time.time() + lease_seconds)
+
+
+def after_failure(task, error, max_attempts):
+    '''
+    Task after a failed attempt: pending again, or failed after max_attempts
+    '''
+    return dict(task, state="failed" if task["attempts"] >= max_attempts else "pending", error=error,
+                failures=task.get("failures", 0) + 1, worker=None, leased_until=None)
+
+
+class SQLiteQueue:
+    '''
+    Shard queue in a SQLite database, for workers on one machine or sharing a file system which supports locking.
+    A shard is claimed in a write transaction, so that every shard goes to one worker.
+    '''
+    def __init__(self, path, max_attempts=SHARD_MAX_ATTEMPTS, lease_seconds=SHARD_LEASE_SECONDS):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.spec = "sqlite:" + path
+        self.max_attempts = max_attempts
+        self.lease_seconds = lease_seconds
+        self.db = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS shards (shard INTEGER PRIMARY KEY, task TEXT, state TEXT, leased_until REAL)")
+        self._lock = threading.Lock()
+
+    def _update(self, task):
+        self.db.execute(
+            "UPDATE shards SET task = ?, state = ?, leased_until = ? WHERE shard = ?",
+            (json.dumps(task), task["state"], task.get("leased_until"), task["shard"])
+        )
+
+    def clear(self):
+        with self._lock:
+            self.db.execute("DELETE FROM shards")
+
+    def put(self, tasks):
+        with self._lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            self.db.executemany(
+                "INSERT OR REPLACE INTO shards (shard, task, state, leased_until) VALUES (?, ?, 'pending', NULL)",
+                [(t["shard"], json.dumps(dict(t, state="pending"))) for t in tasks]
+            )
+            self.db.execute("COMMIT")
+
+    def get(self, worker):
+        '''
+        Claim a pending shard, or one whose lease expired, None if there is none
+        '''
+        with self._lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                now = time.time()
+                for (task,) in self.db.execute(
+                    "SELECT task FROM shards WHERE state = 'running' AND leased_until < ? ORDER BY shard", (now,)
+                ).fetchall():
+                    task = json.loads(task)
+                    self._update(after_failure(task, "lease expired on {}".format(task["worker"]), self.max_attempts))
+                row = self.db.execute("SELECT task FROM shards WHERE state = 'pending' ORDER BY shard LIMIT 1").fetchone()
+                task = None
+                if row is not None:
+                    task = lease(json.loads(row[0]), worker, self.lease_seconds)
+                    self._update(task)
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+        return task
+
+    def _finish(self, task, change):
+        with self._lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            row = self.db.execute("SELECT task FROM shards WHERE shard = ?", (task["shard"],)).fetchone()
+            current = json.loads(row[0]) if row else None
+            # a worker whose lease expired doesn't overwrite the shard's new owner
+            if current is not None and current["state"] == "running" and current["worker"] == task["worker"]:
+                self._update(change(current))
+            self.db.execute("COMMIT")
+
+    def complete(self, task):
+        self._finish(task, lambda t: dict(t, state="done", worker=None, leased_until=None, error=None))
+
+    def fail(self, task, error):
+        self._finish(task, lambda t: after_failure(t, error, self.max_attempts))
+
+    def renew(self, task):
+        self._finish(task, lambda t: renewed(t, self.lease_seconds))
+
+    def status(self):
+        '''
+        Shard -> task, with its state (pending, running, done, failed), attempts and last error
+        '''
+        with self._lock:
+            return {shard: json.loads(task) for shard, task in self.db.execute("SELECT shard, task FROM shards ORDER BY shard")}
+
+
+class FileQueue:
+    '''
+    Shard queue of JSON files in pending/, running/, done/ and failed/ directories, for workers sharing a file
+    system without reliable locking. A shard is claimed by renaming its file, which only one worker can do.
+    '''
+    STATES = ("pending", "running", "done", "failed")
+
+    def __init__(self, directory, max_attempts=SHARD_MAX_ATTEMPTS, lease_seconds=SHARD_LEASE_SECONDS):
+        self.directory = directory
+        self.spec = "file:" + directory
+        self.max_attempts = max_attempts
+        self.lease_seconds = lease_seconds
+        for state in self.STATES:
+            os.makedirs(os.path.join(directory, state), exist_ok=True)
+
+    def _path(self, state, shard):
+        return os.path.join(self.directory, state, "{:08d}.json".format(shard))
+
+    def _write(self, task, state=None):
+        # write next to the target and rename, so that a reader never sees a partial file
+        path = self._path(state or task["state"], task["shard"])
+        tmp = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp, "w") as f:
+            json.dump(task, f)
+        os.replace(tmp, path)
+
+    def _read(self, path):
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _move(self, task, source, target):
+        '''
+        Move a task file to another state, False if another worker moved it first
+        '''
+        claimed = "{}.{}.claim".format(self._path(source, task["shard"]), os.getpid())
+        try:
+            os.rename(self._path(source, task["shard"]), claimed)
+        except FileNotFoundError:
+            return False
+        self._write(dict(task, state=target))
+        os.remove(claimed)
+        return True
+
+    def clear(self):
+        for state in self.STATES:
+            shutil.rmtree(os.path.join(self.directory, state), ignore_errors=True)
+            os.makedirs(os.path.join(self.directory, state), exist_ok=True)
+
+    def put(self, tasks):
+        for task in tasks:
+            self._write(dict(task, state="pending"))
+
+    def get(self, worker):
+        now = time.time()
+        for path in sorted(glob.glob(os.path.join(self.directory, "running", "*.json"))):
+            task = self._read(path)
+            if task is not None and task["leased_until"] < now:
+                failed = after_failure(task, "lease expired on {}".format(task["worker"]), self.max_attempts)
+                self._move(failed, "running", failed["state"])
+        for path in sorted(glob.glob(os.path.join(self.directory, "pending", "*.json"))):
+            task = self._read(path)
+            if task is None:
+                continue
+            task = lease(task, worker, self.lease_seconds)
+            if self._move(task, "pending", "running"):
+                return task
+        return None
+
+    def _finish(self, task, change):
+        current = self._read(self._path("running", task["shard"]))
+        if current is not None and current["worker"] == task["worker"]:
+            changed = change(current)
+            self._move(changed, "running", changed["state"])
+
+    def complete(self, task):
+        self._finish(task, lambda t: dict(t, state="done", worker=None, leased_until=None, error=None))
+
+    def fail(self, task, error):
+        self._finish(task, lambda t: after_failure(t, error, self.max_attempts))
+
+    def renew(self, task):
+        self._finish(task, lambda t: renewed(t, self.lease_seconds))
+
+    def status(self):
+        tasks = {}
+        for state in self.STATES:
+            for path in glob.glob(os.path.join(self.directory, state, "*.json")):
+                task = self._read(path)
+                if task is not None:
+                    tasks[task["shard"]] = dict(task, state=state)
+        return dict(sorted(tasks.items()))
+
+
+class LocalRedis:
+    '''
+    In-process stand-in for the few Redis commands RedisQueue uses, to run without a Redis server.
+    Only workers in the same process (threads) share it.
+    '''
+    def __init__(self):
+        self.hashes = {}
+        self.lists = {}
+        self._lock = threading.Lock()
+
+    def hset(self, name, key, value):
+        with self._lock:
+            self.hashes.setdefault(name, {})[key] = value
+
+    def hget(self, name, key):
+        with self._lock:
+            return self.hashes.get(name, {}).get(key)
+
+    def hgetall(self, name):
+        with self._lock:
+            return dict(self.hashes.get(name, {}))
+
+    def lpush(self, name, *values):
+        with self._lock:
+            self.lists.setdefault(name, [])[:0] = reversed(values)
+
+    def rpop(self, name):
+        with self._lock:
+            values = self.lists.get(name)
+            return values.pop() if values else None
+
+    def delete(self, *names):
+        with self._lock:
+            for name in names:
+                self.hashes.pop(name, None)
+                self.lists.pop(name, None)
+
+
+class RedisQueue:
+    '''
+    Shard queue in Redis, for workers on several machines: a list of pending shards and a hash of the tasks.
+    Takes a redis client (redis.Redis.from_url(url) when a URL is given) or a LocalRedis stand-in.
+    '''
+    def __init__(self, client=None, url=None, prefix="factlens:shards", max_attempts=SHARD_MAX_ATTEMPTS,
+                 lease_seconds=SHARD_LEASE_SECONDS):
+        if client is None:
+            try:
+                import redis
+            except ImportError:
+                raise ImportError("the redis package is needed for a Redis queue, use a SQLite or file queue instead")
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self.spec = url if url else None # a stand-in can't be reached from other processes
+        self.tasks_key = prefix + ":tasks"
+        self.pending_key = prefix + ":pending"
+        self.max_attempts = max_attempts
+        self.lease_seconds = lease_seconds
+
+    def _task(self, shard):
+        value = self.client.hget(self.tasks_key, shard)
+        return json.loads(value) if value is not None else None
+
+    def _set(self, task):
+        self.client.hset(self.tasks_key, str(task["shard"]), json.dumps(task))
+
+    def clear(self):
+        self.client.delete(self.tasks_key, self.pending_key)
+
+    def put(self, tasks):
+        for task in tasks:
+            self._set(dict(task, state="pending"))
+            self.client.lpush(self.pending_key, str(task["shard"]))
+
+    def get(self, worker):
+        now = time.time()
+        for task in self.status().values():
+            if task["state"] == "running" and task["leased_until"] < now:
+                failed = after_failure(task, "lease expired on {}".format(task["worker"]), self.max_attempts)
+                self._set(failed)
+                if failed["state"] == "pending":
+                    self.client.lpush(self.pending_key, str(task["shard"]))
+        while True:
+            shard = self.client.rpop(self.pending_key) # atomic, every shard id is popped by one worker
+            if shard is None:
+                return None
+            task = self._task(shard.decode() if isinstance(shard, bytes) else shard)
+            if task is not None and task["state"] == "pending":
+                task = lease(task, worker, self.lease_seconds)
+                self._set(task)
+                return task
+
+    def _finish(self, task, change):
+        current = self._task(str(task["shard"]))
+        if current is not None and current["state"] == "running" and current["worker"] == task["worker"]:
+            changed = change(current)
+            self._set(changed)
+            if changed["state"] == "pending":
+                self.client.lpush(self.pending_key, str(task["shard"]))
+
+    def complete(self, task):
+        self._finish(task, lambda t: dict(t, state="done", worker=None, leased_until=None, error=None))
+
+    def fail(self, task, error):
+        self._finish(task, lambda t: after_failure(t, error, self.max_attempts))
+
+    def renew(self, task):
+        self._finish(task, lambda t: renewed(t, self.lease_seconds))
+
+    def status(self):
+        tasks = {int(k): json.loads(v) for k, v in self.client.hgetall(self.tasks_key).items()}
+        return dict(sorted(tasks.items()))
+
+
+def open_queue(spec=SHARD_QUEUE):
+    '''
+    Queue from its spec: 'sqlite:PATH', 'file:DIRECTORY', 'redis://...' or 'local-redis'
+    '''
+    if spec.startswith("sqlite:"):
+        return SQLiteQueue(spec[len("sqlite:"):])
+    if spec.startswith("file:"):
+        return FileQueue(spec[len("file:"):])
+    if spec.startswith(("redis://", "rediss://", "unix://")):
+        return RedisQueue(url=spec)
+    if spec == "local-redis":
+        return RedisQueue(LocalRedis())
+    raise ValueError("unknown shard queue {!r}".format(spec))
+
+
+def write_atomic(data, path):
+    '''
+    Write a dataset next to its path and rename it, so that a shard file is either complete or missing
+    '''
+    root, extension = os.path.splitext(path)
+    tmp = "{}.{}.tmp{}".format(root, os.getpid(), extension) # the extension selects the format
+    write_dataset(data, tmp)
+    os.replace(tmp, path)
+
+
+def partition(input_path, shard_dir, shard_size=SHARD_SIZE):
+    '''
+    Split a dataset into JSONL shards of shard_size rows, every row keeps its input row number in "_row".
+    Shards which already exist are kept, so that an interrupted run resumes with the same shards. The shard size is
+    recorded in shards.json, ValueError if the existing shards have another size.
+    '''
+    os.makedirs(shard_dir, exist_ok=True)
+    meta_path = os.path.join(shard_dir, "shards.json")
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            size = json.load(f)["shard_size"]
+        if size != shard_size:
+            raise ValueError("{} holds shards of {} rows, not {}: resume with the same shard size or remove it".format(
+                shard_dir, size, shard_size
+            ))
+    else:
+        with open(meta_path + ".tmp", "w") as f:
+            json.dump({"shard_size": shard_size}, f)
+        os.replace(meta_path + ".tmp", meta_path)
+    paths = []
+    for i, chunk in enumerate(read_chunks(input_path, shard_size)):
+        path = os.path.join(shard_dir, "input-{:05d}.jsonl".format(i))
+        if not os.path.exists(path):
+            chunk = chunk.copy()
+            chunk.insert(0, "_row", chunk.index)
+            write_atomic(chunk, path)
+        paths.append(path)
+    return paths
+
+
+def merge(paths, output_path):
+    '''
+    Reassemble shard outputs in the original row order, whatever order the shards finished in
+    '''
+    import pandas as pd
+    data = pd.concat([read_dataset(path) for path in paths], ignore_index=True)
+    data = data.sort_values("_row", kind="stable").set_index("_row")
+    data.index.name = None
+    write_dataset(data, output_path)
+    return data
+
+
+class Worker:
+    '''
+    Takes shards from the queue and runs their stage on them until no shard is left.
+    Stages are created once per worker, so that their models are loaded once. The lease of a shard is renewed
+    while its stage runs, so that only a worker which stopped loses its shard to another worker.
+    '''
+    def __init__(self, queue, worker_id=None):
+        self.queue = queue
+        self.worker_id = worker_id or default_worker_id()
+        self.stages = {}
+
+    def stage(self, name, options):
+        k = (name, json.dumps(options, sort_keys=True))
+        if k not in self.stages:
+            module, cls = STAGES[name]
+            self.stages[k] = getattr(importlib.import_module(module), cls)(**options)
+        return self.stages[k]
+
+    @contextlib.contextmanager
+    def heartbeat(self, task):
+        '''
+        Renew the lease of a task every third of the lease until the block exits
+        '''
+        stop = threading.Event()
+
+        def renew():
+            while not stop.wait(self.queue.lease_seconds/3):
+                try:
+                    self.queue.renew(task)
+                except Exception: # a missed renewal is retried at the next beat
+                    pass
+        thread = threading.Thread(target=renew, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+    def run_task(self, task):
+        data = read_dataset(task["input"])
+        data.index = data.pop("_row").tolist()
+        data = self.stage(task["stage"], task.get("options") or {}).process(data)
+        data.insert(0, "_row", data.index)
+        write_atomic(data, task["output"])
+
+    def run(self, idle_timeout=0, poll=1.0):
+        '''
+        Process shards until none is pending or running (and none appeared for idle_timeout seconds)
+        '''
+        idle_since = time.monotonic()
+        try:
+            while True:
+                task = self.queue.get(self.worker_id)
+                if task is None:
+                    active = any(t["state"] in ("pending", "running") for t in self.queue.status().values())
+                    if not active and time.monotonic() - idle_since >= idle_timeout:
+                        return
+                    time.sleep(poll)
+                    continue
+                try:
+                    with self.heartbeat(task):
+                        self.run_task(task)
+                except Exception as e:
+                    self.queue.fail(task, "{}: {}".format(type(e).__name__, e))
+                else:
+                    self.queue.complete(task)
+                idle_since = time.monotonic()
+        finally:
+            for stage in self.stages.values():
+                if hasattr(stage, "close"):
+                    stage.close()
+
+
+def run_sharded(stage, input_path, output_path, queue=None, shard_size=SHARD_SIZE, shard_dir=None, workers=0,
+                options=None, poll=1.0):
+    '''
+    Coordinator: partition the input into shards, queue the shards which have no output yet, run them on workers
+    and merge the shard outputs into output_path in the original row order.
+    workers local worker processes are started, with 0 the shards run in this process. Workers on other machines
+    can join with `python src/sharding.py worker --queue ...`.
+    Raises ShardsFailed if shards still failed after their retries, a new run then only redoes the missing shards.
+    '''
+    from tqdm import tqdm
+    queue = queue or open_queue()
+    shard_dir = shard_dir or output_path + ".shards"
+    inputs = partition(input_path, shard_dir, shard_size)
+    outputs = [os.path.join(shard_dir, "output-{:05d}.jsonl".format(i)) for i in range(len(inputs))]
+    queue.clear()
+    queue.put([
+        {"shard": i, "stage": stage, "input": os.path.abspath(inputs[i]), "output": os.path.abspath(outputs[i]), "options": options or {}}
+        for i in range(len(inputs)) if not os.path.exists(outputs[i])
+    ])
+
+    queued = len(queue.status())
+
+    if workers:
+        if queue.spec is None:
+            raise ValueError("worker processes can't reach an in-process queue, use workers=0")
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join([ROOT, os.path.join(ROOT, "src"), os.environ.get("PYTHONPATH", "")]))
+        processes = [
+            subprocess.Popen([sys.executable, os.path.abspath(__file__), "worker", "--queue", queue.spec], env=env, cwd=ROOT)
+            for _ in range(workers)
+        ]
+        alive = lambda: any(p.poll() is None for p in processes)
+    else:
+        thread = threading.Thread(target=Worker(queue, "coordinator").run, kwargs={"poll": poll}, daemon=True)
+        thread.start()
+        processes = []
+        alive = thread.is_alive
+
+    # per-shard progress, failed attempts are reported as they happen
+    finished = set()
+    failures = {}
+    with tqdm(total=len(inputs), initial=len(inputs) - queued, unit="shard") as progress:
+        while True:
+            # read before the status, so that workers which exited after finishing the last shards aren't an error
+            running = alive()
+            status = queue.status()
+            for shard, task in status.items():
+                if task.get("failures", 0) > failures.get(shard, 0):
+                    failures[shard] = task["failures"]
+                    tqdm.write("shard {} failed {} time(s), {}: {}".format(
+                        shard, task["failures"], "giving up" if task["state"] == "failed" else "retrying", task["error"]
+                    ))
+                if task["state"] in ("done", "failed") and shard not in finished:
+                    finished.add(shard)
+                    progress.update(1)
+            states = [t["state"] for t in status.values()]
+            progress.set_postfix(running=states.count("running"), failed=states.count("failed"))
+            if len(states) == queued and all(s in ("done", "failed") for s in states):
+                break
+            if not running:
+                raise RuntimeError("the workers exited with shards left")
+            time.sleep(poll)
+    for p in processes:
+        p.wait()
+
+    failed = {shard: t["error"] for shard, t in queue.status().items() if t["state"] == "failed"}
+    if failed:
+        raise ShardsFailed(failed)
+    return merge(outputs, output_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a FactLens stage over a dataset in shards")
+    commands = parser.add_subparsers(dest="command", required=True)
+    coordinate = commands.add_parser("coordinate", help="partition the input, run the shards and merge the outputs")
+    coordinate.add_argument("--stage", choices=sorted(STAGES), required=True)
+    coordinate.add_argument("--input", required=True)
+    coordinate.add_argument("--output", required=True)
+    coordinate.add_argument("--queue", default=SHARD_QUEUE)
+    coordinate.add_argument("--shard-size", type=int, default=SHARD_SIZE)
+    coordinate.add_argument("--shard-dir", default=None, help="shared directory of the shards, <output>.shards by default")
+    coordinate.add_argument("--workers", type=int, default=0, help="local worker processes, 0 to run the shards in this process")
+    coordinate.add_argument("--options", default="{}", help="JSON keyword arguments of the stage, e.g. '{\"single_pass\": true}'")
+    worker = commands.add_parser("worker", help="process shards from a queue")
+    worker.add_argument("--queue", default=SHARD_QUEUE)
+    worker.add_argument("--idle-timeout", type=float, default=0, help="seconds to wait for shards when the queue is empty")
+    args = parser.parse_args()
+
+    if args.command == "worker":
+        Worker(open_queue(args.queue)).run(args.idle_timeout)
+        return
+    run_sharded(
+        args.stage, args.input, args.output, open_queue(args.queue), args.shard_size, args.shard_dir, args.workers,
+        json.loads(args.options)
+    )
+
+if __name__ == '__main__':
+    main()
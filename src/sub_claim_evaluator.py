@@ -1,20 +1,33 @@
-import ast
+import argparse
+import asyncio
+import json
 import os
-import pandas as pd
 from prompts import (ATOMICITY_EVALUATION, COLLECTIVE_SUB_CLAIM_EVALUATION,
-                     INDIVIDUAL_SUB_CLAIM_EVALUATION)
+                     INDIVIDUAL_SUB_CLAIM_EVALUATION,
+                     MULTI_METRIC_SUB_CLAIM_EVALUATION)
 
 from config import MODEL_NAME
-from src.open_ai import OpenAI
-from tqdm import tqdm
+from src.dataset_io import (as_list, read_dataset, require_list, run_streaming,
+                            streaming_output, write_dataset)
+from src.dedup import DedupStats, SharedResults, UniqueTable, key
+from src.incremental import fingerprint, get_cell_store, source
+from src.instrumentation import labels
+from src.open_ai import AsyncOpenAI
+from src.resilience import ParseError, gather_rows, parse_json
 
 class SubClaimEvaluator:
     '''
     Evaluate decomposed sub-claims using LLMs
     '''
-    def __init__(self):
+    def __init__(self, single_pass=False, incremental=False, dedup=False, cache=None):
+        self.single_pass = single_pass # judge all sub-claim level metrics of a row in one request
+        self.store = get_cell_store() if incremental else None # only evaluate the row x metric cells which changed
+        self.dedup = DedupStats() if dedup else None # evaluate every unique row and (claim, sub-claim) cell once
+        self._cells = None
+        self.judge_model = "gpt-4o-mini"
+        self.usage = {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0}
         self.model_name = MODEL_NAME
-        self.model = OpenAI(os.environ['OPENAI_API_KEY'], os.environ['OPENAI_ORGANIZATION'])
+        self.async_model = AsyncOpenAI(os.environ.get('OPENAI_API_KEY', ''), os.environ.get('OPENAI_ORGANIZATION', ''), cache=cache, stage="llm_evaluator")
         self.subclaim_level_metrics = [
             "atomicity",
             "sufficiency",
@@ -35,71 +48,259 @@ class SubClaimEvaluator:
         }
     
     def set_data(self, path):
-        self.data = pd.read_csv(path)
+        self.data = read_dataset(path)
 
     def set_output_file(self, path):
         self.output_file = path
 
+    async def evaluate(self, claim, sub_claim, metrics, prompt_template, metric=None):
+        user_prompt = prompt_template.format(metrics = metrics, claim = claim, sub_claims = sub_claim)
+        model_config = {
+            "model": self.judge_model,
+            "messages": [
+                {
+                    "role": "system",
+                    "content": "You are a fair evaluator. No additional commentary whatsoever."
+                },
+                {
+                    "role": "user",
+                    "content": user_prompt
+                }
+            ],
+            "temperature": 0,
+            # "response_format": { "type": "json_object" }
+        }
+        with labels(metric=metric):
+            response = await self.async_model.call(model_config)
+        self.track_usage(response)
+        content = response.choices[0]["message"]["content"]
+        return content.strip().lower()
+
+    def track_usage(self, response):
+        self.usage["calls"] += 1
+        usage = response.get("usage") or {}
+        self.usage["prompt_tokens"] += usage.get("prompt_tokens", 0)
+        self.usage["completion_tokens"] += usage.get("completion_tokens", 0)
+
+    def labels(self, m):
+        return ["atomic", "non-atomic-1", "non-atomic-2"] if m == "atomicity" else ["low", "medium", "high"]
+
+    async def evaluate_jointly(self, claim, sub_claims, metrics=None):
+        '''
+        Judge all sub-claim level metrics (or the given ones) for all sub-claims of a claim in one JSON request.
+        Returns metric -> list of labels, None for every cell missing from the answer or with an invalid label.
+        '''
+        subclaim_level_metrics = metrics or self.subclaim_level_metrics
+        metrics = "\n".join(
+            "- {}: {} Labels: {}".format(m, self.metrics[m], ", ".join('\"{}\"'.format(l) for l in self.labels(m)))
+            for m in subclaim_level_metrics
+        )
+        numbered = json.dumps({str(i + 1): c for i, c in enumerate(sub_claims)}, indent=2, ensure_ascii=False)
+        user_prompt = MULTI_METRIC_SUB_CLAIM_EVALUATION.format(metrics = metrics, claim = claim, sub_claims = numbered)
+        model_config = {
+            "model": self.judge_model,
+            "messages": [
+                {
+                    "role": "system",
+                    "content": "You are a fair evaluator. No additional commentary whatsoever. Your answer should strictly be a JSON dictionary keyed by sub-claim id."
+                },
+                {
+                    "role": "user",
+                    "content": user_prompt
+                }
+            ],
+            "temperature": 0,
+            "response_format": { "type": "json_object" }
+        }
+        with labels(metric="multi_metric"):
+            response = await self.async_model.call(model_config)
+        self.track_usage(response)
+        try:
+            content = parse_json(response.choices[0]["message"]["content"])
+        except ParseError:
+            content = {}
+        if not isinstance(content, dict):
+            content = {}
+
+        judgements = {m: [] for m in subclaim_level_metrics}
+        for i in range(len(sub_claims)):
+            cells = content.get(str(i + 1))
+            cells = cells if isinstance(cells, dict) else {}
+            for m in subclaim_level_metrics:
+                label = cells.get(m)
+                label = label.strip().lower() if isinstance(label, str) else None
+                judgements[m].append(label if label in self.labels(m) else None)
+        return judgements
+
+    async def evaluate_row(self, claim, sub_claims, metrics=None):
+        '''
+        Evaluate the sub-claims of one claim on all metrics (or the given ones), all metrics are requested concurrently
+        '''
+        sub_claims = require_list(sub_claims, "sub_claims")
+        claim_level_metrics = [m for m in self.claim_level_metrics if metrics is None or m in metrics]
+        subclaim_level_metrics = [m for m in self.subclaim_level_metrics if metrics is None or m in metrics]
+        scores = {}
+        claim_level_scores = await asyncio.gather(*[
+            self.evaluate(claim, sub_claims, self.metrics[m], COLLECTIVE_SUB_CLAIM_EVALUATION, m)
+            for m in claim_level_metrics
+        ])
+        for m, claim_level_score in zip(claim_level_metrics, claim_level_scores):
+            scores[m] = claim_level_score
+
+        def evaluate_cell(m, sub_claim):
+            args = (claim, sub_claim, self.metrics[m], ATOMICITY_EVALUATION if m == "atomicity" else INDIVIDUAL_SUB_CLAIM_EVALUATION, m)
+            if self._cells is not None:
+                # the same sub-claim of the same claim recurs across rows
+                return self._cells.get(key((m, claim, sub_claim)), self.evaluate, *args)
+            return self.evaluate(*args)
+
+        if self.single_pass and sub_claims and subclaim_level_metrics:
+            judgements = await self.evaluate_jointly(claim, sub_claims, subclaim_level_metrics)
+            # retry only the cells the joint answer is missing, with the per-metric prompt
+            missing = [(m, i) for m in subclaim_level_metrics for i, label in enumerate(judgements[m]) if label is None]
+            retried = await asyncio.gather(*[evaluate_cell(m, sub_claims[i]) for m, i in missing])
+            for (m, i), label in zip(missing, retried):
+                judgements[m][i] = label
+            sub_claim_level_scores = [judgements[m] for m in subclaim_level_metrics]
+        else:
+            sub_claim_level_scores = await asyncio.gather(*[
+                asyncio.gather(*[evaluate_cell(m, sub_claim) for sub_claim in sub_claims])
+                for m in subclaim_level_metrics
+            ])
+        for m, fine_grained_scores in zip(subclaim_level_metrics, sub_claim_level_scores):
+            score = 0
+            for sub_claim_score in fine_grained_scores:
+                if m == "atomicity":
+                    score += 3 if sub_claim_score == "atomic" else 2 if sub_claim_score == "non-atomic-1" else 1
+                else:
+                    score += 3 if sub_claim_score == "high" else 2 if sub_claim_score == "medium" else 1
+            try:
+                scores[m] = score/len(sub_claims)
+                scores['{}_fine_grained'.format(m)] = list(fine_grained_scores)
+            except ZeroDivisionError:
+                scores[m] = 0
+        return scores
+
+    async def evaluate_all(self, claims, sub_claims, rows=None, metrics=None):
+        '''
+        Evaluate all rows concurrently, results are returned in row order (None for a failed row).
+        metrics optionally lists the metrics to evaluate for each row.
+        '''
+        rows = range(len(claims)) if rows is None else rows
+        metrics = [None]*len(claims) if metrics is None else metrics
+        inputs = [{"claim": c, "sub_claims": s} for c, s in zip(claims, sub_claims)]
+        self._cells = SharedResults() if self.dedup is not None else None
+        try:
+            return await gather_rows("llm_evaluator", rows, inputs, [self.evaluate_row(c, s, m) for c, s, m in zip(claims, sub_claims, metrics)])
+        finally:
+            if self._cells is not None:
+                self.dedup.add("sub_claim_cells", self._cells.requests, len(self._cells.tasks))
+                self._cells = None
+
+    def cell_key(self, claim, sub_claims, m):
+        '''
+        Fingerprint of everything the score of metric m for a row depends on: the claim and sub-claims, the metric
+        definition and labels, the prompts, the model, the mode and the scoring code (whose requests carry the
+        system prompts)
+        '''
+        joint = self.single_pass and m in self.subclaim_level_metrics
+        if m in self.claim_level_metrics:
+            prompts = [COLLECTIVE_SUB_CLAIM_EVALUATION]
+        else:
+            prompts = [ATOMICITY_EVALUATION if m == "atomicity" else INDIVIDUAL_SUB_CLAIM_EVALUATION]
+            if joint:
+                prompts.append(MULTI_METRIC_SUB_CLAIM_EVALUATION)
+        return fingerprint(
+            "llm_evaluator", claim, sub_claims, m, self.metrics[m], self.labels(m), prompts, self.judge_model, joint,
+            [source(f) for f in (type(self).evaluate_row, type(self).evaluate, type(self).evaluate_jointly)]
+        )
+
+    def evaluate_incremental(self, claims, sub_claims, rows):
+        '''
+        Scores of all rows, only the row x metric cells which are not in the cell store are evaluated
+        '''
+        metrics = self.claim_level_metrics + self.subclaim_level_metrics
+        keys = [{m: self.cell_key(c, s, m) for m in metrics} for c, s in zip(claims, sub_claims)]
+        stored = self.store.get_many(k for row_keys in keys for k in row_keys.values())
+        stale = [[m for m in metrics if row_keys[m] not in stored] for row_keys in keys]
+        for m in metrics:
+            recomputed = sum(m in row_stale for row_stale in stale)
+            self.store.count("llm_evaluator/" + m, len(claims) - recomputed, recomputed)
+
+        todo = [i for i, row_stale in enumerate(stale) if row_stale]
+        evaluated = asyncio.run(self.evaluate_all(
+            [claims[i] for i in todo], [sub_claims[i] for i in todo], [rows[i] for i in todo], [stale[i] for i in todo]
+        ))
+        failed = set()
+        new_cells = []
+        for i, scores in zip(todo, evaluated):
+            if scores is None:
+                failed.add(i)
+                continue
+            for m in stale[i]:
+                cell = {k: scores[k] for k in (m, '{}_fine_grained'.format(m)) if k in scores}
+                stored[keys[i][m]] = cell
+                new_cells.append((keys[i][m], cell))
+        self.store.put_many(new_cells)
+        return [
+            None if i in failed else {k: v for m in metrics for k, v in stored[row_keys[m]].items()}
+            for i, row_keys in enumerate(keys)
+        ]
+
+    def process(self, data):
+        '''
+        Add the LLM evaluation scores of every row to a dataframe
+        '''
+        claims = data['claim'].tolist()
+        sub_claims = [as_list(s) for s in data['sub_claims']]
+        rows = data.index.tolist()
+        if self.dedup is not None:
+            table = UniqueTable(list(zip(claims, sub_claims)))
+            self.dedup.add("rows", len(claims), len(table))
+            claims, sub_claims, rows = [c for c, _ in table.items], [s for _, s in table.items], table.column(rows)
+        if self.store is not None:
+            scores = self.evaluate_incremental(claims, sub_claims, rows)
+        else:
+            scores = asyncio.run(self.evaluate_all(claims, sub_claims, rows))
+        data['llm_evaluation_scores'] = table.broadcast(scores) if self.dedup is not None else scores
+        return data
+
+    def compare_token_usage(self, data):
+        '''
+        Evaluate the rows once per mode and report the calls and tokens of the single-pass mode against the per-metric mode
+        '''
+        report = {}
+        for mode in ["per_metric", "single_pass"]:
+            # every mode pays for its calls, neither the response cache nor the cell store answers them
+            evaluator = SubClaimEvaluator(single_pass=mode == "single_pass", dedup=self.dedup is not None, cache=False)
+            evaluator.process(data.copy())
+            report[mode] = dict(evaluator.usage)
+
+        for k in ["calls", "prompt_tokens", "completion_tokens"]:
+            report["{}_reduction".format(k)] = 1 - report["single_pass"][k]/report["per_metric"][k] if report["per_metric"][k] else 0
+        return report
+
     def evaluate_sub_claims(self):
         '''
         Evaluate sub-claims using LLMs. 
         '''
-        def evaluate(claim, sub_claim, metrics, prompt_template):
-            user_prompt = prompt_template.format(metrics = metrics, claim = claim, sub_claims = sub_claim)
-            model_config = {
-                "model": "gpt-4o-mini",
-                "messages": [
-                    {
-                        "role": "system",
-                        "content": "You are a fair evaluator. No additional commentary whatsoever."
-                    },
-                    {
-                        "role": "user",
-                        "content": user_prompt
-                    }
-                ],
-                "temperature": 0,
-                # "response_format": { "type": "json_object" }
-            }
-            response = self.model.call(model_config)
-            content = response.choices[0]["message"]["content"]
-            return content.strip().lower()
-        
-        data = self.data
-        llm_evaluation_scores = []
-        for _, row in tqdm(data.iterrows(), total=len(data)):
-            scores = {}
-            claim = row['claim']
-            sub_claims = ast.literal_eval(row['sub_claims'])
-
-            for m in self.claim_level_metrics:
-                scores[m] = evaluate(claim, sub_claims, self.metrics[m], COLLECTIVE_SUB_CLAIM_EVALUATION)
-
-            for m in self.subclaim_level_metrics:
-                score = 0
-                fine_grained_scores = []
-                prompt_template = ATOMICITY_EVALUATION if m == "atomicity" else INDIVIDUAL_SUB_CLAIM_EVALUATION
-                for sub_claim in sub_claims:
-                    sub_claim_score = evaluate(claim, sub_claim, self.metrics[m], prompt_template)
-                    fine_grained_scores.append(sub_claim_score)
-                    if m == "atomicity":
-                        score += 3 if sub_claim_score == "atomic" else 2 if sub_claim_score == "non-atomic-1" else 1
-                    else:
-                        score += 3 if sub_claim_score == "high" else 2 if sub_claim_score == "medium" else 1
-                try:
-                    scores[m] = score/len(sub_claims)
-                    scores['{}_fine_grained'.format(m)] = fine_grained_scores
-                except:
-                    scores[m] = 0
-            llm_evaluation_scores.append(scores)
-
-        data['llm_evaluation_scores'] = llm_evaluation_scores
-        data.to_csv(self.output_file, index=False)
+        data = self.process(self.data)
+        write_dataset(data, self.output_file)
 
 def main():
+    parser = argparse.ArgumentParser(description="Evaluate sub-claims with an LLM judge")
+    parser.add_argument("--input", default='data/sub_claims.csv')
+    parser.add_argument("--output", default='data/llm_evaluation.csv')
+    parser.add_argument("--streaming", action="store_true",
+                        help="process the input in chunks, checkpoint the finished rows to the output as JSONL and resume an interrupted run")
+    parser.add_argument("--chunksize", type=int, default=100, help="rows per chunk with --streaming")
+    args = parser.parse_args()
     sub_claim_evaluator = SubClaimEvaluator()
-    sub_claim_evaluator.set_data('data/sub_claims.csv') # set data
-    sub_claim_evaluator.set_output_file('data/llm_evaluation.csv') # set output file
+    if args.streaming:
+        run_streaming(sub_claim_evaluator.process, args.input, streaming_output(args.output), args.chunksize, "llm_evaluation_scores")
+        return
+    sub_claim_evaluator.set_data(args.input) # set data
+    sub_claim_evaluator.set_output_file(args.output) # set output file
     sub_claim_evaluator.evaluate_sub_claims()
 
 if __name__ == '__main__':
@@ -1,24 +1,43 @@
-import json
+import argparse
+import asyncio
 import os
 import random
+import zlib
 
-import pandas as pd
-from config import MODEL_NAME
+from config import DEMONSTRATION_PERMUTATIONS, DEMONSTRATION_SEED, MODEL_NAME
 from prompts import DEMONSTRATIONS, SUB_CLAIM_GENERATOR_PROMPT
-from tqdm import tqdm
 
-from src.open_ai import OpenAI
+from src.claim_router import get_atomic_router, is_atomic_decomposition
+from src.dataset_io import (read_dataset, run_streaming, streaming_output,
+                            write_dataset)
+from src.dedup import DedupStats, UniqueTable
+from src.open_ai import AsyncOpenAI
+from src.resilience import gather_rows
+
+def check_sub_claims(content):
+    '''
+    List of sub-claims of an answer, ValueError if there is none
+    '''
+    if not isinstance(content, dict) or not isinstance(content.get("sub_claims"), list):
+        raise ValueError("expected a dictionary with a list of sub_claims")
+    return content["sub_claims"]
 
 class SubClaimGenerator:
     '''
     Decompose claim into sub-claims
     '''
-    def __init__(self):
+    def __init__(self, stable_prefix=False, dedup=False, route_atomic=False):
+        self.stable_prefix = stable_prefix # draw demonstrations from a fixed set of orders, so that rows share prompt prefixes
+        self.dedup = DedupStats() if dedup else None # decompose every unique claim once and share its sub-claims
+        self.router = get_atomic_router() if route_atomic else None # pass claims classified atomic through without a model call
+        self.claims = 0 # claims decomposed or routed
+        self.routed = 0 # claims passed through as their own sub-claim
+        self.permutations = self.demonstration_permutations()
         self.model_name = MODEL_NAME
-        self.model = OpenAI(os.environ['OPENAI_API_KEY'], os.environ['OPENAI_ORGANIZATION'])
+        self.async_model = AsyncOpenAI(os.environ.get('OPENAI_API_KEY', ''), os.environ.get('OPENAI_ORGANIZATION', ''), stage="generator")
     
     def set_data(self, path):
-        self.data = pd.read_csv(path)
+        self.data = read_dataset(path)
 
     def set_output_file(self, path):
         self.output_file = path
@@ -32,49 +51,123 @@ class SubClaimGenerator:
         random.shuffle(demonstrations)
         return "\n\n".join(demonstrations)
 
-    def generate_sub_claims(self):
+    def demonstration_permutations(self, n=DEMONSTRATION_PERMUTATIONS, seed=DEMONSTRATION_SEED):
         '''
-        Decompose sub-claims using few-shot prompting method. 
+        Fixed, seeded set of n demonstration orders, each picking 3 of the 4 expert-curated decompositions
+        '''
+        rng = random.Random(seed)
+        return ["\n\n".join(rng.sample(DEMONSTRATIONS, 3)) for _ in range(n)]
+
+    def stable_demonstrations(self, claim):
         '''
-        sub_claims = []
-        data = self.data
-
-        for _, row in tqdm(data.iterrows(), total=len(data)):
-            claim = row['claim']
-            demonstrations = self.shuffle_demonstrations()
-            
-            user_prompt = SUB_CLAIM_GENERATOR_PROMPT.format(demonstrations=demonstrations, claim=claim)  
-
-            model_config = {
-                "model": MODEL_NAME,
-                "messages": [
-                    {
-                        "role": "system",
-                        "content": "Your answer should be strictly be in form of a comma separated list. In JSON format with key \"sub_claims\""
-                    },
-                    {
-                        "role": "user",
-                        "content": user_prompt
-                    }
-                ],
-                "temperature": 0,
-                "response_format": {
-                    "type": "json_object"
+        One of the fixed demonstration orders, picked by a hash of the claim. Demonstrations still vary across rows,
+        but every prompt starts with one of a few prefixes which the provider caches.
+        '''
+        return self.permutations[zlib.crc32(claim.encode("utf-8")) % len(self.permutations)]
+
+    async def generate(self, claim):
+        '''
+        Decompose one claim into sub-claims
+        '''
+        demonstrations = self.stable_demonstrations(claim) if self.stable_prefix else self.shuffle_demonstrations()
+        
+        user_prompt = SUB_CLAIM_GENERATOR_PROMPT.format(demonstrations=demonstrations, claim=claim)  
+
+        model_config = {
+            "model": MODEL_NAME,
+            "messages": [
+                {
+                    "role": "system",
+                    "content": "Your answer should be strictly be in form of a comma separated list. In JSON format with key \"sub_claims\""
+                },
+                {
+                    "role": "user",
+                    "content": user_prompt
                 }
+            ],
+            "temperature": 0,
+            "response_format": {
+                "type": "json_object"
             }
-            response = self.model.call(model_config)
-            content = response.choices[0]["message"]["content"]
-            content = json.loads(content)
-            content = content["sub_claims"]
-            sub_claims.append(content)
+        }
+        return await self.async_model.call_json(model_config, validate=check_sub_claims)
 
-        data['sub_claims'] = sub_claims
-        data.to_csv(self.output_file, index=False)
+    async def generate_all(self, claims, rows=None):
+        '''
+        Decompose all claims concurrently, results are returned in the order of the claims (None for a failed claim)
+        '''
+        rows = list(range(len(claims)) if rows is None else rows)
+        self.claims += len(claims)
+        if self.router is None:
+            return await gather_rows("generator", rows, claims, [self.generate(claim) for claim in claims])
+        # an atomic claim is its own sub-claim, like the unit claim of the demonstrations
+        atomic = self.router.is_atomic(claims)
+        self.routed += sum(atomic)
+        results = [[claim.strip().rstrip(".")] if a else None for claim, a in zip(claims, atomic)]
+        pending = [i for i, a in enumerate(atomic) if not a]
+        generated = await gather_rows(
+            "generator", [rows[i] for i in pending], [claims[i] for i in pending], [self.generate(claims[i]) for i in pending]
+        )
+        for i, sub_claims in zip(pending, generated):
+            results[i] = sub_claims
+        return results
+
+    def process(self, data):
+        '''
+        Add the sub-claims of every claim to a dataframe
+        '''
+        claims = data['claim'].tolist()
+        if self.dedup is not None:
+            table = UniqueTable(claims)
+            self.dedup.add("claims", len(claims), len(table))
+            data['sub_claims'] = table.broadcast(asyncio.run(self.generate_all(table.items, table.column(data.index.tolist()))))
+        else:
+            data['sub_claims'] = asyncio.run(self.generate_all(claims, data.index.tolist()))
+        return data
+
+    def compare_routing(self, data):
+        '''
+        Decompose the claims with the model and with atomic claims routed through, and report the fraction of
+        claims skipping the model and the agreement: the fraction of the routed claims the model left whole too
+        '''
+        claims = data['claim'].tolist()
+        router = self.router
+        atomic = (router or get_atomic_router()).is_atomic(claims)
+        # only the routed claims need the model's decomposition to compare
+        self.router = None
+        try:
+            decomposed = asyncio.run(self.generate_all([c for c, a in zip(claims, atomic) if a]))
+        finally:
+            self.router = router
+        whole = [is_atomic_decomposition(s) for s in decomposed if s is not None]
+        return {
+            "claims": len(claims),
+            "skipped_claims": sum(atomic),
+            "skipped_fraction": sum(atomic)/len(claims) if claims else 0,
+            "agreement": sum(whole)/len(whole) if whole else 1.0,
+        }
+
+    def generate_sub_claims(self):
+        '''
+        Decompose sub-claims using few-shot prompting method. 
+        '''
+        data = self.process(self.data)
+        write_dataset(data, self.output_file)
 
 def main():
+    parser = argparse.ArgumentParser(description="Decompose claims into sub-claims")
+    parser.add_argument("--input", default='data/coverbench_dataset.csv')
+    parser.add_argument("--output", default='data/sub_claims.csv')
+    parser.add_argument("--streaming", action="store_true",
+                        help="process the input in chunks, checkpoint the finished rows to the output as JSONL and resume an interrupted run")
+    parser.add_argument("--chunksize", type=int, default=100, help="rows per chunk with --streaming")
+    args = parser.parse_args()
     sub_claim_generator = SubClaimGenerator()
-    sub_claim_generator.set_data(path = 'data/coverbench_dataset.csv')
-    sub_claim_generator.set_output_file('data/sub_claims.csv') # set output file
+    if args.streaming:
+        run_streaming(sub_claim_generator.process, args.input, streaming_output(args.output), args.chunksize, "sub_claims")
+        return
+    sub_claim_generator.set_data(path = args.input)
+    sub_claim_generator.set_output_file(args.output) # set output file
     sub_claim_generator.generate_sub_claims()
 
 if __name__ == '__main__':
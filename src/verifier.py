@@ -1,20 +1,38 @@
+import asyncio
 import os
-from prompts import VERIFIER_PROMPT
+import time
+from prompts import PREFIX_STABLE_VERIFIER_PROMPT, VERIFIER_PROMPT
 from config import MODEL_NAME
-from src.open_ai import OpenAI
+from src.dataset_io import as_list, require_list
+from src.dedup import DedupStats, SharedResults, UniqueTable, key
+from src.open_ai import AsyncOpenAI, OpenAI
+from src.resilience import gather_rows
+from src.retrieval import get_retrieval_index
 
 class Verifier:
     '''
     Verify if claim is true or false based on the context provided
     '''
-    def __init__(self):
+    def __init__(self, cache=None, stable_prefix=False, dedup=False, early_exit=False, retrieval_k=0):
         self.model_name = MODEL_NAME
-        self.model = OpenAI(os.environ['OPENAI_API_KEY'], os.environ['OPENAI_ORGANIZATION'])
+        self.early_exit = early_exit # process() stops verifying a row at its first false sub-claim
+        # verify every sub-claim against the retrieval_k chunks of the context most relevant to it, 0 for the whole context
+        self.retrieval_k = retrieval_k
+        self.retrieval = get_retrieval_index() if retrieval_k else None
+        self.dedup = DedupStats() if dedup else None # verify every unique row and (sub-claim, context) pair once
+        self._shared = None
+        # with stable_prefix the context comes before the claim, so that the sub-claims of a row share a cached prompt prefix
+        self.prompt = PREFIX_STABLE_VERIFIER_PROMPT if stable_prefix else VERIFIER_PROMPT
+        self.model = OpenAI(os.environ.get('OPENAI_API_KEY', ''), os.environ.get('OPENAI_ORGANIZATION', ''), cache=cache, stage="verifier")
+        self.async_model = AsyncOpenAI(os.environ.get('OPENAI_API_KEY', ''), os.environ.get('OPENAI_ORGANIZATION', ''), cache=cache, stage="verifier")
+        self.calls = 0 # verification responses received
+        self.prompt_tokens = 0
+        self.skipped = 0 # verifications cancelled by early exit before their response
 
-    def verify_claim(self, claim, context):
-        user_prompt = VERIFIER_PROMPT.format(claim=claim, context=context)  
+    def model_config(self, claim, context):
+        user_prompt = self.prompt.format(claim=claim, context=context)  
 
-        model_config = {
+        return {
             "model": MODEL_NAME,
             "messages": [
                 {
@@ -28,6 +46,104 @@ class Verifier:
             ],
             "temperature": 0,
         }
-        response = self.model.call(model_config)
+
+    def evidence(self, claim, context):
+        '''
+        The part of the context a claim is verified against: its retrieval_k most relevant chunks, or all of it
+        '''
+        if self.retrieval is None:
+            return context
+        return self.retrieval.evidence(claim, context, self.retrieval_k)
+
+    def verify_claim(self, claim, context):
+        if self.retrieval is not None:
+            self.retrieval.add([context])
+        response = self.model.call(self.model_config(claim, self.evidence(claim, context)))
+        content = response.choices[0]["message"]["content"]
+        return content.strip().lower()
+
+    async def verify(self, claim, context):
+        response = await self.async_model.call(self.model_config(claim, context))
+        self.calls += 1
+        self.prompt_tokens += (response.get("usage") or {}).get("prompt_tokens", 0)
         content = response.choices[0]["message"]["content"]
-        return content.strip.lower()
\ No newline at end of file
+        return content.strip().lower()
+
+    async def verify_row(self, sub_claims, context, early_exit=False):
+        '''
+        Verify all sub-claims of a claim concurrently against their shared context. 
+        The claim is true only if every sub-claim is true, so the aggregated label is "false" as soon as one sub-claim is false. 
+        With early_exit, the verifications still pending at that point are cancelled and their labels are None.
+        Returns the sub-claim labels and the aggregated label.
+        '''
+        sub_claims = require_list(sub_claims, "sub_claims")
+        if self._shared is not None:
+            # the same sub-claim recurs with the same context across rows
+            context_key = key(context)
+            tasks = [
+                asyncio.ensure_future(self._shared.get((key(c), context_key), self.verify, c, self.evidence(c, context)))
+                for c in sub_claims
+            ]
+        else:
+            tasks = [asyncio.ensure_future(self.verify(c, self.evidence(c, context))) for c in sub_claims]
+        if early_exit:
+            try:
+                for next_done in asyncio.as_completed(tasks):
+                    if await next_done != "true":
+                        break
+            finally:
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+            if self._shared is None:
+                # a verification which received its response despite the cancellation was not skipped
+                self.skipped += sum(task.cancelled() for task in tasks)
+            labels = [task.result() if not task.cancelled() and task.exception() is None else None for task in tasks]
+        else:
+            labels = list(await asyncio.gather(*tasks))
+        aggregated_label = "true" if all(label == "true" for label in labels) else "false"
+        return labels, aggregated_label
+
+    async def verify_many(self, sub_claims, contexts, early_exit=False, rows=None):
+        '''
+        Verify many rows concurrently, results are returned in row order with the latency of each row
+        (None for a failed row)
+        '''
+        rows = range(len(sub_claims)) if rows is None else rows
+        if self.retrieval is not None:
+            # chunk and index the contexts seen for the first time
+            self.retrieval.add(set(contexts))
+        if self.dedup is not None:
+            table = UniqueTable(list(zip(sub_claims, contexts)))
+            self.dedup.add("rows", len(sub_claims), len(table))
+            self._shared = SharedResults()
+            try:
+                results = await self._verify_many(
+                    [s for s, _ in table.items], [c for _, c in table.items], early_exit, table.column(list(rows))
+                )
+            finally:
+                # a shared verification is skipped only if every row waiting for it exited early
+                await self._shared.settle()
+                self.skipped += sum(task.cancelled() for task in self._shared.tasks.values())
+                self.dedup.add("sub_claims", self._shared.requests, len(self._shared.tasks))
+                self._shared = None
+            return table.broadcast(results)
+        return await self._verify_many(sub_claims, contexts, early_exit, rows)
+
+    async def _verify_many(self, sub_claims, contexts, early_exit, rows):
+        async def timed(s, c):
+            start = time.perf_counter()
+            labels, aggregated_label = await self.verify_row(s, c, early_exit)
+            return labels, aggregated_label, time.perf_counter() - start
+        return await gather_rows("verifier", rows, sub_claims, [timed(s, c) for s, c in zip(sub_claims, contexts)], progress=False)
+
+    def process(self, data):
+        '''
+        Add the labels of the sub-claims of every row and the aggregated label to a dataframe, verified against
+        the "context" column
+        '''
+        sub_claims = [as_list(s) for s in data['sub_claims']]
+        results = asyncio.run(self.verify_many(sub_claims, data['context'].tolist(), self.early_exit, data.index.tolist()))
+        data['predicted_labels'] = [r[0] if r is not None else None for r in results]
+        data['predicted_aggregated_label'] = [r[1] if r is not None else None for r in results]
+        return data
@@ -0,0 +1,111 @@
+import argparse
+import asyncio
+import time
+
+from config import MODEL_NAME, RETRIEVAL_TOP_K
+
+from src.dataset_io import as_list, read_dataset
+from verifier import Verifier
+
+
+def load_benchmark(benchmark_path, coverbench_path):
+    '''
+    FactLens benchmark rows with their CoverBench context, "ind" is the row of the claim in CoverBench
+    '''
+    data = read_dataset(benchmark_path)
+    contexts = read_dataset(coverbench_path, columns=['context'])['context']
+    data['context'] = contexts.iloc[data['ind']].values
+    return data
+
+
+def run(data, early_exit, retrieval_k=0):
+    '''
+    Verify every row and report accuracy against the benchmark labels, calls, prompt tokens and latency
+    '''
+    # every run pays for its calls, so that the modes can be compared
+    verifier = Verifier(cache=False, retrieval_k=retrieval_k)
+    sub_claims = [as_list(s) for s in data['sub_claims']]
+    index_time = 0
+    if verifier.retrieval is not None:
+        start = time.perf_counter()
+        verifier.retrieval.add(set(data['context']))
+        index_time = time.perf_counter() - start
+    start = time.perf_counter()
+    results = asyncio.run(verifier.verify_many(sub_claims, data['context'].tolist(), early_exit, data.index.tolist()))
+    wall_time = time.perf_counter() - start
+    failed = sum(r is None for r in results) # in the dead-letter file
+    data = data[[r is not None for r in results]]
+    results = [r for r in results if r is not None]
+
+    correct = total = 0
+    for (labels, _, _), gold in zip(results, data['labels']):
+        for label, gold_label in zip(labels, as_list(gold) or []):
+            if label is not None:
+                total += 1
+                correct += label == str(gold_label).lower()
+    claim_correct = sum(
+        aggregated_label == str(gold).lower()
+        for (_, aggregated_label, _), gold in zip(results, data['aggregated_label'])
+    )
+    latencies = [latency for _, _, latency in results]
+    return {
+        "early_exit": early_exit,
+        "retrieval_k": retrieval_k,
+        "rows": len(data),
+        "failed_rows": failed,
+        "sub_claim_accuracy": correct/total if total else 0,
+        "claim_accuracy": claim_correct/len(data) if len(data) else 0,
+        "calls": verifier.calls,
+        "skipped_calls": verifier.skipped,
+        "prompt_tokens": verifier.prompt_tokens,
+        "prompt_tokens_per_call": verifier.prompt_tokens/verifier.calls if verifier.calls else 0,
+        "index_time": index_time,
+        "mean_row_latency": sum(latencies)/len(latencies) if latencies else 0,
+        "wall_time": wall_time,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the verifier over the FactLens benchmark")
+    parser.add_argument("--benchmark", default="benchmark/fact_lens_benchmark.csv")
+    parser.add_argument("--coverbench", default="data/coverbench_dataset.csv")
+    parser.add_argument("--limit", type=int, default=None, help="only verify the first rows")
+    parser.add_argument("--early-exit", action="store_true", help="stop verifying a claim at its first false sub-claim")
+    parser.add_argument("--retrieval-k", type=int, default=0, help="verify against the k most relevant chunks of the context, 0 for the whole context")
+    parser.add_argument("--compare", action="store_true", help="run with and without early exit and report the savings")
+    parser.add_argument("--compare-retrieval", action="store_true", help="run with the whole context and with retrieval (--retrieval-k or RETRIEVAL_TOP_K chunks) and report the savings")
+    args = parser.parse_args()
+
+    data = load_benchmark(args.benchmark, args.coverbench)
+    if args.limit:
+        data = data.head(args.limit)
+
+    if args.compare_retrieval:
+        full = run(data, args.early_exit)
+        retrieved = run(data, args.early_exit, args.retrieval_k or RETRIEVAL_TOP_K)
+        print(full)
+        print(retrieved)
+        print({
+            "prompt_token_reduction": 1 - retrieved["prompt_tokens"]/full["prompt_tokens"] if full["prompt_tokens"] else 0,
+            "mean_row_latency_saved": full["mean_row_latency"] - retrieved["mean_row_latency"],
+            "sub_claim_accuracy_change": retrieved["sub_claim_accuracy"] - full["sub_claim_accuracy"],
+            "claim_accuracy_change": retrieved["claim_accuracy"] - full["claim_accuracy"],
+        })
+        return
+    if not args.compare:
+        print(run(data, args.early_exit, args.retrieval_k))
+        return
+    full = run(data, early_exit=False, retrieval_k=args.retrieval_k)
+    early = run(data, early_exit=True, retrieval_k=args.retrieval_k)
+    print(full)
+    print(early)
+    print({
+        "calls_saved": full["calls"] - early["calls"],
+        "mean_row_latency_saved": full["mean_row_latency"] - early["mean_row_latency"],
+        "claim_accuracy_change": early["claim_accuracy"] - full["claim_accuracy"],
+    })
+
+if __name__ == '__main__':
+    if not MODEL_NAME:
+        raise Exception("MODEL_NAME not set. Please set MODEL_NAME in config.py")
+    main()
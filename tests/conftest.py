@@ -0,0 +1,30 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, "src")]
+
+SYNTHETIC = os.path.join(ROOT, "synthetic/fact_lens_synthetic_sub_claims.csv")
+
+
+@pytest.fixture
+def stub_backend():
+    '''
+    Every client created in the test answers with the stub backend, no model and no API key
+    '''
+    from src.backends import StubBackend, set_backend
+    backend = StubBackend()
+    set_backend(backend)
+    yield backend
+    set_backend(None)
+
+
+@pytest.fixture
+def dead_letter(tmp_path):
+    '''
+    Failed rows of the test are written to a temporary file
+    '''
+    from src.resilience import set_dead_letter
+    return set_dead_letter(str(tmp_path / "dead_letter.jsonl"))
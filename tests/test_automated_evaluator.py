@@ -0,0 +1,51 @@
+from conftest import SYNTHETIC
+
+
+def evaluate(data, **options):
+    from automated_evaluator import AutomatedEvaluator
+    evaluator = AutomatedEvaluator(**options)
+    evaluator.fabrication_threshold = 0.9
+    evaluator.coverage_threshold = 0.8
+    evaluator.redundancy_threshold = 0.7
+    try:
+        return evaluator.process(data.copy())
+    finally:
+        evaluator.close()
+
+
+def test_pool_matches_serial(stub_backend, dead_letter):
+    '''
+    Scoring in a process pool gives the scores and entities of scoring in this process, with the thresholds
+    of the evaluator, on the whole synthetic dataset (whose malformed sub_claims cell fails its row)
+    '''
+    from src.dataset_io import read_dataset
+    data = read_dataset(SYNTHETIC)
+    serial = evaluate(data, redundancy_chunk_size=8)
+    pool = evaluate(data, redundancy_chunk_size=8, workers=2)
+    for column in ["automated_scores", "claim_entities", "sub_claim_entities"]:
+        assert pool[column].tolist() == serial[column].tolist()
+    failed = data["sub_claims"].isna()
+    assert failed.sum() == 1
+    assert serial["automated_scores"][failed].isna().all()
+    assert serial["automated_scores"][~failed].notna().all()
+
+
+def test_pool_follows_changed_settings(stub_backend, dead_letter):
+    '''
+    Thresholds changed between two runs of the same evaluator are used by its scoring processes
+    '''
+    from automated_evaluator import AutomatedEvaluator
+    from src.dataset_io import read_dataset
+    data = read_dataset(SYNTHETIC).head(20)
+    evaluator = AutomatedEvaluator(redundancy_chunk_size=8, workers=2)
+    try:
+        default = evaluator.process(data.copy())["automated_scores"].tolist()
+        evaluator.fabrication_threshold = 0.9
+        evaluator.coverage_threshold = 0.8
+        evaluator.redundancy_threshold = 0.7
+        changed = evaluator.process(data.copy())["automated_scores"].tolist()
+    finally:
+        evaluator.close()
+    serial = evaluate(data, redundancy_chunk_size=8)["automated_scores"].tolist()
+    assert changed == serial
+    assert changed != default
@@ -0,0 +1,42 @@
+import json
+
+
+def test_streaming_resume_retries_failed_rows(tmp_path):
+    '''
+    Rows a stage failed on are left out of the checkpoint, so that resuming the run processes them again
+    '''
+    import pandas as pd
+    from src.dataset_io import run_streaming
+    input_path, output_path = str(tmp_path / "input.csv"), str(tmp_path / "output.jsonl")
+    pd.DataFrame({"claim": ["claim {}".format(i) for i in range(10)]}).to_csv(input_path, index=False)
+    seen = []
+
+    def process(data, fail=True):
+        seen.extend(data.index)
+        data["result"] = [None if fail and i % 3 == 0 else c.upper() for i, c in zip(data.index, data["claim"])]
+        return data
+
+    assert run_streaming(process, input_path, output_path, chunksize=4, result_column="result") == 4
+    assert run_streaming(lambda data: process(data, fail=False), input_path, output_path, chunksize=4, result_column="result") == 0
+    assert seen == list(range(10)) + [0, 3, 6, 9]
+    with open(output_path) as f:
+        records = sorted((json.loads(line) for line in f), key=lambda r: r["_row"])
+    assert [r["result"] for r in records] == ["CLAIM {}".format(i) for i in range(10)]
+
+
+def test_only_list_columns_are_parsed(tmp_path):
+    '''
+    Free text which looks like a list is kept, a malformed list cell becomes None and is reported
+    '''
+    import pandas as pd
+    from src.dataset_io import parse_literals
+    errors = []
+    data = parse_literals(pd.DataFrame({
+        "claim": ["[Draft] a claim", "{Note} another"],
+        "sub_claims": ['["a claim"]', '["a", , "b"]'],
+        "atomicity_human1": ["[3, 2]", float("nan")],
+    }), errors)
+    assert data["claim"].tolist() == ["[Draft] a claim", "{Note} another"]
+    assert data["sub_claims"].tolist() == [["a claim"], None]
+    assert data["atomicity_human1"].tolist() == [[3, 2], None]
+    assert errors == [("sub_claims", 1)]
@@ -0,0 +1,42 @@
+import os
+import random
+
+
+def contexts(n=60, seed=0):
+    r = random.Random(seed)
+    words = ["w{}".format(i) for i in range(200)]
+    return [
+        "\n".join(" ".join(r.choice(words) for _ in range(r.randint(5, 150))) for _ in range(r.randint(1, 8)))
+        for _ in range(n)
+    ], words
+
+
+def test_merged_segments_search_like_one_segment(tmp_path):
+    '''
+    Contexts added one at a time are merged into few segments, and search them like contexts added at once
+    '''
+    from src.retrieval import RetrievalIndex
+    texts, words = contexts()
+    index = RetrievalIndex(str(tmp_path / "one_by_one"), max_segments=4)
+    for text in texts:
+        assert index.add([text]) == 1
+    assert index.add(texts) == 0
+    assert len(index.segments) <= 4
+    reference = RetrievalIndex(str(tmp_path / "at_once"))
+    reference.add(texts)
+    reopened = RetrievalIndex(str(tmp_path / "one_by_one"), max_segments=4)
+    r = random.Random(1)
+    for text in texts:
+        query = " ".join(r.choice(words) for _ in range(6))
+        assert index.chunks(text) == reopened.chunks(text) == reference.chunks(text)
+        assert index.search(query, text, 5) == reopened.search(query, text, 5) == reference.search(query, text, 5)
+
+
+def test_add_skips_indexed_contexts(tmp_path):
+    from src.retrieval import RetrievalIndex
+    texts, _ = contexts(10)
+    index = RetrievalIndex(str(tmp_path))
+    index.add(texts)
+    names = os.listdir(str(tmp_path))
+    assert index.add(texts[:5]) == 0
+    assert os.listdir(str(tmp_path)) == names
@@ -0,0 +1,42 @@
+import pytest
+
+from conftest import SYNTHETIC
+
+
+def test_resume_with_another_shard_size_raises(tmp_path):
+    from src.sharding import partition
+    shard_dir = str(tmp_path / "shards")
+    paths = partition(SYNTHETIC, shard_dir, shard_size=20)
+    assert partition(SYNTHETIC, shard_dir, shard_size=20) == paths
+    with pytest.raises(ValueError):
+        partition(SYNTHETIC, shard_dir, shard_size=10)
+
+
+@pytest.mark.parametrize("kind", ["sqlite", "file", "redis"])
+def test_lease_is_renewed_while_a_shard_runs(tmp_path, kind):
+    '''
+    A shard taking longer than the lease stays with its worker, while another worker polls the queue
+    '''
+    import threading
+    import time
+    from src.sharding import FileQueue, LocalRedis, RedisQueue, SQLiteQueue, Worker
+    queue = {
+        "sqlite": lambda: SQLiteQueue(str(tmp_path / "queue.sqlite"), lease_seconds=0.3),
+        "file": lambda: FileQueue(str(tmp_path / "queue"), lease_seconds=0.3),
+        "redis": lambda: RedisQueue(LocalRedis(), lease_seconds=0.3),
+    }[kind]()
+    queue.put([{"shard": 0, "stage": "generator", "input": "", "output": ""}])
+
+    class SlowWorker(Worker):
+        def run_task(self, task):
+            time.sleep(1.2)
+
+    workers = [threading.Thread(target=SlowWorker(queue, "worker-{}".format(i)).run, kwargs={"poll": 0.05}) for i in range(2)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    task = queue.status()[0]
+    assert task["state"] == "done"
+    assert task["attempts"] == 1
+    assert "failures" not in task
@@ -0,0 +1,37 @@
+from conftest import SYNTHETIC
+
+METRICS = ["atomicity", "fabrication", "coverage", "redundancy"]
+
+
+def synthetic(rows=12):
+    from src.dataset_io import read_dataset
+    return read_dataset(SYNTHETIC).head(rows)
+
+
+def test_generator(stub_backend, dead_letter):
+    from sub_claim_generator import SubClaimGenerator
+    data = SubClaimGenerator().process(synthetic()[["claim"]].copy())
+    assert all(isinstance(s, list) and s and all(isinstance(c, str) for c in s) for s in data["sub_claims"])
+
+
+def test_generator_dedup_shares_sub_claims(stub_backend, dead_letter):
+    from sub_claim_generator import SubClaimGenerator
+    claims = synthetic(4)[["claim"]]
+    data = SubClaimGenerator(stable_prefix=True, dedup=True).process(claims.loc[list(claims.index)*2].reset_index(drop=True))
+    assert data["sub_claims"][:4].tolist() == data["sub_claims"][4:].tolist()
+
+
+def test_llm_evaluator(stub_backend, dead_letter):
+    from sub_claim_evaluator import SubClaimEvaluator
+    for single_pass in (False, True):
+        data = SubClaimEvaluator(single_pass=single_pass).process(synthetic())
+        for scores in data["llm_evaluation_scores"]:
+            assert set(METRICS) <= set(scores)
+
+
+def test_automated_evaluator(stub_backend, dead_letter):
+    from automated_evaluator import AutomatedEvaluator
+    data = AutomatedEvaluator(batch_entities=True).process(synthetic())
+    for scores, entities in zip(data["automated_scores"], data["claim_entities"]):
+        assert set(METRICS) <= set(scores)
+        assert set(entities) == {"subjects", "objects"}
@@ -0,0 +1,30 @@
+import asyncio
+
+
+def rows():
+    '''
+    Rows of sub-claims and contexts, every row repeated so that sub-claims recur across rows
+    '''
+    sub_claims = [["sub-claim {} of claim {}".format(i, claim) for i in range(1 + claim % 5)] for claim in range(40)]
+    contexts = ["context of claim {}".format(claim) for claim in range(40)]
+    return sub_claims*3, contexts*3
+
+
+def test_early_exit_accounts_for_every_verification(dead_letter):
+    '''
+    With early exit, every verification either received its response or was cancelled before it, with and
+    without dedup (a shared verification is only cancelled when every row waiting for it exited)
+    '''
+    from src.backends import MockBackend, set_backend
+    from verifier import Verifier
+    set_backend(MockBackend(latency=0.01, jitter=0.05, failure_rate=0, seed=1))
+    try:
+        sub_claims, contexts = rows()
+        for dedup, verifications in [(False, sum(map(len, sub_claims))), (True, sum(map(len, sub_claims[:40])))]:
+            verifier = Verifier(cache=False, dedup=dedup)
+            results = asyncio.run(verifier.verify_many(sub_claims, contexts, early_exit=True))
+            assert all(r is not None for r in results)
+            assert verifier.skipped > 0
+            assert verifier.calls + verifier.skipped == verifications
+    finally:
+        set_backend(None)